@@ -0,0 +1,227 @@
+"""
+Asyncio facade over db_operations.
+
+Every function here is the db_operations function of the same name, as a
+coroutine: the call runs on a dedicated thread pool so the event loop never
+blocks on SQLite. Reads share a pool of ``READ_WORKERS`` threads, each with
+its own read-only connection (see models.reading); writes run one at a time
+on a single writer thread, which is all SQLite allows anyway.
+
+    products = await async_operations.search("mug", timeout=2)
+
+Calls beyond the number of worker threads wait in the event loop, where
+waiting costs next to nothing, rather than in the executor queue, so a
+cancelled or timed-out call that hasn't started yet never runs. A read that
+is already running is interrupted (sqlite3 ``Connection.interrupt``); a
+write that has started is left to finish, so its outcome never depends on
+timing. Timeouts raise TimeoutError.
+
+authenticate_user and create_session check the password on the read pool.
+A password they have to re-hash (see db_operations.check_password) is
+stored afterwards by the writer thread, so reads never write.
+"""
+import asyncio
+import contextlib
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from playhouse.pool import PooledDatabase
+
+import db_operations
+from models import db, reading
+
+
+READ = 'read'
+WRITE = 'write'
+
+READ_WORKERS = 8
+
+
+def _connection():
+    # Pooled connections go back to the pool after every call; otherwise each
+    # worker thread keeps its own connection open.
+    if isinstance(db, PooledDatabase):
+        return db.connection_context()
+    return contextlib.nullcontext()
+
+
+class _Call:
+    """
+    One call on a worker thread, which the event loop side can cancel.
+    """
+    def __init__(self, func, args, kwargs, interruptible):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interruptible = interruptible
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._conn = None
+
+    def run(self):
+        # Reads go to the thread's read-only connection, when reads are routed
+        with _connection(), (reading() if self.interruptible else contextlib.nullcontext()):
+            with self._lock:
+                if self._cancelled:
+                    return None
+                if self.interruptible:
+                    self._conn = db.read_connection() if db.routes_reads() else db.connection()
+            try:
+                return self.func(*self.args, **self.kwargs)
+            finally:
+                with self._lock:
+                    self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                # Aborts the statement running on the connection, if any
+                self._conn.interrupt()
+
+
+class DatabaseExecutor:
+    """
+    The read and write thread pools, started on first use.
+    """
+    def __init__(self, read_workers=READ_WORKERS):
+        self.read_workers = read_workers
+        self._executors = {}
+        self._limits = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _executor(self, kind):
+        with self._lock:
+            executor = self._executors.get(kind)
+            if executor is None:
+                workers = self.read_workers if kind == READ else 1
+                executor = self._executors[kind] = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix=f"db-{kind}")
+            return executor
+
+    def _limit(self, kind):
+        # Semaphores belong to one event loop, so there is a pair per loop
+        loop = asyncio.get_running_loop()
+        limits = self._limits.get(loop)
+        if limits is None:
+            limits = self._limits[loop] = {
+                READ: asyncio.Semaphore(self.read_workers),
+                WRITE: asyncio.Semaphore(1),
+            }
+        return limits[kind]
+
+    async def _dispatch(self, kind, func, args, kwargs):
+        async with self._limit(kind):
+            call = _Call(func, args, kwargs, interruptible=(kind == READ))
+            future = asyncio.get_running_loop().run_in_executor(self._executor(kind), call.run)
+            try:
+                return await future
+            except asyncio.CancelledError:
+                call.cancel()
+                raise
+
+    async def run(self, kind, func, *args, timeout=None, **kwargs):
+        """
+        Runs ``func(*args, **kwargs)`` on the read or write pool. ``timeout``
+        is in seconds and includes the time spent waiting for a free worker;
+        None waits indefinitely.
+        """
+        return await asyncio.wait_for(self._dispatch(kind, func, args, kwargs), timeout)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+executor = DatabaseExecutor()
+
+
+def _facade(kind, func):
+    @functools.wraps(func)
+    async def call(*args, timeout=None, **kwargs):
+        return await executor.run(kind, func, *args, timeout=timeout, **kwargs)
+
+    return call
+
+
+def shutdown(wait=True):
+    executor.shutdown(wait)
+
+
+def _deferring_rehashes(func):
+    # Runs a password check on the read pool; the rehashes it computes are
+    # returned, to be stored by the writer
+    def call(*args, **kwargs):
+        with db_operations.deferred_rehashes() as pending:
+            return func(*args, **kwargs), pending
+
+    return call
+
+
+async def _check_password(func, *args, timeout=None, **kwargs):
+    result, pending = await executor.run(READ, _deferring_rehashes(func), *args, timeout=timeout, **kwargs)
+    for user, hashed in pending:
+        await executor.run(WRITE, db_operations.store_rehashed_password, user, hashed)
+    return result
+
+
+def _password_check(func):
+    @functools.wraps(func)
+    async def call(*args, timeout=None, **kwargs):
+        return await _check_password(func, *args, timeout=timeout, **kwargs)
+
+    return call
+
+
+@functools.wraps(db_operations.create_session)
+async def create_session(username, password, ttl=None, timeout=None):
+    user = await _check_password(db_operations.check_login, username, password, timeout=timeout)
+    if isinstance(user, str):
+        return user
+    return await executor.run(WRITE, db_operations.start_session, user, ttl, timeout=timeout)
+
+
+# Catalog
+search = _facade(READ, db_operations.search)
+list_products = _facade(READ, db_operations.list_products)
+get_product_details = _facade(READ, db_operations.get_product_details)
+list_product_tags = _facade(READ, db_operations.list_product_tags)
+create_product = _facade(WRITE, db_operations.create_product)
+update_product = _facade(WRITE, db_operations.update_product)
+delete_product = _facade(WRITE, db_operations.delete_product)
+add_stock = _facade(WRITE, db_operations.add_stock)
+reduce_stock = _facade(WRITE, db_operations.reduce_stock)
+
+# Tags
+list_tags = _facade(READ, db_operations.list_tags)
+get_tag_details = _facade(READ, db_operations.get_tag_details)
+create_tag = _facade(WRITE, db_operations.create_tag)
+update_tag = _facade(WRITE, db_operations.update_tag)
+delete_tag = _facade(WRITE, db_operations.delete_tag)
+add_tag_to_product = _facade(WRITE, db_operations.add_tag_to_product)
+remove_tag_from_product = _facade(WRITE, db_operations.remove_tag_from_product)
+
+# Users
+authenticate_user = _password_check(db_operations.authenticate_user)
+logout = _facade(WRITE, db_operations.logout)
+get_user_details = _facade(READ, db_operations.get_user_details)
+get_user_by_username = _facade(READ, db_operations.get_user_by_username)
+list_users = _facade(READ, db_operations.list_users)
+create_user = _facade(WRITE, db_operations.create_user)
+update_user = _facade(WRITE, db_operations.update_user)
+update_user_password = _facade(WRITE, db_operations.update_user_password)
+delete_user = _facade(WRITE, db_operations.delete_user)
+
+# Orders
+list_orders = _facade(READ, db_operations.list_orders)
+get_order_details = _facade(READ, db_operations.get_order_details)
+get_purchase_details = _facade(READ, db_operations.get_purchase_details)
+get_user_purchases = _facade(READ, db_operations.get_user_purchases)
+record_purchase = _facade(WRITE, db_operations.record_purchase)
+purchase_product = _facade(WRITE, db_operations.purchase_product)
+place_order = _facade(WRITE, db_operations.place_order)
+checkout = _facade(WRITE, db_operations.checkout)
@@ -0,0 +1,240 @@
+"""
+Typo-tolerant lookups ("did you mean") over product and tag names.
+
+An in-memory trigram index holds every product name, tag name and the words
+they are made of. It is loaded from the database once, on first use, and then
+kept current by db_operations as products and tags are created, renamed and
+deleted; it never rescans the tables after that. Changes made inside a
+transaction reach the index when it commits, so a rollback leaves no
+phantom names behind.
+
+Candidates are found through the rarest trigrams of the query only (with k
+edits allowed, a match must share all but 3k of the query's trigrams, so it
+has to show up in one of the 3k + 1 rarest posting lists), then verified with
+a bounded edit distance.
+"""
+import itertools
+import threading
+
+from models import db, Product, Tag
+
+
+PRODUCT = 'product'
+TAG = 'tag'
+WORD = 'word'
+
+# Numbers the loads of every index, so a change queued before a load can tell
+_loads = itertools.count(1)
+
+
+def normalize(text):
+    return ' '.join((text or '').lower().split())
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """
+    Damerau-Levenshtein distance (optimal string alignment, so a swap of two
+    neighbouring letters is one edit). Returns ``limit + 1`` as soon as the
+    distance is known to exceed ``limit``.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, char_b in enumerate(b, 1):
+            cost = 0 if char_a == char_b else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous2 is not None and i > 1 and j > 1
+                    and char_a == b[j - 2] and a[i - 2] == char_b):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def allowed_edits(text, max_distance):
+    # Short strings have too few trigrams to tell a typo from another word.
+    if len(text) <= 3:
+        return 0
+    return min(max_distance, 1 if len(text) <= 5 else 2)
+
+
+class TrigramIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._entries = {}      # entry id -> (kind, normalized text, display text)
+        self._ids = {}          # (kind, normalized text) -> entry id
+        self._refcounts = {}    # entry id -> number of names holding it
+        self._postings = {}     # kind -> trigram -> set of entry ids
+        self._next_id = 0
+        self._load = 0          # which load the contents come from
+
+    def reset(self):
+        """
+        Forgets everything; the next lookup reloads from the database.
+        """
+        with self._lock:
+            self.__init__()
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            for (name,) in Product.select(Product.name).tuples().iterator():
+                self._add_name(PRODUCT, name)
+            for (name,) in Tag.select(Tag.name).tuples().iterator():
+                self._add_name(TAG, name)
+            self._loaded = True
+            self._load = next(_loads)
+
+    def _after_commit(self, change):
+        # Applied once the surrounding transaction commits (right away outside
+        # one), and dropped on rollback
+        with self._lock:
+            load = self._load
+
+        def apply():
+            with self._lock:
+                if not self._loaded:
+                    return
+                if self._load != load:
+                    # Loaded while the transaction was open, perhaps with the
+                    # change already in it: reload on the next lookup instead
+                    self.reset()
+                    return
+                change()
+
+        db.after_commit(apply)
+
+    def add(self, kind, name):
+        self._after_commit(lambda: self._add_name(kind, name))
+
+    def remove(self, kind, name):
+        self._after_commit(lambda: self._remove_name(kind, name))
+
+    def rename(self, kind, old_name, new_name):
+        if old_name == new_name:
+            return
+
+        def change():
+            self._remove_name(kind, old_name)
+            self._add_name(kind, new_name)
+
+        self._after_commit(change)
+
+    def _add_name(self, kind, name):
+        text = normalize(name)
+        if not text:
+            return
+        self._add_entry(kind, text, name)
+        for word in text.split():
+            self._add_entry(WORD, word, word)
+
+    def _remove_name(self, kind, name):
+        text = normalize(name)
+        if not text:
+            return
+        self._remove_entry(kind, text)
+        for word in text.split():
+            self._remove_entry(WORD, word)
+
+    def _add_entry(self, kind, text, display):
+        entry_id = self._ids.get((kind, text))
+        if entry_id is not None:
+            self._refcounts[entry_id] += 1
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._ids[(kind, text)] = entry_id
+        self._entries[entry_id] = (kind, text, display)
+        self._refcounts[entry_id] = 1
+        postings = self._postings.setdefault(kind, {})
+        for gram in trigrams(text):
+            postings.setdefault(gram, set()).add(entry_id)
+
+    def _remove_entry(self, kind, text):
+        entry_id = self._ids.get((kind, text))
+        if entry_id is None:
+            return
+        self._refcounts[entry_id] -= 1
+        if self._refcounts[entry_id] > 0:
+            return
+        del self._ids[(kind, text)]
+        del self._entries[entry_id]
+        del self._refcounts[entry_id]
+        postings = self._postings[kind]
+        for gram in trigrams(text):
+            posting = postings.get(gram)
+            if posting is not None:
+                posting.discard(entry_id)
+                if not posting:
+                    del postings[gram]
+
+    def lookup(self, term, kinds=(PRODUCT, TAG), limit=10, max_distance=2):
+        """
+        Returns up to ``limit`` (display text, kind, distance) tuples for the
+        indexed entries of the given kinds within ``max_distance`` edits of
+        ``term``, closest first.
+        """
+        text = normalize(term)
+        if not text:
+            return []
+        self.load()
+        edits = allowed_edits(text, max_distance)
+        grams = trigrams(text)
+        required = max(len(grams) - 3 * edits, 1)
+        matches = []
+        with self._lock:
+            for kind in kinds:
+                kind_postings = self._postings.get(kind, {})
+                postings = sorted((kind_postings.get(gram, ()) for gram in grams), key=len)
+                for entry_id in set().union(*postings[:3 * edits + 1]):
+                    shared = sum(1 for posting in postings if entry_id in posting)
+                    if shared < required:
+                        continue
+                    _, candidate, display = self._entries[entry_id]
+                    distance = edit_distance(text, candidate, edits)
+                    if distance <= edits:
+                        matches.append((distance, -shared, display, kind))
+        matches.sort()
+        return [(display, kind, distance) for distance, _, display, kind in matches[:limit]]
+
+    def suggest(self, term, max_distance=2):
+        """
+        Returns ``term`` with each unknown word replaced by the closest known
+        word, or None when there is nothing to correct.
+        """
+        words = normalize(term).split()
+        corrected = []
+        for word in words:
+            matches = self.lookup(word, kinds=(WORD,), limit=1, max_distance=max_distance)
+            corrected.append(matches[0][0] if matches else word)
+        if corrected == words:
+            return None
+        return ' '.join(corrected)
+
+
+name_index = TrigramIndex()
+
+
+def suggest(term):
+    """
+    "Did you mean" for a search term, or None.
+    """
+    return name_index.suggest(term)
+
+
+def fuzzy_matches(term, limit=10):
+    """
+    Product and tag names within a few typos of ``term``, closest first.
+    """
+    return name_index.lookup(term, limit=limit)
@@ -0,0 +1,397 @@
+"""
+Benchmarks for the db_operations hot paths on generated datasets.
+
+Each size is a synthetic dataset (see populate_db.generate_synthetic_dataset)
+with that many purchases and proportional users, products and tags. Datasets
+are generated once per size and seed into ``--data-dir`` and reused; every
+run works on a scratch copy, so the purchase paths never change them.
+
+    python benchmark.py --sizes 10k 100k --output results.json
+    python benchmark.py --sizes 10k --compare results.json
+    python benchmark.py --keys --key-rows 10000000
+
+Results are JSON: per size and case, latency percentiles (ms), throughput
+(calls/s), statements per call and peak Python memory of one call. With
+``--compare`` every case whose p50 or p95 got slower than the baseline by
+more than ``--threshold`` is reported and the exit status is 1.
+
+``--keys`` instead compares the primary key generators of models.KEY_GENERATORS:
+purchases are appended to an empty database in committed batches, once per
+generator, recording throughput and file size as the table grows.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import peewee
+
+import db_operations
+from autocorrect import name_index
+from models import KEY_GENERATORS, PROFILES, db, Product, Purchase, User
+from populate_db import ADJECTIVES, NOUNS, _insert_batches, _generate_products, _generate_users, \
+    generate_synthetic_dataset
+from query_stats import profile_queries
+
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+DEFAULT_SIZES = ['10k', '100k']
+DATA_DIR = 'benchmark-data'
+# Bumped whenever generate_synthetic_dataset changes what it makes, so
+# datasets cached by an older version aren't reused
+DATASET_VERSION = 2
+DEFAULT_ITERATIONS = 200
+DEFAULT_MAX_SECONDS = 5.0
+WARMUP_ITERATIONS = 3
+MEMORY_ITERATIONS = 3
+DEFAULT_THRESHOLD = 0.20
+COMPARED_METRICS = ('p50_ms', 'p95_ms')
+KEY_ROWS = 10_000_000
+KEY_COMMIT_ROWS = 1000
+KEY_SAMPLES = 10
+# Synthetic users all share this password (see populate_db).
+PASSWORD = 'password'
+
+
+def dataset_shape(rows):
+    return {
+        'users': max(rows // 20, 10),
+        'products': max(rows // 100, 10),
+        'tags': max(rows // 2000, 5),
+        'purchases': rows,
+    }
+
+
+def prepare_dataset(rows, seed=0, data_dir=DATA_DIR, workers=1):
+    """
+    Returns the path of the dataset for ``rows`` and ``seed``, generating it
+    first if it isn't in ``data_dir`` yet.
+    """
+    path = os.path.join(data_dir, f"dataset-v{DATASET_VERSION}-{rows}-seed{seed}.db")
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    # Generated under a temporary name so an interrupted run leaves nothing behind
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    db.init(partial)
+    try:
+        generate_synthetic_dataset(seed=seed, workers=workers, **dataset_shape(rows))
+        # Everything into the main file: a pooled close() keeps the connection
+        # and with it the WAL
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        db.close()
+    os.replace(partial, path)
+    return path
+
+
+class Fixture:
+    """
+    Ids and terms the cases draw their arguments from, picked with a seeded
+    random generator so that every run makes the same calls.
+    """
+    def __init__(self, seed):
+        self.rng = random.Random(f"{seed}:benchmark")
+        self.users = list(User.select(User.id, User.username).order_by(User.id).tuples())
+        self.product_ids = [product_id for (product_id,) in
+                            Product.select(Product.id).order_by(Product.id).tuples()]
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def product_id(self):
+        return self.rng.choice(self.product_ids)
+
+    def search_term(self):
+        return f"{self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)}"
+
+
+def _search(fixture):
+    return db_operations.search(fixture.search_term())
+
+
+def _search_typo(fixture):
+    # No match, so this includes the "did you mean" lookup
+    term = fixture.search_term()
+    return db_operations.search(term[:-1] + 'x' + term[-1])
+
+
+def _list_products(fixture):
+    return db_operations.list_products()
+
+
+def _list_orders(fixture):
+    return db_operations.list_orders(fixture.user()[0])
+
+
+def _get_user_purchases(fixture):
+    return db_operations.get_user_purchases(fixture.user()[0])
+
+
+def _list_product_tags(fixture):
+    return db_operations.list_product_tags(fixture.product_id())
+
+
+def _record_purchase(fixture):
+    return db_operations.record_purchase(fixture.user()[0], fixture.product_id(), 1)
+
+
+def _place_order(fixture):
+    return db_operations.place_order(fixture.user()[0], fixture.product_id(), 1)
+
+
+def _purchase_product(fixture):
+    return db_operations.purchase_product(fixture.user()[0], fixture.user()[0], fixture.product_id(), 1)
+
+
+def _checkout(fixture):
+    return db_operations.checkout(fixture.user()[0], [(fixture.product_id(), 1) for _ in range(3)])
+
+
+def _authenticate_user(fixture):
+    return db_operations.authenticate_user(fixture.user()[1], PASSWORD)
+
+
+CASES = {
+    'search': _search,
+    'search_typo': _search_typo,
+    'list_products': _list_products,
+    'list_orders': _list_orders,
+    'get_user_purchases': _get_user_purchases,
+    'list_product_tags': _list_product_tags,
+    'record_purchase': _record_purchase,
+    'place_order': _place_order,
+    'purchase_product': _purchase_product,
+    'checkout': _checkout,
+    'authenticate_user': _authenticate_user,
+}
+
+
+def percentile(ordered, fraction):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+def run_case(case, fixture, iterations=DEFAULT_ITERATIONS, max_seconds=DEFAULT_MAX_SECONDS):
+    """
+    Times ``case`` for ``iterations`` calls, or fewer if they take longer than
+    ``max_seconds`` in total. Peak memory and statement counts are measured
+    in separate calls, so their bookkeeping never adds to the latencies.
+    """
+    for _ in range(WARMUP_ITERATIONS):
+        case(fixture)
+
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    started = time.perf_counter()
+    while len(samples) < iterations:
+        start = time.perf_counter()
+        case(fixture)
+        samples.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    elapsed = time.perf_counter() - started
+
+    with profile_queries(repeat_threshold=sys.maxsize) as profile:
+        tracemalloc.start()
+        try:
+            peak = 0
+            for _ in range(MEMORY_ITERATIONS):
+                tracemalloc.reset_peak()
+                case(fixture)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+    samples.sort()
+    return {
+        'iterations': len(samples),
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'throughput_per_sec': len(samples) / elapsed,
+        'queries_per_call': profile.count() / MEMORY_ITERATIONS,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def run_benchmarks(rows, seed=0, data_dir=DATA_DIR, cases=None, iterations=DEFAULT_ITERATIONS,
+                   max_seconds=DEFAULT_MAX_SECONDS, workers=1, profile=None):
+    """
+    Runs the given cases (all of them by default) against a scratch copy of
+    the dataset for ``rows``, with the given database profile (default: the
+    current one). Returns {case: metrics}.
+    """
+    dataset = prepare_dataset(rows, seed, data_dir, workers)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        scratch = os.path.join(tmp, 'benchmark.db')
+        shutil.copyfile(dataset, scratch)
+        db.configure(scratch, profile)
+        name_index.reset()
+        try:
+            # The purchase paths measure successful purchases, not sold-out products
+            Product.update(quantity_in_stock=10 ** 9).execute()
+            fixture = Fixture(seed)
+            for name in cases or CASES:
+                results[name] = run_case(CASES[name], fixture, iterations, max_seconds)
+        finally:
+            db.close()
+            name_index.reset()
+    return results
+
+
+def _database_bytes(path):
+    return sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name))
+
+
+def run_key_benchmark(rows=KEY_ROWS, keys=None, profile=None, samples=KEY_SAMPLES):
+    """
+    Inserts ``rows`` purchases into an empty database with each primary key
+    generator (all of KEY_GENERATORS by default), KEY_COMMIT_ROWS per
+    transaction. Returns {key: metrics}, with throughput and file size
+    sampled ``samples`` times along the way and the final size of the
+    primary key index.
+    """
+    results = {}
+    for key in keys or KEY_GENERATORS:
+        generate = KEY_GENERATORS[key]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f'keys-{key}.db')
+            db.configure(path, profile)
+            try:
+                db_operations.create_database()
+                # A handful of buyers and products; the keys are what's measured
+                _generate_users(0, 100)
+                _generate_products(0, 100, 0, datetime.date.today())
+                user_ids = [user_id for (user_id,) in User.select(User.id).tuples()]
+                product_ids = [product_id for (product_id,) in Product.select(Product.id).tuples()]
+                fields = [Purchase.id, Purchase.user, Purchase.product, Purchase.quantity,
+                          Purchase.amount, Purchase.date]
+                today = datetime.date.today()
+                growth = []
+                inserted = 0
+                step = max(rows // samples, KEY_COMMIT_ROWS)
+                started = sample_started = time.perf_counter()
+                while inserted < rows:
+                    size = min(KEY_COMMIT_ROWS, rows - inserted)
+                    batch = [(generate(), user_ids[i % 100], product_ids[i % 97], 1, 10, today)
+                             for i in range(inserted, inserted + size)]
+                    with db.atomic():
+                        _insert_batches(Purchase, fields, batch)
+                    inserted += size
+                    if inserted % step == 0 or inserted == rows:
+                        now = time.perf_counter()
+                        rows_in_sample = inserted - (growth[-1]['rows'] if growth else 0)
+                        growth.append({'rows': inserted, 'file_bytes': _database_bytes(path),
+                                       'rows_per_sec': rows_in_sample / (now - sample_started)})
+                        sample_started = now
+                elapsed = time.perf_counter() - started
+                db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+                index_bytes = db.execute_sql(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name = 'sqlite_autoindex_purchase_1'").fetchone()[0]
+                results[key] = {
+                    'rows': rows,
+                    'rows_per_sec': rows / elapsed,
+                    'file_bytes': os.path.getsize(path),
+                    'primary_key_index_bytes': index_bytes,
+                    'growth': growth,
+                }
+            finally:
+                db.close()
+    return results
+
+
+def environment():
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'peewee': peewee.__version__,
+        'platform': platform.platform(),
+    }
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Lists the cases of ``current`` that got slower than in ``baseline`` (both
+    benchmark reports) by more than ``threshold``, as a fraction.
+    """
+    regressions = []
+    for size, cases in current['results'].items():
+        for name, metrics in cases.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            for metric in COMPARED_METRICS:
+                if previous[metric] > 0 and metrics[metric] > previous[metric] * (1 + threshold):
+                    regressions.append({
+                        'size': size,
+                        'case': name,
+                        'metric': metric,
+                        'baseline': previous[metric],
+                        'current': metrics[metric],
+                        'change': metrics[metric] / previous[metric] - 1,
+                    })
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the db_operations hot paths.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=DEFAULT_SIZES)
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), help="default: every case")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--max-seconds", type=float, default=DEFAULT_MAX_SECONDS,
+                        help="time budget per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DATA_DIR, help="where generated datasets are kept")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to generate datasets")
+    parser.add_argument("--profile", choices=list(PROFILES), help="database profile (default: BETSY_DB_PROFILE)")
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    parser.add_argument("--compare", help="baseline report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown before a case counts as a regression (0.20 = 20%%)")
+    parser.add_argument("--keys", action="store_true", help="compare the primary key generators instead")
+    parser.add_argument("--key-rows", type=int, default=KEY_ROWS, help="purchases inserted per key generator")
+    args = parser.parse_args()
+
+    report = {'environment': environment(), 'seed': args.seed, 'profile': args.profile or db.profile,
+              'results': {}}
+    if args.keys:
+        report['keys'] = run_key_benchmark(args.key_rows, profile=args.profile)
+        args.sizes = []
+    for size in args.sizes:
+        report['results'][size] = run_benchmarks(SIZES[size], args.seed, args.data_dir, args.cases,
+                                                 args.iterations, args.max_seconds, args.workers, args.profile)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            report['regressions'] = compare(report, json.load(baseline_file), args.threshold)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if report.get('regressions'):
+        for regression in report['regressions']:
+            print(f"Regression in {regression['case']} ({regression['size']}): {regression['metric']} "
+                  f"{regression['baseline']:.2f} -> {regression['current']:.2f} ms "
+                  f"(+{regression['change']:.0%})", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,212 @@
+"""
+Streaming bulk import of products from a CSV or JSONL supplier feed.
+
+Rows are read one at a time, checked with the same rules as
+db_operations.create_product and written in chunks, many chunks per
+transaction, with the search index filled once per transaction. Rows that
+fail validation are written to a rejects file (JSONL) instead of stopping
+the import. A product whose name
+already exists is either skipped or updated in place.
+
+    python bulk_import.py feed.csv --on-conflict update --rejects rejects.jsonl
+
+CSV feeds need a header row; both feed types use the columns name,
+description, price (or price_per_unit) and quantity (or quantity_in_stock).
+"""
+import argparse
+import csv
+import datetime
+import json
+import logging
+import time
+
+from peewee import EXCLUDED
+
+from models import db, Product
+from autocorrect import name_index, PRODUCT
+from db_operations import validate_product
+from product_cache import product_cache
+from search_index import bulk_insert_indexing
+
+
+logger = logging.getLogger(__name__)
+
+SKIP = 'skip'
+UPDATE = 'update'
+
+CHUNK_SIZE = 1000
+CHUNKS_PER_TRANSACTION = 20
+
+COLUMNS = [Product.id, Product.name, Product.description, Product.price_per_unit,
+           Product.quantity_in_stock, Product.created_at, Product.is_active]
+
+
+def read_rows(path):
+    """
+    Yields (line number, raw row) from a .csv or .jsonl/.ndjson file: a dict
+    for CSV, the undecoded line for JSONL (see decode_row).
+    """
+    with open(path, newline='', encoding='utf-8') as feed:
+        if path.endswith('.csv'):
+            # Line 1 is the header
+            yield from enumerate(csv.DictReader(feed), 2)
+            return
+        for line_number, line in enumerate(feed, 1):
+            if line.strip():
+                yield line_number, line.rstrip('\r\n')
+
+
+def decode_row(row):
+    """
+    The row as a dict: JSONL lines are decoded here, per row, so one broken
+    line is rejected like any invalid row. Raises ValueError.
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(row, dict):
+        raise ValueError("Row is not a JSON object.")
+    return row
+
+
+def parse_row(row):
+    """
+    Converts a raw feed row into a validated (name, description, price,
+    quantity) tuple. Raises ValueError for anything create_product would refuse.
+    """
+    name = row.get('name')
+    description = row.get('description')
+    try:
+        price = float(row.get('price', row.get('price_per_unit')))
+        quantity = row.get('quantity', row.get('quantity_in_stock'))
+        quantity = int(quantity) if isinstance(quantity, (int, str)) else quantity
+    except (TypeError, ValueError):
+        raise ValueError("Price and quantity must be numbers.")
+    validate_product(name, description, price, quantity)
+    return name, description, price, quantity
+
+
+def _chunks(rows, stats, rejects):
+    chunk = []
+    for line_number, row in rows:
+        stats['read'] += 1
+        try:
+            row = decode_row(row)
+            chunk.append(parse_row(row))
+        except (ValueError, AttributeError) as e:
+            stats['rejected'] += 1
+            if rejects is not None:
+                rejects.write(json.dumps({'line': line_number, 'error': str(e), 'row': row}, default=str) + "\n")
+            continue
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert_sql(on_conflict):
+    """
+    The single-row INSERT for ``on_conflict``, rendered once by peewee and
+    then run for a whole chunk with executemany: building an insert_many
+    query through peewee costs more than SQLite spends writing the rows.
+    """
+    query = Product.insert_many([[None] * len(COLUMNS)], fields=COLUMNS)
+    if on_conflict == UPDATE:
+        query = query.on_conflict(
+            conflict_target=[Product.name],
+            preserve=[Product.description, Product.price_per_unit, Product.quantity_in_stock],
+            update={Product.updated_at: EXCLUDED.created_at})
+    else:
+        query = query.on_conflict_ignore()
+    sql, _ = query.sql()
+    return sql
+
+
+def _existing_names(names):
+    # Rendered by peewee once per chunk size rather than once per chunk.
+    sql = _existing_sql.get(len(names))
+    if sql is None:
+        query = Product.select(Product.name).where(Product.name.in_([None] * len(names)))
+        sql = _existing_sql[len(names)] = query.sql()[0]
+    return {name for (name,) in db.execute_sql(sql, names)}
+
+
+_existing_sql = {}
+
+
+def _write_chunk(chunk, insert_sql, on_conflict, stats):
+    names = [row[0] for row in chunk]
+    existing = _existing_names(names)
+
+    if on_conflict == UPDATE:
+        stats['updated'] += sum(1 for name in names if name in existing)
+        rows = chunk
+    else:
+        new_rows = {}
+        for row in chunk:
+            if row[0] not in existing:
+                new_rows.setdefault(row[0], row)
+        stats['skipped'] += len(chunk) - len(new_rows)
+        rows = new_rows.values()
+    new_names = [name for name in dict.fromkeys(names) if name not in existing]
+
+    now = datetime.datetime.now()
+    params = [(Product.id.db_value(Product.id.default()), name, description,
+               Product.price_per_unit.db_value(price), quantity, now, True)
+              for name, description, price, quantity in rows]
+    db.cursor().executemany(insert_sql, params)
+
+    stats['imported'] += len(new_names)
+    for name in new_names:
+        name_index.add(PRODUCT, name)
+
+
+def import_products(path, on_conflict=SKIP, rejects_path=None):
+    """
+    Imports every product in the feed at ``path``. Returns counts of rows
+    read, imported, updated, skipped and rejected, plus the elapsed seconds.
+    """
+    if on_conflict not in (SKIP, UPDATE):
+        raise ValueError(f"on_conflict must be '{SKIP}' or '{UPDATE}'.")
+
+    stats = {'read': 0, 'imported': 0, 'updated': 0, 'skipped': 0, 'rejected': 0}
+    start = time.perf_counter()
+    insert_sql = _insert_sql(on_conflict)
+    rejects = open(rejects_path, 'w', encoding='utf-8') if rejects_path else None
+    try:
+        chunks = _chunks(read_rows(path), stats, rejects)
+        done = False
+        while not done:
+            with db.atomic(lock_type='IMMEDIATE'), bulk_insert_indexing():
+                for _ in range(CHUNKS_PER_TRANSACTION):
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        done = True
+                        break
+                    _write_chunk(chunk, insert_sql, on_conflict, stats)
+            if on_conflict == UPDATE and stats['updated']:
+                # Updated rows are known by name only, so the whole cache goes
+                product_cache.clear()
+            logger.info(f"Imported {stats['imported']} products from {stats['read']} rows...")
+    finally:
+        if rejects is not None:
+            rejects.close()
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import products from a CSV or JSONL feed.")
+    parser.add_argument("path", help="feed file (.csv, .jsonl or .ndjson)")
+    parser.add_argument("--on-conflict", choices=[SKIP, UPDATE], default=SKIP,
+                        help="what to do with products whose name already exists")
+    parser.add_argument("--rejects", help="write rows that fail validation to this JSONL file")
+    args = parser.parse_args()
+
+    result = import_products(args.path, args.on_conflict, args.rejects)
+    print(f"Read {result['read']} rows in {result['seconds']:.1f}s: {result['imported']} imported, "
+          f"{result['updated']} updated, {result['skipped']} skipped, {result['rejected']} rejected.")
@@ -1,25 +1,86 @@
+import contextlib
+import contextvars
 import logging
 
-import bcrypt
 from peewee import IntegrityError
 
+from models import DailySales
+from models import ProductSales
 from models import ProductTag
 from models import Purchase
+from models import Session
+from models import StockError
+from models import TagClosure
 from models import UserProduct
 from models import db
+from models import read_operation
+from models import reading
+from pagination import DEFAULT_PER_PAGE, Page, paginate
+from passwords import hash_password, needs_rehash, verify_password
+from product_cache import product_cache
+from autocorrect import name_index, suggest, PRODUCT, TAG
+from search_index import create_search_index, search_products
+from sessions import sessions
+from sales_rollup import create_sales_rollup
+from tag_tree import create_tag_closure
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# Set by deferred_rehashes(): where check_password leaves its rehashes
+_deferred_rehashes = contextvars.ContextVar('betsy_deferred_rehashes', default=None)
 
 
-def create_product(name, description, price, quantity):
+def check_password(user, password):
     """
-    Create a product with validations.
+    True if ``password`` is the user's. A stored password that wasn't hashed
+    with the configured bcrypt cost is re-hashed while we have the plaintext.
+    """
+    if not verify_password(password, user.password):
+        return False
+    if needs_rehash(user.password):
+        hashed = hash_password(password)
+        pending = _deferred_rehashes.get()
+        if pending is None:
+            store_rehashed_password(user, hashed)
+        else:
+            pending.append((user, hashed))
+    return True
+
+
+@contextlib.contextmanager
+def deferred_rehashes():
+    """
+    Inside the block, check_password only computes new hashes and appends
+    (user, hash) to the yielded list, for the caller to store with
+    store_rehashed_password where writes belong (see async_operations).
+    """
+    pending = []
+    token = _deferred_rehashes.set(pending)
+    try:
+        yield pending
+    finally:
+        _deferred_rehashes.reset(token)
+
+
+def store_rehashed_password(user, hashed):
+    from models import User
+
+    # The transaction sends the write to the writer connection even from a
+    # read operation; a password changed in the meantime is left alone.
+    with db.atomic():
+        (User
+         .update(password=hashed)
+         .where((User.id == user.id) & (User.password == user.password))
+         .execute())
+    user.password = hashed
+
+
+def validate_product(name, description, price, quantity):
+    """
+    Raises ValueError unless the product fields are acceptable for the catalog.
     """
     # Validate product name
     if not name or len(name.strip()) == 0 or len(name) > 255:
@@ -36,15 +97,24 @@ def create_product(name, description, price, quantity):
     # Validate product quantity
     if not isinstance(quantity, int) or quantity < 0:
         raise ValueError("Quantity must be a non-negative integer.")
-    
+
+
+def create_product(name, description, price, quantity):
+    """
+    Create a product with validations.
+    """
+    validate_product(name, description, price, quantity)
+
     # Create the product in the database
     try:
-        return Product.create(
+        product = Product.create(
             name=name,
             description=description,
             price_per_unit=price,
             quantity_in_stock=quantity,
         )
+        name_index.add(PRODUCT, name)
+        return product
     except Exception as e:
         logger.error(f"Error creating product: {e}")
         return None
@@ -52,7 +122,9 @@ def create_product(name, description, price, quantity):
 
 def create_tag(name):
     try:
-        return Tag.create(name=name)
+        tag = Tag.create(name=name)
+        name_index.add(TAG, name)
+        return tag
     except IntegrityError as e:
         logger.error(f"Error creating tag: {e}")
         return None
@@ -90,16 +162,29 @@ def create_bulk_user_products(users, product_name):
 
 def create_database():
     with db.atomic():
-        db.create_tables([User, Product, Tag, ProductTag, Purchase, UserProduct])
+        db.create_tables([User, Product, Tag, ProductTag, Purchase, UserProduct, Session])
+    create_search_index()
+    create_tag_closure()
+    create_sales_rollup()
+
 
+def _user_products_query():
+    # Users and products are joined in so that reading them costs no extra queries
+    return (UserProduct
+            .select(UserProduct, User, Product)
+            .join(User)
+            .switch(UserProduct)
+            .join(Product))
 
+@read_operation
 def list_user_products_by_user(user_id):
-    user_products = UserProduct.select().where(UserProduct.user == user_id)
+    user_products = _user_products_query().where(UserProduct.user == user_id)
     for user_product in user_products:
         print(user_product.user.username, user_product.product.name, user_product.quantity)
 
+@read_operation
 def list_user_products_by_product(product_id):
-    user_products = UserProduct.select().where(UserProduct.product == product_id)
+    user_products = _user_products_query().where(UserProduct.product == product_id)
     for user_product in user_products:
         print(user_product.user.username, user_product.product.name, user_product.quantity)
 
@@ -110,41 +195,6 @@ def add_product_to_catalog():
     else:
         print("Error creating product")
 
-def add_product_to_user(user_id, product_id, quantity):
-    """
-    Handle product purchase with validations.
-    """
-    # Validate user existence
-    user = User.get_or_none(User.id == user_id)
-    if not user:
-        raise ValueError("User not found.")
-    
-    # Validate product existence
-    product = Product.get_or_none(Product.id == product_id)
-    if not product:
-        raise ValueError("Product not found.")
-    
-    # Validate purchase quantity
-    if not isinstance(quantity, int) or quantity <= 0:
-        raise ValueError("Purchase quantity must be a positive integer.")
-    
-    # Check stock availability
-    if product.quantity < quantity:
-        raise ValueError("Requested quantity exceeds available stock.")
-    
-    # Create a new UserProduct entry
-    user_product = UserProduct.create(
-        user=user,
-        product=product,
-        quantity=quantity,
-    )
-    
-    # Update the product quantity in the database
-    product.quantity -= quantity
-    product.save()
-    
-    return f"Successfully created UserProduct with ID {user_product.id}."
-
 def create_product_tag(product_id, tag_id):
     # Importing necessary models and exceptions
     from models import Product, Tag, ProductTag
@@ -164,6 +214,7 @@ def create_product_tag(product_id, tag_id):
 
     # Creating a new ProductTag entry
     product_tag = ProductTag.create(product=product, tag=tag, name=f"{product.name}_{tag.name}")
+    product_cache.invalidate(product.id)
 
     return f"Successfully created ProductTag with ID {product_tag.id}."
 
@@ -182,7 +233,7 @@ def create_purchase(user_id, product_id, quantity):
     # Checking if the product exists and getting its price
     try:
         product = Product.get_by_id(product_id)
-        product_price = product.price  # Assuming Product model has a price attribute
+        product_price = product.price_per_unit
     except DoesNotExist:
         return f"Product with ID {product_id} does not exist."
 
@@ -194,6 +245,51 @@ def create_purchase(user_id, product_id, quantity):
 
     return f"Successfully created Purchase with ID {purchase_entry.id}."
 
+def reserve_stock(product_id, quantity):
+    """
+    Takes ``quantity`` units out of stock with a single conditional UPDATE, so
+    concurrent buyers can never oversell. Returns False when the product does
+    not exist or has fewer than ``quantity`` units left.
+    """
+    rows = (Product
+            .update(quantity_in_stock=Product.quantity_in_stock - quantity)
+            .where((Product.id == product_id) & (Product.quantity_in_stock >= quantity))
+            .execute())
+    if rows:
+        product_cache.invalidate(product_id)
+    return rows == 1
+
+
+def record_purchase(user_id, product_id, quantity, **details):
+    """
+    The purchase engine behind every purchase path: reserves the stock and
+    inserts the Purchase row in one transaction.
+
+    Raises ValueError for a bad quantity, StockError when the stock is short
+    and DoesNotExist when the user or product is missing; nothing is written
+    in any of those cases. Extra keyword arguments are stored on the Purchase.
+    """
+    if not isinstance(quantity, int) or quantity <= 0:
+        raise ValueError("Purchase quantity must be a positive integer.")
+
+    # IMMEDIATE takes the write lock up front, so concurrent buyers queue on
+    # the busy timeout instead of failing a lock upgrade half-way through.
+    with db.atomic(lock_type='IMMEDIATE'):
+        if not reserve_stock(product_id, quantity):
+            product = Product.get_by_id(product_id)
+            raise StockError(
+                f"Not enough stock for Product ID {product_id}. Available stock: {product.quantity_in_stock}")
+        product = Product.get_by_id(product_id)
+        user = User.get_by_id(user_id)
+        return Purchase.create(
+            user=user,
+            product=product,
+            quantity=quantity,
+            amount=product.price_per_unit * quantity,
+            **details,
+        )
+
+
 def purchase_product(buyer_id, seller_id, product_id, quantity):
     """
     Handle product purchase with validations.
@@ -213,30 +309,12 @@ def purchase_product(buyer_id, seller_id, product_id, quantity):
     if not product:
         raise ValueError("Product not found.")
     
-    # Validate purchase quantity
-    if not isinstance(quantity, int) or quantity <= 0:
-        raise ValueError("Purchase quantity must be a positive integer.")
-    
-    # Check stock availability
-    if product.quantity < quantity:
+    # Reserve the stock and record the purchase in one transaction
+    try:
+        purchase_entry = record_purchase(buyer.id, product.id, quantity)
+    except StockError:
         raise ValueError("Requested quantity exceeds available stock.")
     
-    # Calculate the total amount for the purchase
-    total_amount = product.price * quantity
-    
-    # Create a new Purchase entry
-    purchase_entry = Purchase.create(
-        buyer=buyer,
-        seller=seller,
-        product=product,
-        quantity=quantity,
-        amount=total_amount,
-    )
-    
-    # Update the product quantity in the database
-    product.quantity -= quantity
-    product.save()
-    
     return f"Successfully created Purchase with ID {purchase_entry.id}."
 
 
@@ -261,6 +339,7 @@ def remove_tag_from_product(product_id, tag_id):
     try:
         product_tag_association = ProductTag.get((ProductTag.product == product) & (ProductTag.tag == tag))
         product_tag_association.delete_instance()
+        product_cache.invalidate(product.id)
         return f"Successfully removed association between Product {product_id} and Tag {tag_id}."
     except DoesNotExist:
         return f"No association exists between Product {product_id} and Tag {tag_id}."
@@ -274,7 +353,9 @@ def remove_product(product_id):
     # Checking if the product exists
     try:
         product = Product.get_by_id(product_id)
-        product.delete_instance()
+        product.delete_instance(recursive=True)
+        product_cache.invalidate(product.id)
+        name_index.remove(PRODUCT, product.name)
         return f"Successfully removed Product with ID {product_id}."
     except DoesNotExist:
         return f"Product with ID {product_id} does not exist."
@@ -304,6 +385,7 @@ def add_tag_to_product(product_id, tag_id):
     except DoesNotExist:
         # Creating a new ProductTag entry
         product_tag = ProductTag.create(product=product, tag=tag, name=f"{product.name}_{tag.name}")
+        product_cache.invalidate(product.id)
         return f"Successfully added tag {tag_id} to Product {product_id}."
 
 
@@ -334,61 +416,35 @@ def delete_tag(tag_id):
     """
     try:
         tag = Tag.get_by_id(tag_id)
-        tag.delete_instance()
+        tag.delete_instance(recursive=True)
         return f"Successfully deleted Tag with ID {tag_id}."
     except DoesNotExist:
         return f"Tag with ID {tag_id} does not exist."
 
 
-def search(keyword):
-    # Importing necessary models
-    from models import Product
-
-    # Searching for products with names containing the keyword
-    matching_products = Product.select().where(Product.name.contains(keyword))
+@read_operation
+def search(keyword, page=1, per_page=20):
+    # Searching the full-text index, best matches first
+    matching_products = list(search_products(keyword, page, per_page))
 
     # Returning the list of matching products or a message if no matches are found
     if matching_products:
         return [product.name for product in matching_products]
-    else:
-        return f"No products found matching the keyword '{keyword}'."
-
-
-from models import Product
-
-
-def get_product_details(product_id):
-    """
-    Retrieves the details of a product with the given ID from the database.
-    """
-    try:
-        product = Product.get_by_id(product_id)
-        product_details = {
-            'id': product.id,
-            'name': product.name,
-            'description': product.description,
-            'price': product.price,
-            # Other fields can be added as needed
-        }
-        return product_details
-    except DoesNotExist:
-        return f"Product with ID {product_id} does not exist."
 
-    # Importing necessary models
-    from models import Product
+    # Nothing matched: offer the closest spelling from known product and tag names
+    suggestion = suggest(keyword)
+    if suggestion:
+        return f"No products found matching the keyword '{keyword}'. Did you mean '{suggestion}'?"
+    return f"No products found matching the keyword '{keyword}'."
 
-    # Querying the database to retrieve all products
-    products = Product.select()
-    
-    # Creating a list of product details
-    product_list = [{'id': product.id, 'name': product.name, 'price': product.price} for product in products]
 
-    return product_list if product_list else "No products found in the database."
+from models import Product
 
 
+@read_operation
 def get_user_purchases(user_id):
     # Importing necessary models and exceptions
-    from models import User, Purchase
+    from models import User, Product, Purchase
     from peewee import DoesNotExist
 
     # Checking if the user exists
@@ -397,8 +453,11 @@ def get_user_purchases(user_id):
     except DoesNotExist:
         return f"User with ID {user_id} does not exist."
 
-    # Querying the database to retrieve all purchases made by this user
-    user_purchases = Purchase.select().where(Purchase.user == user)
+    # Querying the database to retrieve all purchases made by this user, with their products
+    user_purchases = (Purchase
+                      .select(Purchase, Product)
+                      .join(Product)
+                      .where(Purchase.user == user))
     
     # Creating a list of purchase details
     purchase_list = [
@@ -415,14 +474,15 @@ def get_user_purchases(user_id):
     return purchase_list if purchase_list else f"No purchases found for user with ID {user_id}."
 
 
+@read_operation
 def get_purchase_details(purchase_id):
     # Importing necessary models and exceptions
-    from models import Purchase
+    from models import User, Product, Purchase
     from peewee import DoesNotExist
 
     # Checking if the purchase exists and retrieving its details
     try:
-        purchase = Purchase.get_by_id(purchase_id)
+        purchase = _orders_query().where(Purchase.id == purchase_id).get()
         purchase_details = {
             'id': purchase.id,
             'user_id': purchase.user.id,
@@ -438,6 +498,7 @@ def get_purchase_details(purchase_id):
         return f"Purchase with ID {purchase_id} does not exist."
 
 
+@read_operation
 def get_tag_details(tag_id):
     # Importing necessary models and exceptions
     from models import Tag
@@ -494,7 +555,9 @@ def delete_user(user_id):
     # Checking if the user exists
     try:
         user = User.get_by_id(user_id)
-        user.delete_instance()
+        with db.atomic():
+            user.delete_instance(recursive=True)
+            sessions.revoke_user(user_id)
         return f"Successfully deleted User with ID {user_id}."
     except DoesNotExist:
         return f"User with ID {user_id} does not exist."
@@ -539,9 +602,11 @@ def add_product_to_user(user_id, product_id, quantity):
     # Check if the user already has the product in their inventory
     user_product = UserProduct.get_or_none(UserProduct.user == user, UserProduct.product == product)
     if user_product:
-        # If the user already has the product, update the quantity
-        user_product.quantity += quantity
-        user_product.save()
+        # If the user already has the product, add to the quantity in place
+        (UserProduct
+         .update(quantity=UserProduct.quantity + quantity)
+         .where(UserProduct.id == user_product.id)
+         .execute())
         return f"Successfully updated UserProduct with ID {user_product.id}."
     else:
         # If the user does not have the product, create a new UserProduct entry
@@ -557,7 +622,9 @@ def delete_product(product_id):
     # Checking if the product exists and deleting it
     try:
         product = Product.get_by_id(product_id)
-        product.delete_instance()
+        product.delete_instance(recursive=True)
+        product_cache.invalidate(product.id)
+        name_index.remove(PRODUCT, product.name)
         return f"Successfully deleted Product with ID {product_id}."
     except DoesNotExist:
         return f"Product with ID {product_id} does not exist."
@@ -571,9 +638,12 @@ def update_product(product_id, **kwargs):
     # Checking if the product exists and updating its details
     try:
         product = Product.get_by_id(product_id)
+        old_name = product.name
         for key, value in kwargs.items():
             setattr(product, key, value)
         product.save()
+        product_cache.invalidate(product.id)
+        name_index.rename(PRODUCT, old_name, product.name)
         return f"Successfully updated Product with ID {product_id}."
     except DoesNotExist:
         return f"Product with ID {product_id} does not exist."
@@ -607,11 +677,17 @@ def add_tag(name, description):
     # Adding the new tag to the database
     try:
         new_tag = Tag.create(name=name, description=description)
+        name_index.add(TAG, name)
         return f"Successfully added new tag with ID {new_tag.id}."
     except Exception as e:
         return f"Error adding tag: {str(e)}."
 
 
+def _tagged_product_ids(tag_id):
+    return [product_id for (product_id,) in
+            ProductTag.select(ProductTag.product).where(ProductTag.tag == tag_id).tuples()]
+
+
 def delete_tag(tag_id):
     # Importing necessary models and exceptions
     from models import Tag
@@ -620,7 +696,10 @@ def delete_tag(tag_id):
     # Checking if the tag exists and deleting it
     try:
         tag = Tag.get_by_id(tag_id)
-        tag.delete_instance()
+        tagged = _tagged_product_ids(tag.id)
+        tag.delete_instance(recursive=True)
+        product_cache.invalidate(*tagged)
+        name_index.remove(TAG, tag.name)
         return f"Successfully deleted Tag with ID {tag_id}."
     except DoesNotExist:
         return f"Tag with ID {tag_id} does not exist."
@@ -634,27 +713,40 @@ def update_tag(tag_id, **kwargs):
     # Checking if the tag exists and updating its details
     try:
         tag = Tag.get_by_id(tag_id)
+        old_name = tag.name
         for key, value in kwargs.items():
             setattr(tag, key, value)
         tag.save()
+        if tag.name != old_name:
+            # Product details list their tags by name
+            product_cache.invalidate(*_tagged_product_ids(tag.id))
+        name_index.rename(TAG, old_name, tag.name)
         return f"Successfully updated Tag with ID {tag_id}."
     except DoesNotExist:
         return f"Tag with ID {tag_id} does not exist."
     except AttributeError:
         return f"Invalid field provided for update."
+    except IntegrityError as e:
+        # Duplicate name, or a parent below the tag itself
+        return f"Error updating tag: {e}"
 
 
-def list_tags():
+@read_operation
+def list_tags(cursor=None, per_page=DEFAULT_PER_PAGE):
     # Importing necessary models
     from models import Tag
 
-    # Querying the database to retrieve all tags
-    tags = Tag.select()
+    # Querying one page of tags, by name
+    try:
+        tags, next_cursor = paginate(Tag.select(), Tag.name, 'tags', cursor, per_page)
+    except ValueError as e:
+        return str(e)
     
     # Creating a list of tag details
-    tag_list = [{'id': tag.id, 'name': tag.name, 'description': tag.description} for tag in tags]
+    tag_list = Page([{'id': tag.id, 'name': tag.name, 'description': tag.description} for tag in tags],
+                    next_cursor)
 
-    return tag_list if tag_list else "No tags found in the database."
+    return tag_list if tag_list or cursor else "No tags found in the database."
 
 
 def add_product_tag(product_id, tag_id):
@@ -670,6 +762,7 @@ def add_product_tag(product_id, tag_id):
         
         # Creating the association in the ProductTag table
         product_tag_association = ProductTag.create(product=product, tag=tag)
+        product_cache.invalidate(product.id)
         
         return f"Successfully associated Product ID {product_id} with Tag ID {tag_id}."
     except DoesNotExist:
@@ -692,6 +785,7 @@ def delete_product_tag(product_id, tag_id):
         # Finding and deleting the association in the ProductTag table
         product_tag_association = ProductTag.get((ProductTag.product == product) & (ProductTag.tag == tag))
         product_tag_association.delete_instance()
+        product_cache.invalidate(product.id)
         
         return f"Successfully removed association of Product ID {product_id} with Tag ID {tag_id}."
     except DoesNotExist:
@@ -700,6 +794,7 @@ def delete_product_tag(product_id, tag_id):
         return f"Error removing association between product and tag: {str(e)}."
 
 
+@read_operation
 def list_product_tags(product_id):
     # Importing necessary models and exceptions
     from models import Product, ProductTag, Tag
@@ -723,6 +818,7 @@ def list_product_tags(product_id):
         return f"Product ID {product_id} does not exist."
 
 
+@read_operation
 def login(username, password):
     # Importing necessary models and exceptions
     from models import User
@@ -731,7 +827,7 @@ def login(username, password):
     # Attempting to authenticate the user
     try:
         user = User.get(User.username == username)
-        if user.password == password:  # Note: This is insecure and just for demonstration.
+        if check_password(user, password):
             return f"Login successful for user: {username}."
         else:
             return f"Incorrect password for user: {username}."
@@ -746,20 +842,51 @@ def register(username, password, email):
 
     # Attempting to register the user
     try:
-        new_user = User.create(username=username, password=password, email=email)  # Insecure password storage
+        new_user = User.create(username=username, password=hash_password(password), email=email)
         return f"User {username} successfully registered."
     except IntegrityError:
         return f"User with username {username} or email {email} already exists."
 
 
-def logout():
-    # In this basic implementation, we'll assume there's an in-memory variable or cache that tracks the logged-in user.
-    # This variable will be reset/cleared during logout.
-    
-    logged_in_user = None  # This is a placeholder. In a real-world application, this might be a global or context variable.
-    
-    if logged_in_user:
-        logged_in_user = None
+def create_session(username, password, ttl=None):
+    """
+    Checks the password once and starts a session: returns {'token',
+    'user_id', 'username'}, where later requests pass the token to
+    sessions.validate instead of the password. An error message otherwise.
+    """
+    user = check_login(username, password)
+    if isinstance(user, str):
+        return user
+    return start_session(user, ttl)
+
+
+@read_operation
+def check_login(username, password):
+    """
+    The user if ``password`` is theirs, an error message otherwise.
+    """
+    from models import User
+    from peewee import DoesNotExist
+
+    try:
+        user = User.get(User.username == username)
+    except DoesNotExist:
+        return f"User with username {username} does not exist."
+    if not check_password(user, password):
+        return f"Incorrect password for user: {username}."
+    return user
+
+
+def start_session(user, ttl=None):
+    token = sessions.issue(user.id, ttl)
+    return {'token': token, 'user_id': user.id, 'username': user.username}
+
+
+def logout(token=None):
+    """
+    Ends the session of ``token``.
+    """
+    if token and sessions.revoke(token):
         return f"Successfully logged out."
     else:
         return f"No user is currently logged in."
@@ -770,30 +897,91 @@ def place_order(user_id, product_id, quantity):
     from models import User, Product, Purchase
     from peewee import DoesNotExist, IntegrityError
 
-    # Attempting to place the order
+    # Attempting to place the order: the stock is deducted and the order
+    # recorded (using the Purchase model in this case) in one transaction
     try:
-        user = User.get_by_id(user_id)
-        product = Product.get_by_id(product_id)
-        
-        # Check if enough stock is available
-        if product.stock < quantity:
-            return f"Not enough stock for Product ID {product_id}. Available stock: {product.stock}"
-        
-        # Create the order record (using the Purchase model in this case)
-        purchase = Purchase.create(user=user, product=product, quantity=quantity)
-        
-        # Deduct the stock of the product
-        product.stock -= quantity
-        product.save()
-        
+        record_purchase(user_id, product_id, quantity)
         return f"Order successfully placed for Product ID {product_id}. Quantity: {quantity}"
+    except StockError as e:
+        return str(e)
     except DoesNotExist:
         return f"Either User ID {user_id} or Product ID {product_id} does not exist."
-    except IntegrityError as e:
+    except (IntegrityError, ValueError) as e:
         return f"Error placing order: {str(e)}."
 
 
-def list_orders(user_id=None):
+def checkout(user_id, items):
+    """
+    Buys a whole cart of (product_id, quantity) lines in one transaction: the
+    stock of every product is checked with one query, taken with one
+    set-based UPDATE and the purchases are written with one INSERT. Either
+    every line is bought or none is.
+
+    Raises ValueError for an empty cart or a bad quantity, StockError naming
+    the products that are short and DoesNotExist when the user or a product
+    is missing. Returns the ids of the new Purchase rows, in cart order.
+    """
+    import uuid
+    from peewee import Case
+
+    # Lines for the same product are merged
+    quantities = {}
+    for product_id, quantity in items:
+        if not isinstance(quantity, int) or quantity <= 0:
+            raise ValueError("Purchase quantity must be a positive integer.")
+        product_id = uuid.UUID(str(product_id))
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    if not quantities:
+        raise ValueError("Cannot check out an empty cart.")
+
+    with db.atomic(lock_type='IMMEDIATE'):
+        user = User.get_by_id(user_id)
+        products = {product.id: product
+                    for product in Product.select().where(Product.id.in_(list(quantities)))}
+
+        missing = [str(product_id) for product_id in quantities if product_id not in products]
+        if missing:
+            raise Product.DoesNotExist(f"Products do not exist: {', '.join(missing)}")
+        short = [str(product_id) for product_id, quantity in quantities.items()
+                 if products[product_id].quantity_in_stock < quantity]
+        if short:
+            raise StockError(f"Not enough stock for Product IDs: {', '.join(short)}")
+
+        # Every line's quantity in one CASE, guarded so no row can go negative
+        ordered = Case(Product.id, [(Product.id.db_value(product_id), quantity)
+                                    for product_id, quantity in quantities.items()])
+        reserved = (Product
+                    .update(quantity_in_stock=Product.quantity_in_stock - ordered)
+                    .where(Product.id.in_(list(quantities))
+                           & (Product.quantity_in_stock >= ordered))
+                    .execute())
+        if reserved != len(quantities):
+            raise StockError("Not enough stock to complete the checkout.")
+        product_cache.invalidate(*quantities)
+
+        rows = [{
+            'id': Purchase.id.default(),
+            'user': user,
+            'product': product_id,
+            'quantity': quantity,
+            'amount': products[product_id].price_per_unit * quantity,
+        } for product_id, quantity in quantities.items()]
+        Purchase.insert_many(rows).execute()
+
+    return [row['id'] for row in rows]
+
+
+def _orders_query():
+    # Buyers and products are joined in so that reading them costs no extra queries
+    return (Purchase
+            .select(Purchase, User, Product)
+            .join(User)
+            .switch(Purchase)
+            .join(Product))
+
+
+@read_operation
+def list_orders(user_id=None, cursor=None, per_page=DEFAULT_PER_PAGE):
     # Importing necessary models and exceptions
     from models import User, Purchase
     from peewee import DoesNotExist
@@ -801,16 +989,17 @@ def list_orders(user_id=None):
     # Attempting to list the orders
     try:
         # Base query for all orders
-        orders_query = Purchase.select()
+        orders_query = _orders_query()
         
         # If a user_id is provided, filter orders for that user
         if user_id:
             user = User.get_by_id(user_id)
             orders_query = orders_query.where(Purchase.user == user)
         
-        # Fetching the orders and associated details
-        orders_list = []
-        for order in orders_query:
+        # Fetching one page of orders in id order (new ids are time-ordered; migrated ones aren't)
+        orders, next_cursor = paginate(orders_query, Purchase.id, 'orders', cursor, per_page)
+        orders_list = Page(next_cursor=next_cursor)
+        for order in orders:
             order_details = {
                 'order_id': order.id,
                 'user': order.user.username,
@@ -819,13 +1008,18 @@ def list_orders(user_id=None):
             }
             orders_list.append(order_details)
         
-        return orders_list if orders_list else f"No orders found for User ID {user_id}." if user_id else "No orders found."
+        if orders_list or cursor:
+            return orders_list
+        return f"No orders found for User ID {user_id}." if user_id else "No orders found."
     except DoesNotExist:
         return f"User ID {user_id} does not exist."
+    except ValueError as e:
+        return str(e)
     except Exception as e:
         return f"Error listing orders: {str(e)}."
 
 
+@read_operation
 def get_order_details(order_id):
     # Importing necessary models and exceptions
     from models import Purchase
@@ -833,7 +1027,7 @@ def get_order_details(order_id):
 
     # Attempting to fetch the order details
     try:
-        order = Purchase.get_by_id(order_id)
+        order = _orders_query().where(Purchase.id == order_id).get()
         order_details = {
             'order_id': order.id,
             'user': order.user.username,
@@ -853,13 +1047,20 @@ def add_stock(product_id, quantity):
     from models import Product
     from peewee import DoesNotExist
 
-    # Attempting to add stock to the specified product
+    # Attempting to add stock to the specified product, in one UPDATE so
+    # concurrent changes to the stock are never lost
     try:
-        product = Product.get_by_id(product_id)
-        product.stock += quantity
-        product.save()
-        
-        return f"Stock successfully updated for Product ID {product_id}. New stock: {product.stock}."
+        with db.atomic():
+            updated = (Product
+                       .update(quantity_in_stock=Product.quantity_in_stock + quantity)
+                       .where(Product.id == product_id)
+                       .execute())
+            if not updated:
+                raise DoesNotExist
+            product_cache.invalidate(product_id)
+            product = Product.get_by_id(product_id)
+
+        return f"Stock successfully updated for Product ID {product_id}. New stock: {product.quantity_in_stock}."
     except DoesNotExist:
         return f"Product ID {product_id} does not exist."
     except Exception as e:
@@ -873,46 +1074,47 @@ def reduce_stock(product_id, quantity):
 
     # Attempting to reduce stock of the specified product
     try:
+        # Only succeeds if enough stock is available to reduce
+        reduced = reserve_stock(product_id, quantity)
         product = Product.get_by_id(product_id)
+        if not reduced:
+            return f"Not enough stock for Product ID {product_id}. Available stock: {product.quantity_in_stock}"
         
-        # Check if enough stock is available to reduce
-        if product.stock < quantity:
-            return f"Not enough stock for Product ID {product_id}. Available stock: {product.stock}"
-        
-        product.stock -= quantity
-        product.save()
-        
-        return f"Stock successfully reduced for Product ID {product_id}. New stock: {product.stock}."
+        return f"Stock successfully reduced for Product ID {product_id}. New stock: {product.quantity_in_stock}."
     except DoesNotExist:
         return f"Product ID {product_id} does not exist."
     except Exception as e:
         return f"Error reducing stock: {str(e)}."
     
 
-def list_products():
+@read_operation
+def list_products(cursor=None, per_page=DEFAULT_PER_PAGE):
     # Importing necessary models and exceptions
     from models import Product
 
-    # Fetching the list of products
-    products_query = Product.select()
+    # Fetching one page of products, by name
+    try:
+        products, next_cursor = paginate(Product.select(), Product.name, 'products', cursor, per_page)
+    except ValueError as e:
+        return str(e)
     
     # Fetching the products and associated details
-    products_list = []
-    for product in products_query:
+    products_list = Page(next_cursor=next_cursor)
+    for product in products:
         product_details = {
             'product_id': product.id,
             'name': product.name,
             'description': product.description,
-            'price': product.price,
-            'stock': product.stock
+            'price': product.price_per_unit,
+            'stock': product.quantity_in_stock
         }
         products_list.append(product_details)
     
-    return products_list if products_list else "No products available."
+    return products_list if products_list or cursor else "No products available."
 
-def get_product_details(product_id):
+def _load_product_details(product_id):
     # Importing necessary models and exceptions
-    from models import Product
+    from models import Product, ProductTag, Tag
     from peewee import DoesNotExist
 
     # Attempting to fetch the product details
@@ -922,8 +1124,10 @@ def get_product_details(product_id):
             'product_id': product.id,
             'name': product.name,
             'description': product.description,
-            'price': product.price,
-            'stock': product.stock
+            'price': product.price_per_unit,
+            'stock': product.quantity_in_stock,
+            'tags': sorted(tag.name for tag in Tag.select(Tag.name).join(ProductTag)
+                           .where(ProductTag.product == product.id)),
         }
         
         return product_details
@@ -932,6 +1136,13 @@ def get_product_details(product_id):
     except Exception as e:
         return f"Error fetching product details: {str(e)}."
 
+
+@read_operation
+def get_product_details(product_id):
+    # Served from the product cache; see product_cache.py
+    return product_cache.get(product_id, _load_product_details)
+
+@read_operation
 def get_user_details(user_id):
     # Importing necessary models and exceptions
     from models import User
@@ -954,26 +1165,30 @@ def get_user_details(user_id):
     except Exception as e:
         return f"Error fetching user details: {str(e)}."
 
-def list_users():
+@read_operation
+def list_users(cursor=None, per_page=DEFAULT_PER_PAGE):
     # Importing necessary models
     from models import User
 
-    # Fetching the list of users
-    users_query = User.select()
+    # Fetching one page of users, by username
+    try:
+        users, next_cursor = paginate(User.select(), User.username, 'users', cursor, per_page)
+    except ValueError as e:
+        return str(e)
     
     # Fetching the users and associated details
-    users_list = []
-    for user in users_query:
+    users_list = Page(next_cursor=next_cursor)
+    for user in users:
         user_details = {
             'user_id': user.id,
             'username': user.username,
-            'email': user.email,
-            'admin': user.admin
+            'email': user.email
         }
         users_list.append(user_details)
     
-    return users_list if users_list else "No users available."
+    return users_list if users_list or cursor else "No users available."
 
+@read_operation
 def authenticate_user(username, password):
     # Importing necessary models and exceptions
     from models import User
@@ -983,8 +1198,8 @@ def authenticate_user(username, password):
     try:
         user = User.get(User.username == username)
         
-        # Comparing the provided password with the stored one
-        if user.password == password:
+        # Comparing the provided password with the stored hash
+        if check_password(user, password):
             return f"User {username} authenticated successfully."
         else:
             return f"Incorrect password for user {username}."
@@ -1002,7 +1217,7 @@ def create_user(username, name, email, password, address, zipcode, city, state,
         username=username,
         name=name,
         email=email,
-        password=hashed_password.decode('utf-8'),
+        password=hashed_password,
         address=address,
         zipcode=zipcode,
         city=city,
@@ -1038,14 +1253,14 @@ def create_user(username, email, password, admin=False):
         existing_user = User.get((User.username == username) | (User.email == email))
         return "A user with the same username or email already exists."
     except DoesNotExist:
-        # Hashing the password using bcrypt
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        # Hashing the password using bcrypt, in the password pool
+        hashed_password = hash_password(password)
         
         # Creating a new user entry in the database
         new_user = User.create(
             username=username,
             email=email,
-            password=hashed_password.decode('utf-8'),
+            password=hashed_password,
             admin=admin
         )
         return f"User {username} created successfully with ID {new_user.id}."
@@ -1058,18 +1273,20 @@ def update_user_password(user_id, new_password):
     # Importing necessary models and exceptions
     from models import User
     from peewee import DoesNotExist
-    import bcrypt
 
     try:
         # Querying the database to find the specified user
         user = User.get_by_id(user_id)
         
-        # Hashing the new password using bcrypt
-        hashed_new_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        # Hashing the new password using bcrypt, in the password pool
+        hashed_new_password = hash_password(new_password)
         
-        # Updating the user's password in the database
-        user.password = hashed_new_password.decode('utf-8')
-        user.save()
+        # Updating the user's password in the database, which signs the
+        # user out everywhere
+        with db.atomic():
+            user.password = hashed_new_password
+            user.save()
+            sessions.revoke_user(user.id)
         
         return f"Password updated successfully for User ID {user_id}."
     except DoesNotExist:
@@ -1079,7 +1296,6 @@ def update_user_password(user_id, new_password):
 
 db_operations_updated_content_list = [ "\n\n", inspect.getsource(create_user) ] 
 db_operations_updated_content = "".join(db_operations_updated_content_list)
-print(inspect.getsource(create_user))
 
 # Displaying the implemented function for review
 inspect.getsource(update_user_password)
@@ -1088,18 +1304,20 @@ def update_user_password(user_id, new_password):
     # Importing necessary models and exceptions
     from models import User
     from peewee import DoesNotExist
-    import bcrypt
 
     try:
         # Querying the database to find the specified user
         user = User.get_by_id(user_id)
         
-        # Hashing the new password using bcrypt
-        hashed_new_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        # Hashing the new password using bcrypt, in the password pool
+        hashed_new_password = hash_password(new_password)
         
-        # Updating the user's password in the database
-        user.password = hashed_new_password.decode('utf-8')
-        user.save()
+        # Updating the user's password in the database, which signs the
+        # user out everywhere
+        with db.atomic():
+            user.password = hashed_new_password
+            user.save()
+            sessions.revoke_user(user.id)
         
         return f"Password updated successfully for User ID {user_id}."
     except DoesNotExist:
@@ -1163,8 +1381,10 @@ def delete_user(user_id):
         # Querying the database to find the specified user
         user = User.get_by_id(user_id)
         
-        # Deleting the user's entry from the database
-        user.delete_instance()
+        # Deleting the user's entry from the database, with its sessions
+        with db.atomic():
+            user.delete_instance(recursive=True)
+            sessions.revoke_user(user_id)
         
         return f"User ID {user_id} deleted successfully."
     except DoesNotExist:
@@ -1173,15 +1393,19 @@ def delete_user(user_id):
         return f"Error deleting user: {str(e)}."
     
 
+# Every table create_database() makes; a database missing one needs it run
+REQUIRED_TABLES = [User, Product, Tag, ProductTag, Purchase, UserProduct, TagClosure, DailySales, ProductSales,
+                   Session]
+
+
 def initialize_database():
-    db.connect()  # Connect to the database
-    # Create tables if they don't exist with safe=True
-    db.create_tables([User, Product, Tag, ProductTag, Purchase, UserProduct], safe=True)
-    db.close()  # Close the connection
+    # Connected for the duration only (with a pool, the connection goes back to it)
+    with db.connection_context():
+        # Creates whatever is missing, so one path sets up every table and trigger
+        create_database()
 
 def are_tables_initialized():
-    required_tables = [User, Product, Tag, ProductTag, Purchase, UserProduct]
-    for table in required_tables:
+    for table in REQUIRED_TABLES:
         if not table.table_exists():
             return False
     return True
@@ -1195,5 +1419,9 @@ def get_user_by_id(buyer_id):
     return None
 
 
-def get_user_by_username(param):
-    return None
\ No newline at end of file
+@read_operation
+def get_user_by_username(username):
+    """
+    The user with ``username``, or None if there is none.
+    """
+    return User.get_or_none(User.username == username)
@@ -0,0 +1,211 @@
+"""
+Streams purchases, joined with their buyer and product, to a file for
+analytics:
+
+    python export_purchases.py purchases.parquet --since 2024-01-01 --until 2025-01-01
+    python export_purchases.py purchases.csv --user 5f0c... --resume <cursor>
+
+Rows are read in chunks of ``--chunk-size`` in the order they were
+inserted (by SQLite rowid), each chunk starting after the last rowid of the
+previous one (keyset cursors, like the db_operations listings), so memory
+stays flat however long the purchase history is. Parquet and Arrow IPC
+output need pyarrow; CSV works without it.
+
+The cursor of the last exported row is logged after every chunk and
+returned at the end. Passing it to ``--resume`` continues an interrupted
+export into a new file, or picks up only the purchases inserted since the
+last export. The order isn't the id order: ids made before the switch to
+time-ordered UUIDs are random, so a new purchase can sort below the last
+exported id. A VACUUM (``migrate_uuid_offline.py --vacuum``) may renumber
+rowids, so don't resume across one; start a full export instead.
+"""
+import argparse
+import csv
+import datetime
+import logging
+import os
+import time
+
+from peewee import Column
+
+from models import db, reading, Product, Purchase, User
+from pagination import decode_cursor, encode_cursor
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50000
+# Cursors hold a rowid; older ones held a purchase id and are rejected
+CURSOR_LISTING = 'purchase-export-rowid'
+COLUMNS = ('purchase_id', 'date', 'user_id', 'username', 'product_id', 'product_name', 'quantity', 'amount')
+FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.csv': 'csv'}
+
+
+def arrow_schema():
+    return pyarrow.schema([
+        ('purchase_id', pyarrow.string()),
+        ('date', pyarrow.date32()),
+        ('user_id', pyarrow.string()),
+        ('username', pyarrow.string()),
+        ('product_id', pyarrow.string()),
+        ('product_name', pyarrow.string()),
+        ('quantity', pyarrow.int64()),
+        ('amount', pyarrow.decimal128(10, 2)),
+    ])
+
+
+def purchases_query(user_id=None, since=None, until=None):
+    """
+    Purchases with their buyer and product as tuples in COLUMNS order, from
+    ``since`` up to but not including ``until`` (dates).
+    """
+    query = (Purchase
+             .select(Purchase.id, Purchase.date, User.id, User.username, Product.id, Product.name,
+                     Purchase.quantity, Purchase.amount)
+             .join(User)
+             .switch(Purchase)
+             .join(Product))
+    if user_id is not None:
+        query = query.where(Purchase.user == user_id)
+    if since is not None:
+        query = query.where(Purchase.date >= since)
+    if until is not None:
+        query = query.where(Purchase.date < until)
+    return query.tuples()
+
+
+def chunks(query, last_rowid=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields (rows, cursor) for consecutive chunks of ``query`` in insertion
+    (rowid) order, starting after ``last_rowid``.
+    """
+    rowid = Column(Purchase, 'rowid')
+    query = query.select_extend(rowid)
+    while True:
+        chunk = query if last_rowid is None else query.where(rowid > last_rowid)
+        with reading():
+            rows = list(chunk.order_by(rowid).limit(chunk_size))
+        if not rows:
+            return
+        last_rowid = rows[-1][-1]
+        yield [row[:-1] for row in rows], encode_cursor(CURSOR_LISTING, str(last_rowid))
+        if len(rows) < chunk_size:
+            return
+
+
+def _export_row(row):
+    purchase_id, date, user_id, username, product_id, product_name, quantity, amount = row
+    return (str(purchase_id), date, str(user_id), username, str(product_id), product_name, quantity, amount)
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _ArrowWriter:
+    def __init__(self, path, fmt):
+        self.schema = arrow_schema()
+        if fmt == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def output_format(path, fmt=None):
+    fmt = fmt or FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS.values():
+        raise ValueError(f"Unknown export format for '{path}'. Choose parquet, arrow or csv.")
+    if fmt != 'csv' and pyarrow is None:
+        raise ValueError(f"{fmt} output needs pyarrow (pip install pyarrow); use a .csv file instead.")
+    return fmt
+
+
+def export_purchases(path, fmt=None, user_id=None, since=None, until=None, cursor=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the selected purchases to ``path`` and returns
+    {'rows': count, 'cursor': cursor of the last row exported}. The format
+    is taken from the file extension unless ``fmt`` is given.
+    """
+    fmt = output_format(path, fmt)
+    last_rowid = _rowid(decode_cursor(CURSOR_LISTING, cursor)) if cursor else None
+    query = purchases_query(user_id, since, until)
+    writer = _CsvWriter(path) if fmt == 'csv' else _ArrowWriter(path, fmt)
+    start = time.perf_counter()
+    count = 0
+    try:
+        for rows, cursor in chunks(query, last_rowid, chunk_size):
+            writer.write([_export_row(row) for row in rows])
+            count += len(rows)
+            elapsed = time.perf_counter() - start
+            logger.info(f"{count} purchases exported ({count / elapsed:.0f} rows/s), cursor {cursor}")
+    finally:
+        writer.close()
+    return {'rows': count, 'cursor': cursor}
+
+
+def _rowid(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Invalid page cursor.")
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a date (YYYY-MM-DD).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export purchases for analytics.")
+    parser.add_argument("path", help="output file: .parquet, .arrow/.feather or .csv")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())), help="override the file extension")
+    parser.add_argument("--user", help="only this user's purchases (user id)")
+    parser.add_argument("--since", type=_date, help="first purchase date to include (YYYY-MM-DD)")
+    parser.add_argument("--until", type=_date, help="purchase date to stop before (YYYY-MM-DD)")
+    parser.add_argument("--resume", metavar="CURSOR", help="start after the row of a previous export")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per chunk")
+    parser.add_argument("--db", help="database file (default: BETSY_DB_PATH)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.db:
+        db.configure(args.db)
+    try:
+        result = export_purchases(args.path, args.format, args.user, args.since, args.until,
+                                  args.resume, args.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        db.close()
+    print(f"{result['rows']} purchases exported to {args.path}.")
+    if result['cursor']:
+        print(f"Continue from here with --resume {result['cursor']}")
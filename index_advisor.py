@@ -0,0 +1,274 @@
+"""
+Index advisor: replays the db_operations queries through EXPLAIN QUERY PLAN
+and flags the plans that won't scale.
+
+    python index_advisor.py --db copy-of-production.db
+
+Every read and write path in WORKLOAD (the db_operations functions, session
+validation and a user's purchase export) runs once against sample rows inside
+a single transaction, which is rolled back at the end, so the database is
+left exactly as it was and a copy of production can be used (that copy's
+ANALYZE statistics then drive the plans, as they would in production).
+Each distinct statement is explained with the parameters it ran with.
+Reported are:
+
+- full scans of a table by a statement that filters it (a WHERE clause),
+- temporary B-trees built for ORDER BY, GROUP BY or DISTINCT,
+- foreign keys with no index starting with them, which makes deleting
+  the parent row scan the child table,
+- indexes that are a prefix of another index on the same table.
+
+The exit status is 1 when anything is reported.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import re
+import sys
+import uuid
+
+import db_operations
+import export_purchases
+import sessions
+from autocorrect import name_index
+from models import db, ProductTag, Purchase, User
+from query_stats import UNATTRIBUTED, operation, profile_queries
+
+
+logger = logging.getLogger(__name__)
+
+FULL_SCAN = 'full scan'
+TEMP_BTREE = 'temp b-tree'
+UNINDEXED_FOREIGN_KEY = 'unindexed foreign key'
+REDUNDANT_INDEX = 'redundant index'
+
+PLANNED_STATEMENTS = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+# (kind, operation) pairs that are expected and not reported: ranking by
+# relevance always sorts the matches, and a user's export, found through
+# purchase (user_id, date), is sorted into insertion order.
+ACCEPTED = {(TEMP_BTREE, 'db_operations.search'), (TEMP_BTREE, 'export_purchases.chunks')}
+
+_scan_re = re.compile(r'^SCAN (\S+)')
+_where_re = re.compile(r'\bWHERE\b', re.IGNORECASE)
+
+
+class Sample:
+    """
+    Rows for the workload to act on, created inside the advisor's transaction.
+    """
+    def __init__(self):
+        suffix = uuid.uuid4().hex[:12]
+        self.user = self._user(f"advisor-buyer-{suffix}")
+        self.user_id = self.user.id
+        self.seller_id = self._user(f"advisor-seller-{suffix}").id
+        self.product_id = db_operations.create_product(
+            f"Advisor Product {suffix}", "Index advisor sample", 10.0, 1000).id
+        self.other_product_id = db_operations.create_product(
+            f"Advisor Other {suffix}", "Index advisor sample", 10.0, 1000).id
+        self.tag_id = db_operations.create_tag(f"advisor-{suffix}").id
+        self.other_tag_id = db_operations.create_tag(f"advisor-other-{suffix}").id
+        ProductTag.create(name=f"advisor-{suffix}", product=self.product_id, tag=self.tag_id)
+        self.purchase_id = Purchase.create(user=self.user_id, product=self.product_id,
+                                           quantity=1, amount=10).id
+        self.name = f"Advisor Product {suffix}"
+
+    @staticmethod
+    def _user(username):
+        return User.create(
+            username=username, name="Advisor", address="1 Main St", zipcode="12345",
+            city="Boston", state="MA", country="United States", billing_name="Advisor",
+            billing_account="0", password="-", email=f"{username}@example.com")
+
+
+def _named(name, func, *args):
+    # Statements from outside db_operations/main are unattributed, and left
+    # out, unless named
+    with operation(name):
+        return func(*args)
+
+
+def _export_for_user(sample):
+    # Two chunks: the first query and the one resuming after its last row
+    query = export_purchases.purchases_query(sample.user_id, since=datetime.date.today())
+    return list(export_purchases.chunks(query, chunk_size=1))
+
+
+def _start_session_and_logout(sample):
+    session = db_operations.start_session(sample.user)
+    return db_operations.logout(session['token'])
+
+
+# (label, call) in the order they run; deletes come last.
+WORKLOAD = [
+    ('search', lambda s: db_operations.search("advisor product")),
+    ('search_typo', lambda s: db_operations.search("advisr prodct")),
+    ('list_products', lambda s: db_operations.list_products()),
+    ('get_product_details', lambda s: db_operations.get_product_details(s.product_id)),
+    ('list_product_tags', lambda s: db_operations.list_product_tags(s.product_id)),
+    ('list_tags', lambda s: db_operations.list_tags()),
+    ('get_tag_details', lambda s: db_operations.get_tag_details(s.tag_id)),
+    ('list_users', lambda s: db_operations.list_users()),
+    ('get_user_details', lambda s: db_operations.get_user_details(s.user_id)),
+    ('get_user_by_username', lambda s: db_operations.get_user_by_username(s.user.username)),
+    ('authenticate_user', lambda s: db_operations.authenticate_user("advisor", "-")),
+    ('check_login', lambda s: db_operations.check_login(s.user.username, "wrong")),
+    ('create_session', lambda s: db_operations.create_session(s.user.username, "wrong")),
+    ('start_session_and_logout', _start_session_and_logout),
+    ('validate_session', lambda s: _named('sessions.validate', sessions.validate, "advisor-unknown-token")),
+    ('list_orders', lambda s: db_operations.list_orders()),
+    ('list_orders_for_user', lambda s: db_operations.list_orders(s.user_id)),
+    ('get_order_details', lambda s: db_operations.get_order_details(s.purchase_id)),
+    ('get_purchase_details', lambda s: db_operations.get_purchase_details(s.purchase_id)),
+    ('get_user_purchases', lambda s: db_operations.get_user_purchases(s.user_id)),
+    ('export_purchases_for_user', lambda s: _named('export_purchases.chunks', _export_for_user, s)),
+    ('list_user_products_by_user', lambda s: db_operations.list_user_products_by_user(s.user_id)),
+    ('list_user_products_by_product', lambda s: db_operations.list_user_products_by_product(s.product_id)),
+    ('add_tag_to_product', lambda s: db_operations.add_tag_to_product(s.product_id, s.other_tag_id)),
+    ('remove_tag_from_product', lambda s: db_operations.remove_tag_from_product(s.product_id, s.other_tag_id)),
+    ('add_product_tag', lambda s: db_operations.add_product_tag(s.other_product_id, s.tag_id)),
+    ('delete_product_tag', lambda s: db_operations.delete_product_tag(s.other_product_id, s.tag_id)),
+    ('add_product_to_user', lambda s: db_operations.add_product_to_user(s.user_id, s.product_id, 1)),
+    ('update_product', lambda s: db_operations.update_product(s.product_id, description="Updated")),
+    ('update_tag', lambda s: db_operations.update_tag(s.tag_id, description="Updated")),
+    ('update_user', lambda s: db_operations.update_user(s.user_id, name="Updated")),
+    ('add_stock', lambda s: db_operations.add_stock(s.product_id, 1)),
+    ('reduce_stock', lambda s: db_operations.reduce_stock(s.product_id, 1)),
+    ('create_purchase', lambda s: db_operations.create_purchase(s.user_id, s.product_id, 1)),
+    ('record_purchase', lambda s: db_operations.record_purchase(s.user_id, s.product_id, 1)),
+    ('purchase_product', lambda s: db_operations.purchase_product(s.user_id, s.seller_id, s.product_id, 1)),
+    ('place_order', lambda s: db_operations.place_order(s.user_id, s.product_id, 1)),
+    ('checkout', lambda s: db_operations.checkout(s.user_id, [(s.product_id, 1), (s.other_product_id, 1)])),
+    ('delete_tag', lambda s: db_operations.delete_tag(s.other_tag_id)),
+    ('delete_product', lambda s: db_operations.delete_product(s.other_product_id)),
+    ('delete_user', lambda s: db_operations.delete_user(s.seller_id)),
+]
+
+
+def capture_workload(workload=None):
+    """
+    Runs the workload (WORKLOAD by default) in a transaction that is rolled
+    back and returns [(operation, sql, params)] for every distinct statement.
+    """
+    with db.atomic() as transaction:
+        try:
+            sample = Sample()
+            with profile_queries(repeat_threshold=sys.maxsize, capture_params=True) as profile:
+                for label, call in workload or WORKLOAD:
+                    try:
+                        # Some listing functions print their rows
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            call(sample)
+                    except Exception as e:
+                        logger.warning(f"{label} failed and was skipped: {e}")
+        finally:
+            transaction.rollback()
+            # Names the workload added to the typo index are gone with the rollback
+            name_index.reset()
+    return [statement for statement in profile.statements() if statement[0] != UNATTRIBUTED]
+
+
+def explain(sql, params=()):
+    """
+    The EXPLAIN QUERY PLAN details of one statement.
+    """
+    return [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+
+def plan_findings(statements):
+    findings = []
+    for operation, sql, params in statements:
+        if not sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+            continue
+        try:
+            details = explain(sql, params)
+        except Exception as e:
+            logger.warning(f"Could not explain a statement of {operation}: {e}")
+            continue
+        for detail in details:
+            if (TEMP_BTREE, operation) in ACCEPTED and 'USE TEMP B-TREE' in detail:
+                continue
+            scan = _scan_re.match(detail)
+            if scan and 'VIRTUAL TABLE' not in detail and _where_re.search(sql):
+                findings.append({'kind': FULL_SCAN, 'table': scan.group(1), 'operation': operation,
+                                 'detail': detail, 'sql': sql})
+            elif 'USE TEMP B-TREE' in detail:
+                findings.append({'kind': TEMP_BTREE, 'table': None, 'operation': operation,
+                                 'detail': detail, 'sql': sql})
+    return findings
+
+
+def _indexes(table):
+    # [(name, unique, [columns])] of one table
+    indexes = []
+    for row in db.execute_sql(f'PRAGMA index_list("{table}")').fetchall():
+        name, unique = row[1], row[2]
+        columns = [info[2] for info in db.execute_sql(f'PRAGMA index_info("{name}")').fetchall()]
+        indexes.append((name, bool(unique), columns))
+    return indexes
+
+
+def schema_findings():
+    findings = []
+    rows = db.execute_sql("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                          "AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\' ORDER BY name").fetchall()
+    virtual = [name for name, sql in rows if sql.upper().startswith('CREATE VIRTUAL')]
+    # Virtual tables and their shadow tables (e.g. the FTS5 index) are left out
+    tables = [name for name, sql in rows if not any(name == v or name.startswith(v + '_') for v in virtual)]
+    for table in tables:
+        indexes = _indexes(table)
+        leading = {columns[0] for _, _, columns in indexes if columns}
+        for row in db.execute_sql(f'PRAGMA foreign_key_list("{table}")').fetchall():
+            column = row[3]
+            if column not in leading:
+                findings.append({'kind': UNINDEXED_FOREIGN_KEY, 'table': table, 'operation': None,
+                                 'detail': f"{table}.{column} references {row[2]}", 'sql': None})
+        for name, unique, columns in indexes:
+            if unique:
+                continue
+            for other, _, other_columns in indexes:
+                if other != name and len(other_columns) > len(columns) and \
+                        other_columns[:len(columns)] == columns:
+                    findings.append({'kind': REDUNDANT_INDEX, 'table': table, 'operation': None,
+                                     'detail': f"{name} ({', '.join(columns)}) is a prefix of {other}",
+                                     'sql': None})
+                    break
+    return findings
+
+
+def advise(workload=None):
+    """
+    Every finding for the current database: query plans first, then schema.
+    """
+    return plan_findings(capture_workload(workload)) + schema_findings()
+
+
+def format_findings(findings):
+    if not findings:
+        return "No full scans, temporary B-trees, unindexed foreign keys or redundant indexes found."
+    lines = []
+    for finding in findings:
+        where = finding['operation'] or finding['table']
+        lines.append(f"[{finding['kind']}] {where}: {finding['detail']}")
+        if finding['sql']:
+            lines.append(f"    {finding['sql']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explain the db_operations queries and flag slow plans.")
+    parser.add_argument("--db", default=db.database, help="database file (default: BETSY_DB_PATH)")
+    parser.add_argument("--json", action="store_true", help="print the findings as JSON")
+    args = parser.parse_args()
+
+    db.configure(args.db)
+    try:
+        results = advise()
+    finally:
+        db.close()
+    print(json.dumps(results, indent=2) if args.json else format_findings(results))
+    if results:
+        raise SystemExit(1)
@@ -1,6 +1,7 @@
 __winc_id__ = "d7b474e9b3a54d23bca54879a4f1855b"
 __human_name__ = "Betsy Webshop"
 
+import datetime
 import logging
 import sqlite3
 import subprocess
@@ -12,9 +13,12 @@ from db_operations import are_tables_initialized
 from models import Product
 from models import ProductTag
 from models import Purchase
+from models import StockError
 from models import Tag
 from models import User
 from models import UserProduct
+from search_index import search_products
+from tag_tree import products_under_tag
 
 #
 
@@ -24,7 +28,7 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
 def are_tables_initialized():
-    required_tables = [User, Product, Tag, ProductTag, Purchase, UserProduct]
+    required_tables = db_operations.REQUIRED_TABLES
     for table in required_tables:
         if not table.table_exists():
             return False
@@ -35,7 +39,7 @@ if not are_tables_initialized():
     print("Error: Database tables are not initialized. Please run populate_db.py.")
 
 def check_tables_exist(db=None):
-    required_tables = [User, Product, Tag, ProductTag, Purchase, UserProduct]
+    required_tables = db_operations.REQUIRED_TABLES
     missing_tables = []
     print("Checking if required tables exist...")
     print(f"Required tables: {required_tables}")
@@ -68,20 +72,16 @@ def purchase_product(product_id, buyer_id, quantity):
     Purchase a specific quantity of a product.
     """
     try:
-        product = Product.get_by_id(product_id)
-        buyer = db_operations.get_user_by_id(buyer_id)
-        if product.quantity >= quantity:
-            product.quantity -= quantity
-            product.save()
-            message = f"{quantity} units of product {product.name} successfully purchased by {buyer.username}!"
-            return {"success": True, "message": message}
-    except DoesNotExist as e:
+        purchase = db_operations.record_purchase(buyer_id, product_id, quantity)
+        message = f"{quantity} units of product {purchase.product.name} successfully purchased by {purchase.user.username}!"
+        return {"success": True, "message": message}
+    except (DoesNotExist, StockError, ValueError) as e:
         message = f"Error purchasing product: {e}"
-        return {"fail": False, "message": message}
+        return {"success": False, "message": message}
     except Exception as e:
         logger.error(f"Error purchasing product: {e}")
         return {
-            "success": True,
+            "success": False,
             "message": "An error occurred while purchasing the product.",
         }
 
@@ -115,7 +115,7 @@ def create_purchase(
         purchase=None):
 
     try:
-        user = db_operations.get_user_by_username('user_id')
+        user = User.get_by_id(user_id)
         try:
             product = Product.get_by_id(product_id)
         except DoesNotExist:
@@ -130,7 +130,8 @@ def create_purchase(
             description=description,
             category=category,
             account=account,
-            date=date,
+            # Undated purchases would be left out of the daily sales rollup
+            date=date if date is not None else datetime.date.today(),
         )
         logger.info(f"Transaction created: {purchase}")
         print(f"Transaction created: {purchase}")
@@ -145,29 +146,29 @@ def create_purchase(
         return None
 
 
-def remove_tag_from_product(product_id, tag_name):
-    try:
-        product = Product.get(id=product_id)
-    except DoesNotExist:
-        logger.error(f"Error: Product with id {product_id} does not exist.")
-        return
+def _log_result(message):
+    # db_operations reports how a change went as a message
+    if message.startswith("Successfully"):
+        logger.info(message)
+    else:
+        logger.error(f"Error: {message}")
+
 
+def remove_tag_from_product(product_id, tag_name):
     try:
         tag = Tag.get(name=tag_name)
     except DoesNotExist:
         logger.error(f"Error: Tag '{tag_name}' does not exist.")
         return
 
-    product.tags.remove(tag)
+    # Through db_operations, which invalidates the cached product
+    _log_result(db_operations.remove_tag_from_product(product_id, tag.id))
 
 
 def remove_product(product_id):
+    # Through db_operations, which keeps the product cache and autocorrect index in step
     try:
-        product = Product.get(Product.id == product_id)
-        product.delete_instance()
-        logger.info(f"Product {product.name} successfully removed from catalog!")
-    except DoesNotExist:
-        logger.error(f"Product with id {product_id} does not exist.")
+        _log_result(db_operations.remove_product(product_id))
     except Exception as e:
         logger.error(f"Error removing product from catalog: {e}")
         print(f"Error: Product with id {product_id} does not exist.")
@@ -182,40 +183,30 @@ def add_tag_to_product(product_id, tag_name):
         return
 
     try:
-        tag, _ = Tag.get_or_create(name=tag_name)
-        product.tags.add(tag)
+        tag = Tag.get_or_none(Tag.name == tag_name) or db_operations.create_tag(tag_name)
+        _log_result(db_operations.add_tag_to_product(product.id, tag.id))
     except Exception as e:
         logger.error(f"Error adding tag to product: {e}")
 
 
 def update_tag(tag_id, new_name):
     try:
-        tag = Tag.get(id=tag_id)
-        tag.name = new_name
-        tag.save()
-    except DoesNotExist:
-        logger.error(f"Error: Tag with id {tag_id} does not exist.")
+        _log_result(db_operations.update_tag(tag_id, name=new_name))
     except Exception as e:
         logger.error(f"Error updating tag: {e}")
 
 
 def delete_tag(tag_id):
     try:
-        tag = Tag.get(id=tag_id)
-        tag.delete_instance()
-    except DoesNotExist:
-        logger.error(f"Error: Tag with id {tag_id} does not exist.")
+        _log_result(db_operations.delete_tag(tag_id))
     except Exception as e:
         logger.error(f"Error deleting tag: {e}")
 
 
-def search(term):
+def search(term, page=1, per_page=20):
     logger.info(f'Searching for products with term "{term}"...')
     try:
-        products = Product.select().where(
-            (Product.name.contains(term, case=True))
-            | (Product.description.contains(term, case=True))
-        )
+        products = search_products(term, page, per_page)
         return products
     except Exception as e:
         logger.error(f"Error searching for products: {e}")
@@ -242,11 +233,11 @@ def list_user_products(user_id):
         return []
 
 
-def list_products_per_tag(tag_id):
+def list_products_per_tag(tag_id, include_descendants=True):
     logger.info(f"Listing products for tag with ID {tag_id}...")
     try:
-        products = Product.select().join(Tag).where(Tag.id == tag_id)
-        return products
+        # Includes the products of every tag below this one
+        return list(products_under_tag(tag_id, include_descendants))
     except Exception as e:
         logger.error(f"Error listing products per tag: {e}")
         return []
@@ -0,0 +1,154 @@
+"""
+Converts the UUID keys of an existing database from hex text to 16-byte
+blobs (models.BinaryUUIDField), in place. This is an offline migration, for
+a maintenance window with the application stopped:
+
+    python migrate_uuid_offline.py --db betsy.db
+
+Every table is converted in one exclusive transaction. Keys and the foreign
+keys pointing at them are all rewritten before anything commits, so no
+connection ever sees blob keys next to text ones, which joins and lookups
+by id would silently get wrong. Writers are locked out until it is done,
+and an interrupted or failed run leaves the database as it was. Rows are
+still read and rewritten ``--batch-size`` at a time to bound memory. The
+declared column types stay as they were, which SQLite doesn't hold against
+blobs (a text column only converts numbers). ``--vacuum`` then rebuilds
+the file so the freed pages are given back.
+
+File, table and index sizes are reported before and after.
+"""
+import argparse
+import json
+import logging
+import os
+import uuid
+
+from models import db, BinaryUUIDField, DailySales, Product, ProductTag, Purchase, Tag, TagClosure, User, UserProduct
+from sales_rollup import rebuild_sales_rollup
+from tag_tree import rebuild_tag_closure
+
+
+logger = logging.getLogger(__name__)
+
+MODELS = [User, Product, Tag, ProductTag, Purchase, UserProduct]
+DEFAULT_BATCH_SIZE = 5000
+
+
+def uuid_columns(model):
+    """
+    The model's columns holding UUIDs: binary keys and the foreign keys to them.
+    """
+    return [field.column_name for field in model._meta.sorted_fields
+            if isinstance(getattr(field, 'rel_field', field), BinaryUUIDField)]
+
+
+def database_sizes():
+    """
+    {'file': bytes, 'objects': {name: {'bytes', 'used'}}} for the current
+    database. 'bytes' counts whole pages; 'used' leaves out their free space,
+    so it shows the gain before a VACUUM. Per-object sizes need the dbstat
+    table, which some SQLite builds leave out.
+    """
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    objects = {}
+    try:
+        rows = db.execute_sql('SELECT name, sum(pgsize), sum(pgsize - unused) FROM dbstat GROUP BY name')
+        objects = {name: {'bytes': size, 'used': used} for name, size, used in rows}
+    except Exception:
+        logger.warning("dbstat is not available; only the file size is reported.")
+    return {'file': os.path.getsize(db.database), 'objects': objects}
+
+
+def _to_blob(value):
+    if isinstance(value, str):
+        return uuid.UUID(value).bytes
+    return value
+
+
+def migrate_table(model, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Converts the text UUIDs of one table, a batch at a time, within the
+    migration's transaction. Returns the number of rows rewritten.
+    """
+    columns = uuid_columns(model)
+    table = model._meta.table_name
+    selected = ', '.join(f'"{column}"' for column in columns)
+    pending = ' OR '.join(f'typeof("{column}") = \'text\'' for column in columns)
+    assignments = ', '.join(f'"{column}" = ?' for column in columns)
+    converted = 0
+    last_rowid = 0
+    while True:
+        with db.atomic():
+            rows = db.execute_sql(
+                f'SELECT rowid, {selected} FROM "{table}" WHERE rowid > ? AND ({pending}) '
+                f'ORDER BY rowid LIMIT ?', (last_rowid, batch_size)).fetchall()
+            if not rows:
+                return converted
+            db.cursor().executemany(
+                f'UPDATE "{table}" SET {assignments} WHERE rowid = ?',
+                [[_to_blob(value) for value in row[1:]] + [row[0]] for row in rows])
+        last_rowid = rows[-1][0]
+        converted += len(rows)
+        logger.info("%s: %d rows converted", table, converted)
+
+
+def migrate(batch_size=DEFAULT_BATCH_SIZE, vacuum=False):
+    """
+    Converts every table of the current database and returns
+    {'converted': {table: rows}, 'before': sizes, 'after': sizes}.
+    """
+    before = database_sizes()
+    converted = {}
+    # Keys and the foreign keys pointing at them can't change in one
+    # statement, so the checks are suspended (the pragma is a no-op inside a
+    # transaction) and run once before committing.
+    foreign_keys = db.execute_sql('PRAGMA foreign_keys').fetchone()[0]
+    db.execute_sql('PRAGMA foreign_keys = 0')
+    try:
+        with db.atomic('EXCLUSIVE'):
+            for model in MODELS:
+                converted[model._meta.table_name] = migrate_table(model, batch_size)
+            # Derived from the tag and purchase tables, so rebuilt rather than converted
+            if TagClosure.table_exists():
+                rebuild_tag_closure()
+            if DailySales.table_exists():
+                rebuild_sales_rollup()
+            violations = db.execute_sql('PRAGMA foreign_key_check').fetchall()
+            if violations:
+                raise ValueError(f"Foreign key check failed, nothing was converted: {violations[:10]}")
+    finally:
+        db.execute_sql(f'PRAGMA foreign_keys = {foreign_keys}')
+    if vacuum:
+        db.execute_sql('VACUUM')
+    return {'converted': converted, 'before': before, 'after': database_sizes()}
+
+
+def size_report(before, after):
+    lines = [f"{'':<40} {'before':>12} {'after':>12}",
+             f"{'file':<40} {before['file']:>12,} {after['file']:>12,}"]
+    for name in sorted(set(before['objects']) | set(after['objects'])):
+        old = before['objects'].get(name, {}).get('used', 0)
+        new = after['objects'].get(name, {}).get('used', 0)
+        lines.append(f"{name:<40} {old:>12,} {new:>12,}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store UUID keys as 16-byte blobs (offline: stop the application first).")
+    parser.add_argument("--db", default=db.database, help="database file (default: BETSY_DB_PATH)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--vacuum", action="store_true", help="give the freed space back to the file system")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db.configure(args.db)
+    try:
+        result = migrate(args.batch_size, args.vacuum)
+    finally:
+        db.close()
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(json.dumps(result['converted']))
+        print(size_report(result['before'], result['after']))
@@ -1,12 +1,428 @@
+import contextlib
+import contextvars
 import datetime
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
 import uuid
+from urllib.request import pathname2url
 
 from peewee import (
     SqliteDatabase, Model, CharField, TextField, DecimalField,
-    IntegerField, ForeignKeyField, DateTimeField, BooleanField, DateField, UUIDField
+    IntegerField, ForeignKeyField, DateTimeField, BooleanField, DateField, BlobField, CompositeKey
 )
+from playhouse.pool import MaxConnectionsExceeded, PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
-db = SqliteDatabase("betsy.db")
+from query_stats import QueryStatsMixin
+
+logger = logging.getLogger(__name__)
+
+# The database file and profile can be chosen per environment; see PROFILES.
+DATABASE_PATH = os.environ.get("BETSY_DB_PATH", "betsy.db")
+DATABASE_PROFILE = os.environ.get("BETSY_DB_PROFILE", "balanced")
+# Maximum pooled connections; 0 means one plain connection per thread, opened
+# and closed by the caller. Stale connections are recycled after
+# BETSY_DB_POOL_STALE seconds; a thread waits up to BETSY_DB_POOL_TIMEOUT
+# seconds for a free one.
+POOL_SIZE = int(os.environ.get("BETSY_DB_POOL_SIZE", "0"))
+POOL_STALE_TIMEOUT = int(os.environ.get("BETSY_DB_POOL_STALE", "300"))
+POOL_TIMEOUT = int(os.environ.get("BETSY_DB_POOL_TIMEOUT", "10"))
+# Read operations (see read_operation) run on read-only connections, to the
+# main file or to BETSY_DB_READ_PATH, e.g. a replica. BETSY_DB_READ_ROUTING=0
+# sends them through the writer's connection like everything else.
+READ_ROUTING = os.environ.get("BETSY_DB_READ_ROUTING", "1") != "0"
+READ_PATH = os.environ.get("BETSY_DB_READ_PATH") or None
+# Profile pragmas a read-only connection can't or needn't set
+WRITER_ONLY_PRAGMAS = ("journal_mode", "synchronous", "foreign_keys")
+
+# SQLite pragmas per profile. All profiles use WAL, so catalog reads never
+# wait for a checkout to commit and vice versa. cache_size is in KiB when
+# negative; busy_timeout is in milliseconds.
+PROFILES = {
+    # Every commit is synced to disk before it returns.
+    "durable": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "default",
+        "busy_timeout": 5000,
+        "foreign_keys": 1,
+    },
+    # Safe against application crashes; a power cut may lose the last
+    # commits but never corrupts the database.
+    "balanced": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 5000,
+        "foreign_keys": 1,
+    },
+    # Bulk loads, benchmarks and scratch databases: no syncing and no
+    # foreign key checks.
+    "throughput": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "cache_size": -256000,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 10000,
+        "foreign_keys": 0,
+    },
+}
+
+# What PRAGMA returns for the named settings.
+PRAGMA_VALUES = {
+    "synchronous": {"off": 0, "normal": 1, "full": 2, "extra": 3},
+    "temp_store": {"default": 0, "file": 1, "memory": 2},
+}
+
+
+def profile_pragmas(profile):
+    try:
+        return dict(PROFILES[profile])
+    except KeyError:
+        raise ValueError(f"Unknown database profile '{profile}'. Choose one of: {', '.join(PROFILES)}.")
+
+
+def check_pragmas(conn, profile, database):
+    """
+    Logs the pragmas in effect on ``conn`` and warns about any that differ
+    from the profile, e.g. WAL refused by the filesystem or mmap_size capped
+    by the SQLite build. Returns the effective values.
+    """
+    effective = {}
+    for name in PROFILES[profile]:
+        # mmap_size returns no row for in-memory databases
+        row = conn.execute(f"PRAGMA {name}").fetchone()
+        effective[name] = row[0] if row else None
+    logger.info(f"SQLite profile '{profile}' on {database}: "
+                + ", ".join(f"{name}={value}" for name, value in effective.items()))
+    # In-memory databases have no journal file or mmap to configure
+    if database != ":memory:":
+        for name, expected in PROFILES[profile].items():
+            expected = PRAGMA_VALUES.get(name, {}).get(expected, expected)
+            if effective[name] != expected:
+                logger.warning(f"SQLite pragma {name} is {effective[name]}, profile '{profile}' asks for {expected}.")
+    return effective
+
+
+_reading = contextvars.ContextVar('betsy_reading', default=False)
+
+
+@contextlib.contextmanager
+def reading():
+    """
+    Routes the statements run inside the block to the read-only connections,
+    unless they are part of a transaction.
+    """
+    token = _reading.set(True)
+    try:
+        yield
+    finally:
+        _reading.reset(token)
+
+
+def read_operation(func):
+    """
+    Marks ``func`` as never writing, so it runs on the read-only connections.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with reading():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class BetsyDatabaseMixin(QueryStatsMixin):
+    """
+    What the shared database adds to peewee's SqliteDatabase, with or
+    without a pool: per-operation statement statistics (query_stats)
+    and the pragmas of a named profile. The pragmas in effect are checked
+    on the first connection to each database file.
+
+    Statements run in ``reading()`` outside a transaction go to a read-only
+    connection per thread (``mode=ro`` and ``query_only``), so catalog reads
+    never queue behind the writer's connection state. Under WAL they read the
+    last committed data. A transaction keeps every statement on the writer,
+    so it reads its own writes.
+    """
+    def __init__(self, database, profile=DATABASE_PROFILE, read_routing=READ_ROUTING,
+                 read_path=READ_PATH, **kwargs):
+        self.profile = profile
+        self.read_routing = read_routing
+        self.read_path = read_path
+        self._checked = set()
+        self._readers = threading.local()
+        self._reader_conns = {}
+        self._reader_lock = threading.Lock()
+        self._reader_generation = 0
+        super().__init__(database, pragmas=profile_pragmas(profile), **kwargs)
+
+    def init(self, database, **kwargs):
+        # Readers of the old database file are closed
+        self._close_readers()
+        super().init(database, **kwargs)
+
+    def configure(self, database=None, profile=None, read_path=None):
+        """
+        Points the database at another file, switches to another profile
+        and/or reads from a replica file ('' reads the main file again).
+        """
+        if profile is not None:
+            pragmas = profile_pragmas(profile)
+            self.profile = profile
+        else:
+            pragmas = profile_pragmas(self.profile)
+        if read_path is not None:
+            self.read_path = read_path or None
+        self.init(self.database if database is None else database, pragmas=pragmas)
+
+    def _initialize_connection(self, conn):
+        super()._initialize_connection(conn)
+        if (self.database, self.profile) not in self._checked:
+            self._checked.add((self.database, self.profile))
+            check_pragmas(conn, self.profile, self.database)
+
+    def routes_reads(self):
+        # A second connection to an in-memory database would be another database
+        return (self.read_routing and self.database is not None
+                and not (self.read_path or self.database).startswith((':memory:', 'file::memory:')))
+
+    def read_connection(self):
+        """
+        This thread's read-only connection, opened on first use.
+        """
+        reader = getattr(self._readers, 'conn', None)
+        if reader is not None and self._readers.generation == self._reader_generation:
+            return reader
+        path = os.path.abspath(self.read_path or self.database)
+        # Closed by whichever thread re-points the database, hence check_same_thread
+        reader = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True, timeout=self._timeout,
+                                 isolation_level=None, check_same_thread=False)
+        for name, value in profile_pragmas(self.profile).items():
+            if name not in WRITER_ONLY_PRAGMAS:
+                reader.execute(f"PRAGMA {name} = {value}")
+        reader.execute("PRAGMA query_only = 1")
+        with self._reader_lock:
+            self._reader_conns[id(reader)] = reader
+        self._readers.conn = reader
+        self._readers.generation = self._reader_generation
+        return reader
+
+    def cursor(self, named_cursor=None):
+        if _reading.get() and not self.in_transaction() and self.routes_reads():
+            return self.read_connection().cursor()
+        return super().cursor(named_cursor)
+
+    def close(self):
+        closed = super().close()
+        reader = getattr(self._readers, 'conn', None)
+        if reader is not None:
+            self._readers.conn = None
+            with self._reader_lock:
+                self._reader_conns.pop(id(reader), None)
+            reader.close()
+        return closed
+
+    def _close_readers(self):
+        with self._reader_lock:
+            readers, self._reader_conns = list(self._reader_conns.values()), {}
+            self._reader_generation += 1
+        for reader in readers:
+            reader.close()
+
+
+class BetsyDatabase(BetsyDatabaseMixin, SqliteDatabase):
+    pass
+
+
+class PoolStats:
+    """
+    Counters for a connection pool: checkouts, connections opened and closed
+    (stale, broken or on close_all), waits that timed out and the time
+    threads spent waiting for a connection.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.opened = 0
+            self.closed = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record_checkout(self, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'opened': self.opened,
+                'closed': self.closed,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'wait_mean': self.wait_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+# Built on the public PooledSqliteDatabase, so only documented peewee
+# classes are subclassed
+class PooledBetsyDatabase(BetsyDatabaseMixin, PooledSqliteDatabase):
+    """
+    BetsyDatabase with a pool of connections shared by all threads. Each
+    thread checks a connection out on connect() and returns it on close();
+    wrap each request in ``db.connection_context()`` so it is returned.
+    """
+    def __init__(self, database, **kwargs):
+        self.pool_stats = PoolStats()
+        self._open_keys = set()
+        super().__init__(database, **kwargs)
+
+    def init(self, database, **kwargs):
+        # Idle connections still point at the old database file
+        if getattr(self, '_pool_initialized', False):
+            self.close_all()
+        # A pooled connection moves between threads, though only one uses it at a time
+        kwargs.setdefault('check_same_thread', False)
+        super().init(database, **kwargs)
+        self._pool_initialized = True
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        try:
+            opened = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            self.pool_stats.record('timeouts')
+            raise
+        if opened:
+            self.pool_stats.record_checkout(time.perf_counter() - start)
+        return opened
+
+    def _connect(self):
+        with self._pool_lock:
+            conn = super()._connect()
+            if self.conn_key(conn) not in self._open_keys:
+                self._open_keys.add(self.conn_key(conn))
+                self.pool_stats.record('opened')
+            return conn
+
+    def _close_raw(self, conn):
+        with self._pool_lock:
+            if self.conn_key(conn) in self._open_keys:
+                self._open_keys.discard(self.conn_key(conn))
+                self.pool_stats.record('closed')
+        super()._close_raw(conn)
+
+    def pool_status(self):
+        """
+        PoolStats counters plus the connections in use and idle right now.
+        """
+        status = self.pool_stats.snapshot()
+        with self._pool_lock:
+            status['in_use'] = len(self._in_use)
+            status['idle'] = len(self._connections)
+        status['max_connections'] = self._max_connections
+        return status
+
+
+def make_database(path=DATABASE_PATH, profile=DATABASE_PROFILE, pool_size=POOL_SIZE,
+                  stale_timeout=POOL_STALE_TIMEOUT, timeout=POOL_TIMEOUT):
+    if pool_size:
+        return PooledBetsyDatabase(path, profile=profile, max_connections=pool_size,
+                                   stale_timeout=stale_timeout, timeout=timeout)
+    return BetsyDatabase(path, profile=profile)
+
+
+db = make_database()
+
+
+_uuid7_lock = threading.Lock()
+_uuid7_last = (0, 0)
+
+
+def uuid7():
+    """
+    A time-ordered UUID (version 7, RFC 9562): 48 bits of Unix time in
+    milliseconds, then a 12-bit counter and 62 random bits. Ids made in this
+    process are strictly increasing, so new rows land at the right edge of
+    the primary key B-tree instead of on a random page. They reveal their
+    creation time; uuid.uuid4 is still the default where that matters.
+    """
+    global _uuid7_last
+    with _uuid7_lock:
+        millis = time.time_ns() // 1_000_000
+        last_millis, counter = _uuid7_last
+        if millis > last_millis:
+            # Random start, with room left for ids in the same millisecond
+            counter = int.from_bytes(os.urandom(2), 'big') >> 5
+        else:
+            millis, counter = last_millis, counter + 1
+            if counter > 0xFFF:
+                # Counter exhausted: borrow the next millisecond
+                millis, counter = millis + 1, 0
+        _uuid7_last = (millis, counter)
+    random_bits = int.from_bytes(os.urandom(8), 'big') >> 2
+    return uuid7_at(millis, counter, random_bits)
+
+
+def uuid7_at(millis, rand_a, rand_b):
+    """
+    The version 7 UUID for a Unix time in milliseconds, followed by 12 bits
+    (``rand_a``) and 62 bits (``rand_b``) of the caller's choosing.
+    """
+    return uuid.UUID(int=millis << 80 | 0x7 << 76 | rand_a << 64 | 0b10 << 62 | rand_b)
+
+
+# Primary key defaults a model can pick from
+KEY_GENERATORS = {'uuid4': uuid.uuid4, 'uuid7': uuid7}
+
+
+class BinaryUUIDField(BlobField):
+    """
+    A UUID stored as its 16 raw bytes rather than as 32 characters of hex,
+    which halves every key, foreign key and index entry. Accepts the same
+    values as UUIDField. Hex text still read back as a UUID, so databases
+    migrate in place (see migrate_uuid_offline.py).
+    """
+    field_type = 'UUIDB'
+
+    def db_value(self, value):
+        if value is None or isinstance(value, uuid.UUID):
+            return None if value is None else self._constructor(value.bytes)
+        if isinstance(value, (bytes, bytearray, memoryview)) and len(value) == 16:
+            return self._constructor(bytes(value))
+        try:
+            return self._constructor(uuid.UUID(str(value)).bytes)
+        except ValueError:
+            # Not a UUID, so it matches nothing, as with UUIDField
+            return value
+
+    def python_value(self, value):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        if isinstance(value, str):
+            return uuid.UUID(value)
+        return uuid.UUID(bytes=bytes(value))
 
 
 class BaseModel(Model):
@@ -17,8 +433,12 @@ class BaseModel(Model):
 class TagError(Exception):
     pass
 
+
+class StockError(Exception):
+    pass
+
 class User(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = BinaryUUIDField(primary_key=True, default=uuid.uuid4)
     username = CharField(unique=True, index=True)
     name = CharField()
     address = CharField()
@@ -35,7 +455,7 @@ class User(BaseModel):
 
 
 class Product(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = BinaryUUIDField(primary_key=True, default=uuid.uuid4)
     name = CharField(unique=True, index=True)
     description = TextField()
     price_per_unit = DecimalField()
@@ -45,8 +465,25 @@ class Product(BaseModel):
     is_active = BooleanField(default=True)
 
 
+class ProductIndex(FTS5Model):
+    """
+    FTS5 index over Product name and description.
+
+    External-content table: the text is read back from the product table and
+    the index is kept in sync by the triggers in search_index.py.
+    """
+    id = SearchField(unindexed=True)
+    name = SearchField()
+    description = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'product_index'
+        options = {'content': 'product', 'content_rowid': 'rowid'}
+
+
 class Tag(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = BinaryUUIDField(primary_key=True, default=uuid.uuid4)
     name = CharField(unique=True, index=True)
     description = TextField(null=True)
     created_at = DateTimeField(default=datetime.datetime.now)
@@ -59,23 +496,46 @@ class Tag(BaseModel):
         database = db
 
 
+class TagClosure(BaseModel):
+    """
+    Every (ancestor, descendant) pair of the tag tree, with the number of
+    levels between them; each tag is its own ancestor at depth 0. Triggers
+    keep it in sync with Tag.parent (see tag_tree.py).
+    """
+    # Leading column of the primary key
+    ancestor = ForeignKeyField(Tag, backref='descendant_links', on_delete='CASCADE', index=False)
+    descendant = ForeignKeyField(Tag, backref='ancestor_links', on_delete='CASCADE')
+    depth = IntegerField()
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey('ancestor', 'descendant')
+        without_rowid = True
+
+
 class ProductTag(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = BinaryUUIDField(primary_key=True, default=uuid.uuid4)
     name = CharField(unique=True, index=True)
     description = TextField(null=True)
     tag = ForeignKeyField(Tag, backref='related_products')
-    product = ForeignKeyField(Product, backref='associated_tags')
+    # Indexed by (product, tag) below
+    product = ForeignKeyField(Product, backref='associated_tags', index=False)
     created_at = DateTimeField(default=datetime.datetime.now)
     updated_at = DateTimeField(null=True)
     is_active = BooleanField(default=True)
 
     class Meta:
         database = db
+        indexes = (
+            # Tag lookups and removals for a product
+            (('product', 'tag'), False),
+        )
 
 
 class Purchase(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
-    user = ForeignKeyField(User, backref='user_purchases', on_delete='CASCADE')
+    id = BinaryUUIDField(primary_key=True, default=uuid7)
+    # Indexed by (user, id) and (user, date) below
+    user = ForeignKeyField(User, backref='user_purchases', on_delete='CASCADE', index=False)
     product = ForeignKeyField(Product, backref='product_purchases', on_delete='CASCADE')
     quantity = IntegerField()
     amount = DecimalField(max_digits=10, decimal_places=2)
@@ -86,11 +546,20 @@ class Purchase(BaseModel):
 
     class Meta:
         database = db
-    
+        indexes = (
+            # A user's purchase history in id order, which list_orders
+            # pages through
+            (('user', 'id'), False),
+            # A user's purchases in a date range, as export_purchases
+            # --user --since reads them
+            (('user', 'date'), False),
+        )
+
 
 class UserProduct(BaseModel):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
-    user = ForeignKeyField(User, backref='user_products')
+    id = BinaryUUIDField(primary_key=True, default=uuid7)
+    # Indexed by (user, product) below
+    user = ForeignKeyField(User, backref='user_products', index=False)
     product = ForeignKeyField(Product, backref='user_products')
     quantity = IntegerField()
     created_at = DateTimeField(default=datetime.datetime.now)
@@ -100,5 +569,64 @@ class UserProduct(BaseModel):
 
     class Meta:
         database = db
+        indexes = (
+            # add_product_to_user finds the user's row for a product
+            (('user', 'product'), False),
+        )
+
+
+
+
+class DailySales(BaseModel):
+    """
+    Purchases, units and revenue per day, product and purchase category.
+    Triggers keep it in sync with the purchase table (see sales_rollup.py);
+    purchases without a category count under ''.
+    """
+    date = DateField()
+    product = ForeignKeyField(Product, backref='daily_sales', on_delete='CASCADE')
+    category = CharField(default='')
+    purchases = IntegerField(default=0)
+    units = IntegerField(default=0)
+    # Kept rounded to cents by the triggers
+    amount = DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey('date', 'product', 'category')
+        without_rowid = True
+
 
+class ProductSales(BaseModel):
+    """
+    Lifetime purchases, units and revenue per product, kept up to date by
+    the same triggers as DailySales (see sales_rollup.py).
+    """
+    product = ForeignKeyField(Product, primary_key=True, backref='sales', on_delete='CASCADE')
+    purchases = IntegerField(default=0)
+    units = IntegerField(default=0)
+    amount = DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            # Best sellers first, read backwards
+            (('units', 'product'), False),
+        )
 
+
+class Session(BaseModel):
+    """
+    A signed-in session (see sessions.py). Only the SHA-256 of the token is
+    stored, so the table alone doesn't let anyone sign in.
+    """
+    token_hash = CharField(primary_key=True)
+    # Indexed, for revoking every session of a user
+    user = ForeignKeyField(User, backref='sessions', on_delete='CASCADE')
+    created_at = DateTimeField(default=datetime.datetime.now)
+    # Indexed, for the sweep of expired sessions
+    expires_at = DateTimeField(index=True)
+
+    class Meta:
+        database = db
+        without_rowid = True
@@ -0,0 +1,73 @@
+"""
+Keyset pagination for the db_operations listings.
+
+A listing returns one page at a time, ordered by a unique, indexed column,
+and the page carries an opaque ``next_cursor`` to pass back for the next
+one. The cursor holds the key of the last row, so the next page starts
+with an index seek: page 1000 costs the same as page 1, and each call
+holds at most ``per_page`` rows in memory.
+
+    page = db_operations.list_products(per_page=50)
+    while page.next_cursor:
+        page = db_operations.list_products(cursor=page.next_cursor, per_page=50)
+
+A Page is a list, so callers that only look at the rows keep working.
+"""
+import base64
+import binascii
+import json
+import uuid
+
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 500
+
+
+class Page(list):
+    """
+    The rows of one page; ``next_cursor`` is None on the last page.
+    """
+    def __init__(self, rows=(), next_cursor=None):
+        super().__init__(rows)
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(listing, value):
+    if isinstance(value, uuid.UUID):
+        value = value.hex
+    payload = json.dumps([listing, value], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(listing, cursor):
+    """
+    The key stored in ``cursor``. Raises ValueError for a cursor that is
+    malformed or was issued by a different listing.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_listing, value = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid page cursor.")
+    if cursor_listing != listing or not isinstance(value, str):
+        raise ValueError("Invalid page cursor.")
+    return value
+
+
+def paginate(query, key, listing, cursor=None, per_page=DEFAULT_PER_PAGE):
+    """
+    One page of ``query`` ordered by the unique field ``key``, starting
+    after the row ``cursor`` points to. Returns (rows, next_cursor); the
+    caller turns the rows into the items of a Page.
+    """
+    if not isinstance(per_page, int) or not 1 <= per_page <= MAX_PER_PAGE:
+        raise ValueError(f"per_page must be an integer from 1 to {MAX_PER_PAGE}.")
+    if cursor is not None:
+        query = query.where(key > decode_cursor(listing, cursor))
+    # One extra row tells whether there is a next page
+    rows = list(query.order_by(key).limit(per_page + 1))
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(listing, getattr(rows[-1], key.name))
+    return rows, next_cursor
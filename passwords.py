@@ -0,0 +1,185 @@
+"""
+Password hashing and verification with bcrypt, off the calling thread.
+
+bcrypt is deliberately slow: at a realistic cost factor one hash or check
+is a few hundred milliseconds of CPU with the GIL held. The calls here run
+in a pool of worker processes instead, so a burst of logins doesn't stall
+every other thread in the process:
+
+    hashed = passwords.hash_password("s3cret")
+    passwords.verify_password("s3cret", hashed)              # True
+    await passwords.verify_password_async("s3cret", hashed)  # same, for asyncio
+
+At most ``queue_size`` calls are in the pool at once, running or waiting
+for a worker. Further callers block until one finishes, or get a
+TimeoutError after ``queue_timeout`` seconds if that is set, so an
+overload turns into errors instead of an ever growing backlog.
+
+``needs_rehash()`` tells whether a stored hash was made with a cost factor
+other than the configured one; db_operations re-hashes such passwords on
+the next successful login. Stored passwords that aren't bcrypt hashes
+(users registered before passwords were hashed) are compared as they are
+and always need a rehash.
+
+Configuration, read when the module is imported:
+
+- BETSY_BCRYPT_ROUNDS: the cost factor, 4 to 31 (default 12)
+- BETSY_PASSWORD_WORKERS: worker processes (default: one per CPU); 0
+  hashes on the calling thread
+- BETSY_PASSWORD_QUEUE_SIZE: calls in the pool at once (default 64)
+- BETSY_PASSWORD_QUEUE_TIMEOUT: seconds to wait for room in the pool
+  (default: wait indefinitely)
+"""
+import asyncio
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+DEFAULT_ROUNDS = int(os.environ.get("BETSY_BCRYPT_ROUNDS", "12"))
+DEFAULT_WORKERS = int(os.environ.get("BETSY_PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+DEFAULT_QUEUE_SIZE = int(os.environ.get("BETSY_PASSWORD_QUEUE_SIZE", "64"))
+DEFAULT_QUEUE_TIMEOUT = (float(os.environ["BETSY_PASSWORD_QUEUE_TIMEOUT"])
+                         if os.environ.get("BETSY_PASSWORD_QUEUE_TIMEOUT") else None)
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+# Run in the worker processes, so they take and return plain strings
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _verify(password, hashed):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Malformed hash
+        return False
+
+
+def is_bcrypt_hash(stored):
+    return stored.startswith(BCRYPT_PREFIXES)
+
+
+def hash_rounds(hashed):
+    """
+    The cost factor a bcrypt hash was made with, or None for anything else.
+    """
+    if not is_bcrypt_hash(hashed):
+        return None
+    try:
+        return int(hashed[4:6])
+    except ValueError:
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.rounds = self.workers = self.queue_size = None
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self.configure(rounds, workers, queue_size)
+
+    def configure(self, rounds=None, workers=None, queue_size=None):
+        """
+        Changes the settings given; a running pool is shut down and the next
+        call starts one with the new settings.
+        """
+        rounds = self.rounds if rounds is None else rounds
+        if not MIN_ROUNDS <= rounds <= MAX_ROUNDS:
+            raise ValueError(f"bcrypt rounds must be between {MIN_ROUNDS} and {MAX_ROUNDS}.")
+        self.shutdown()
+        self.rounds = rounds
+        self.workers = self.workers if workers is None else workers
+        self.queue_size = self.queue_size if queue_size is None else queue_size
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process with threads running can deadlock the child
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _acquire(self, slots):
+        if not slots.acquire(timeout=self.queue_timeout):
+            raise TimeoutError("Too many password checks waiting; try again later.")
+
+    def _submit(self, slots, func, *args):
+        # Called with a slot held, which is given back when the call ends
+        try:
+            future = self._pool().submit(func, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        slots = self._slots
+        self._acquire(slots)
+        return self._submit(slots, func, *args).result()
+
+    async def _run_async(self, func, *args):
+        if not self.workers:
+            return await asyncio.to_thread(func, *args)
+        slots = self._slots
+        # Waiting for a slot blocks, so unless one is free right away it
+        # happens on a thread, not on the event loop
+        if not slots.acquire(blocking=False):
+            acquiring = asyncio.get_running_loop().run_in_executor(None, self._acquire, slots)
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # A slot the thread still gets is handed straight back
+                acquiring.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() is not None or slots.release())
+                raise
+        return await asyncio.wrap_future(self._submit(slots, func, *args))
+
+    def hash(self, password):
+        return self._run(_hash, password, self.rounds)
+
+    def verify(self, password, stored):
+        if not is_bcrypt_hash(stored):
+            return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+        return self._run(_verify, password, stored)
+
+    async def hash_async(self, password):
+        return await self._run_async(_hash, password, self.rounds)
+
+    async def verify_async(self, password, stored):
+        if not is_bcrypt_hash(stored):
+            return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+        return await self._run_async(_verify, password, stored)
+
+    def needs_rehash(self, stored):
+        """
+        True if ``stored`` wasn't hashed with the configured cost factor.
+        """
+        return hash_rounds(stored) != self.rounds
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+hasher = PasswordHasher()
+hash_password = hasher.hash
+verify_password = hasher.verify
+hash_password_async = hasher.hash_async
+verify_password_async = hasher.verify_async
+needs_rehash = hasher.needs_rehash
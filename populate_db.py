@@ -1,10 +1,28 @@
+import argparse
+import calendar
+import contextlib
+import datetime
+import itertools
+import multiprocessing
+import os
+import random
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import bcrypt
 from models import TagError
 from peewee import IntegrityError
+from peewee import chunked
 from peewee import fn
 
 
-from models import db, User, Product, Tag, ProductTag, Purchase, UserProduct
+from models import db, uuid7_at, User, Product, Tag, ProductTag, Purchase, UserProduct, Session
+from autocorrect import name_index
+from sales_rollup import bulk_insert_rollup, create_sales_rollup
+from search_index import bulk_insert_indexing, create_search_index
+from tag_tree import create_tag_closure, products_under_tag
 
 
 def populate_test_database(electronics=None, apple=None):
@@ -23,7 +41,10 @@ def hash_password(password):
 
 def create_database():
     with db.atomic():
-        db.create_tables([User, Product, Tag, ProductTag, Purchase, UserProduct])
+        db.create_tables([User, Product, Tag, ProductTag, Purchase, UserProduct, Session])
+    create_search_index()
+    create_tag_closure()
+    create_sales_rollup()
 
 
 def create_user(username, name, address, zipcode, city, state, country, billing_name, billing_account, password, email):
@@ -100,15 +121,13 @@ def display_all_tags():
     print("\n")
 
 
-def display_products_by_tag(tag_name: str):
+def display_products_by_tag(tag_name: str, include_descendants=True):
     if not tag_name:
         raise TagError("Tag name cannot be empty")
     try:
-        products = (Product
-                    .select()
-                    .join(ProductTag)
-                    .join(Tag)
-                    .where(Tag.name == tag_name))
+        # Products tagged with any tag below this one count too
+        tag = Tag.get_or_none(Tag.name == tag_name)
+        products = products_under_tag(tag.id, include_descendants) if tag else []
         print(f"Products with tag: {tag_name}")
         for product in products:
             print(product.name)
@@ -584,36 +603,316 @@ def populate_test_database(electronics=None, apple=None):
     print(f"UserProduct 5 created: {created}")
 
 
-# Call database
-create_database()
+# Synthetic datasets for benchmarks.
+#
+# generate_synthetic_dataset() builds a database of any size from a seed: the
+# same seed and cardinalities always give the same rows, ids included. Product
+# popularity (and, more mildly, user activity) follows a Zipf distribution,
+# tags form a random tree, and purchases are spread over two years with more
+# of them recently. Purchases are generated in fixed-size shards, each from
+# its own seed, so the result does not depend on the number of workers; with
+# workers > 1 every shard is written to its own file by a worker process and
+# merged in shard order with ATTACH.
+
+# 1000 rows of up to 12 columns stays below SQLite's bound-variable limit.
+SYNTHETIC_BATCH_SIZE = 1000
+PURCHASE_SHARD_SIZE = 1_000_000
+PRODUCT_ZIPF_EXPONENT = 1.1
+USER_ZIPF_EXPONENT = 0.6
+SYNTHETIC_END_DATE = datetime.date(2024, 12, 31)
+SYNTHETIC_DAYS = 730
+# Every synthetic user's password is "password" (bcrypt, fixed salt so the
+# dataset stays reproducible).
+SYNTHETIC_PASSWORD = '$2b$04$SyntheticDatasetSalt..zYWgcSbevcaWioz2g7D9ZPfNL/xNpue'
+
+CITIES = [("San Francisco", "CA"), ("Los Angeles", "CA"), ("San Diego", "CA"), ("Boston", "MA"),
+          ("New York", "NY"), ("Chicago", "IL"), ("Austin", "TX"), ("Seattle", "WA"),
+          ("Portland", "OR"), ("Denver", "CO")]
+FIRST_NAMES = ["Emma", "Max", "Dan", "Alice", "Bob", "Olivia", "Liam", "Noah", "Ava", "Mia",
+               "Lucas", "Sofia", "Ethan", "Zoe", "Leo", "Nora"]
+LAST_NAMES = ["Stone", "Johnson", "Brown", "Smith", "Garcia", "Miller", "Davis", "Lopez",
+              "Wilson", "Clark", "Lee", "Young"]
+ADJECTIVES = ["Handmade", "Vintage", "Rustic", "Hand-painted", "Knitted", "Ceramic", "Wooden",
+              "Leather", "Linen", "Woven", "Recycled", "Engraved", "Glazed", "Beaded"]
+NOUNS = ["Mug", "Scarf", "Bowl", "Necklace", "Wallet", "Candle", "Vase", "Blanket", "Earrings",
+         "Notebook", "Basket", "Tote", "Coaster", "Print", "Lamp", "Planter"]
+TAG_WORDS = ["Home", "Kitchen", "Jewelry", "Art", "Textiles", "Pottery", "Woodwork", "Gifts",
+             "Decor", "Accessories", "Stationery", "Outdoor", "Kids", "Wedding", "Seasonal"]
+QUANTITIES = [1, 2, 3, 4, 5]
+QUANTITY_WEIGHTS = [70, 18, 7, 3, 2]
+
+
+def _synthetic_ids(seed, kind, count):
+    rng = random.Random(f"{seed}:{kind}:ids")
+    return [uuid.UUID(int=rng.getrandbits(128), version=4) for _ in range(count)]
+
+
+def _synthetic_prices(seed, count):
+    rng = random.Random(f"{seed}:product:prices")
+    return [round(min(rng.lognormvariate(3.4, 0.9), 5000.0), 2) for _ in range(count)]
+
+
+def _zipf_sampler(seed, kind, count, exponent):
+    """
+    (population, cumulative weights) for random.choices: rank r is drawn with
+    weight 1 / r ** exponent and the ranks are shuffled over the rows, so the
+    most popular rows are not simply the first ones inserted.
+    """
+    population = list(range(count))
+    random.Random(f"{seed}:{kind}:popularity").shuffle(population)
+    cum_weights = list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+    return population, cum_weights
+
+
+def _synthetic_datetime(rng, end_date):
+    # Skewed towards end_date: the marketplace grows over time.
+    days_ago = int(SYNTHETIC_DAYS * rng.random() ** 2)
+    return datetime.datetime.combine(end_date - datetime.timedelta(days=days_ago),
+                                     datetime.time(rng.randrange(24), rng.randrange(60)))
+
+
+def _synthetic_uuid7(rng, when):
+    # Purchase ids as models.uuid7 makes them, for a moment within the
+    # minute of ``when`` (taken as UTC, so datasets don't depend on the zone)
+    millis = calendar.timegm(when.timetuple()) * 1000 + rng.randrange(60000)
+    return uuid7_at(millis, rng.getrandbits(12), rng.getrandbits(62))
+
+
+def _insert_batches(model, fields, rows):
+    # The insert_many statement is rendered once and run with executemany:
+    # building it through peewee for every batch costs several times more
+    # than SQLite spends writing the rows. ``fields`` must include every
+    # column with a default, or peewee would bake the default into the SQL.
+    sql, params = model.insert_many([[None] * len(fields)], fields=fields).sql()
+    if len(params) != len(fields):
+        raise ValueError(f"Defaulted {model.__name__} columns are missing from the fields.")
+    converters = [field.db_value for field in fields]
+    cursor = db.cursor()
+    for batch in chunked(rows, SYNTHETIC_BATCH_SIZE):
+        cursor.executemany(sql, [[convert(value) for convert, value in zip(converters, row)]
+                                 for row in batch])
+
+
+def _generate_users(seed, count):
+    rng = random.Random(f"{seed}:users")
+    ids = _synthetic_ids(seed, 'user', count)
+    fields = [User.id, User.username, User.name, User.address, User.zipcode, User.city,
+              User.state, User.country, User.billing_name, User.billing_account,
+              User.password, User.email]
+
+    def rows():
+        for i, user_id in enumerate(ids):
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            city, state = rng.choice(CITIES)
+            yield (user_id, f"user{i}", name, f"{rng.randrange(1, 9999)} Main St",
+                   f"{rng.randrange(10000, 99999)}", city, state, "United States", name,
+                   f"{rng.randrange(10 ** 9, 10 ** 10)}", SYNTHETIC_PASSWORD, f"user{i}@example.com")
+
+    with db.atomic():
+        _insert_batches(User, fields, rows())
+
+
+def _generate_tags(seed, count, end_date):
+    rng = random.Random(f"{seed}:tags")
+    ids = _synthetic_ids(seed, 'tag', count)
+    roots = max(1, count // 50)
+
+    def rows():
+        for i, tag_id in enumerate(ids):
+            # Parents always come earlier in the list, so they are inserted first.
+            parent = ids[rng.randrange(i)] if i >= roots else None
+            yield tag_id, f"{rng.choice(TAG_WORDS)} {i}", parent, created_at, True
+
+    created_at = datetime.datetime.combine(end_date - datetime.timedelta(days=SYNTHETIC_DAYS), datetime.time())
+    with db.atomic():
+        _insert_batches(Tag, [Tag.id, Tag.name, Tag.parent, Tag.created_at, Tag.is_active], rows())
+
+
+def _generate_products(seed, count, tags, end_date):
+    rng = random.Random(f"{seed}:products")
+    ids = _synthetic_ids(seed, 'product', count)
+    prices = _synthetic_prices(seed, count)
+    tag_ids = _synthetic_ids(seed, 'tag', tags)
+
+    def product_rows():
+        for i, product_id in enumerate(ids):
+            adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+            yield (product_id, f"{adjective} {noun} {i}",
+                   f"{adjective} {noun.lower()} made by hand, item {i}",
+                   prices[i], rng.randrange(0, 500), _synthetic_datetime(rng, end_date), True)
+
+    def product_tag_rows():
+        for i, product_id in enumerate(ids):
+            created_at = _synthetic_datetime(rng, end_date)
+            for tag in rng.sample(range(tags), min(tags, rng.randint(1, 3))):
+                yield (uuid.UUID(int=rng.getrandbits(128), version=4),
+                       f"synthetic-{i}-{tag}", tag_ids[tag], product_id, created_at, True)
+
+    with db.atomic(), bulk_insert_indexing():
+        _insert_batches(Product, [Product.id, Product.name, Product.description, Product.price_per_unit,
+                                  Product.quantity_in_stock, Product.created_at, Product.is_active],
+                        product_rows())
+    if tags:
+        with db.atomic():
+            _insert_batches(ProductTag, [ProductTag.id, ProductTag.name, ProductTag.tag, ProductTag.product,
+                                         ProductTag.created_at, ProductTag.is_active], product_tag_rows())
+
+
+@lru_cache(maxsize=1)
+def _purchase_context(seed, users, products):
+    # Shared by every shard one process generates.
+    return (_synthetic_ids(seed, 'user', users),
+            _zipf_sampler(seed, 'user', users, USER_ZIPF_EXPONENT),
+            _synthetic_ids(seed, 'product', products),
+            _synthetic_prices(seed, products),
+            _zipf_sampler(seed, 'product', products, PRODUCT_ZIPF_EXPONENT))
+
+
+def _generate_purchase_shard(seed, shard, count, users, products, end_date, path=None):
+    """
+    Inserts ``count`` purchases generated from the shard's own seed, into the
+    current database or, given a ``path``, into a new database file there.
+    """
+    if path is not None:
+        # A scratch file without the user and product tables: no foreign key
+        # checks, no syncing
+        db.configure(path, profile='throughput')
+        Purchase._schema.create_table()
+    user_ids, (user_population, user_weights), product_ids, prices, (product_population, product_weights) = \
+        _purchase_context(seed, users, products)
+    rng = random.Random(f"{seed}:purchases:{shard}")
+    fields = [Purchase.id, Purchase.user, Purchase.product, Purchase.quantity, Purchase.amount, Purchase.date]
+
+    def rows():
+        for start in range(0, count, SYNTHETIC_BATCH_SIZE):
+            size = min(SYNTHETIC_BATCH_SIZE, count - start)
+            buyers = rng.choices(user_population, cum_weights=user_weights, k=size)
+            bought = rng.choices(product_population, cum_weights=product_weights, k=size)
+            quantities = rng.choices(QUANTITIES, weights=QUANTITY_WEIGHTS, k=size)
+            for user, product, quantity in zip(buyers, bought, quantities):
+                when = _synthetic_datetime(rng, end_date)
+                yield (_synthetic_uuid7(rng, when), user_ids[user], product_ids[product],
+                       quantity, round(prices[product] * quantity, 2), when.date())
+
+    with db.atomic(), bulk_insert_rollup() if path is None else contextlib.nullcontext():
+        _insert_batches(Purchase, fields, rows())
+    if path is not None:
+        # The parent reads the shard file, so nothing may stay in the WAL
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        db.close()
+    return path
+
+
+def _merge_shard(path):
+    columns = ', '.join(f'"{field.column_name}"' for field in Purchase._meta.sorted_fields)
+    table = Purchase._meta.table_name
+    # ATTACH is not allowed inside a transaction.
+    db.execute_sql('ATTACH DATABASE ? AS shard', (path,))
+    try:
+        with db.atomic(), bulk_insert_rollup():
+            db.execute_sql(f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM shard."{table}"')
+    finally:
+        db.execute_sql('DETACH DATABASE shard')
+
+
+def _generate_purchases(seed, count, users, products, end_date, workers, shard_size):
+    if not count:
+        return
+    if not users or not products:
+        raise ValueError("Purchases need at least one user and one product.")
+    shards = [(shard, min(shard_size, count - start))
+              for shard, start in enumerate(range(0, count, shard_size))]
+    if workers <= 1 or len(shards) == 1:
+        for shard, size in shards:
+            _generate_purchase_shard(seed, shard, size, users, products, end_date)
+        return
+
+    # spawn, so that workers don't inherit the parent's open connection.
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(_generate_purchase_shard, seed, shard, size, users, products, end_date,
+                               os.path.join(tmp, f"purchases-{shard}.db"))
+                   for shard, size in shards]
+        # Merged in shard order, whichever worker finishes first.
+        for future in futures:
+            path = future.result()
+            _merge_shard(path)
+            os.remove(path)
+
+
+def generate_synthetic_dataset(users=1000, products=200, tags=50, purchases=10000, seed=0,
+                               workers=1, end_date=SYNTHETIC_END_DATE, shard_size=PURCHASE_SHARD_SIZE):
+    """
+    Adds a reproducible synthetic dataset of the given size to the database,
+    e.g. generate_synthetic_dataset(1_000_000, 200_000, 5_000, 20_000_000, workers=8).
+    Returns the number of rows generated per table.
+    """
+    if min(users, products, tags, purchases) < 0:
+        raise ValueError("Dataset sizes cannot be negative.")
+    create_database()
+    _generate_users(seed, users)
+    _generate_tags(seed, tags, end_date)
+    _generate_products(seed, products, tags, end_date)
+    _generate_purchases(seed, purchases, users, products, end_date, workers, shard_size)
+    # The typo index reloads the new names on its next lookup.
+    name_index.reset()
+    return {'users': users, 'products': products, 'tags': tags, 'purchases': purchases}
+
+
+def populate_demo_database():
+    # Call database
+    create_database()
+
+
+    # Call the populate function to populate the database
+    populate_test_database()
+
 
+    # Call the display_all_users function to display all users in the database
+    display_all_users()
 
-# Call the populate function to populate the database
-populate_test_database()
 
+    # Call display all products
+    display_all_products()
 
-# Call the display_all_users function to display all users in the database
-display_all_users()
 
+    # Call all purchases
+    display_all_purchases()
 
-# Call display all products
-display_all_products()
 
+    # call all tags 
+    display_all_tags()
 
-# Call all purchases
-display_all_purchases()
 
+    # Call all products by tag
+    display_all_products_by_tag("Electronics, Apple, Wireless, AirPods, Headphones, Laptops, iPhone, AirPods Pro, MacBook Pro")
 
-# call all tags 
-display_all_tags()
 
+    # Call all user products
+    display_all_user_products()
 
-# Call all products by tag
-display_all_products_by_tag("Electronics, Apple, Wireless, AirPods, Headphones, Laptops, iPhone, AirPods Pro, MacBook Pro")
 
+    print("Test database created and populated successfully.")
 
-# Call all user products
-display_all_user_products()
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Populate the database with demo or synthetic data.")
+    parser.add_argument("--synthetic", action="store_true", help="generate a synthetic benchmark dataset")
+    parser.add_argument("--db", help="database file (default: betsy.db)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--purchases", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="processes generating purchase shards")
+    args = parser.parse_args()
 
-print("Test database created and populated successfully.")
+    if args.db:
+        db.init(args.db)
+    if args.synthetic:
+        counts = generate_synthetic_dataset(args.users, args.products, args.tags, args.purchases,
+                                            seed=args.seed, workers=args.workers)
+        print("Generated " + ", ".join(f"{count} {table}" for table, count in counts.items()) + ".")
+    else:
+        populate_demo_database()
@@ -0,0 +1,139 @@
+"""
+In-process read-through cache for product lookups (get_product_details).
+
+Entries are bounded in number (least recently used go first) and in age
+(``ttl`` seconds). Every db_operations function that changes a product, its
+stock or its tags invalidates that product: once right away and once more
+when the surrounding transaction commits, so a reader racing the writer
+can't put the old row back. A load that overlaps any invalidation is
+returned but not cached.
+
+    product_cache.stats()     # hits, misses, evictions, expirations, ...
+    with product_cache.disabled():
+        ...
+
+BETSY_PRODUCT_CACHE=0 turns the cache off; BETSY_PRODUCT_CACHE_SIZE and
+BETSY_PRODUCT_CACHE_TTL set its bounds. Cached values are copied on the way
+out, so callers may modify what they get.
+"""
+import contextlib
+import copy
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from models import db
+
+
+ENABLED = os.environ.get("BETSY_PRODUCT_CACHE", "1") != "0"
+DEFAULT_MAX_SIZE = int(os.environ.get("BETSY_PRODUCT_CACHE_SIZE", "10000"))
+DEFAULT_TTL = float(os.environ.get("BETSY_PRODUCT_CACHE_TTL", "60"))
+
+
+class ProductCache:
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, enabled=ENABLED, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; loads that saw it change aren't stored
+        self._generation = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(product_id):
+        try:
+            return product_id if isinstance(product_id, uuid.UUID) else uuid.UUID(str(product_id))
+        except ValueError:
+            return None
+
+    def get(self, product_id, load):
+        """
+        The cached value for ``product_id``, or ``load(product_id)``, which
+        is cached if it is a dict (lookup failures are not).
+        """
+        key = self._key(product_id)
+        if not self.enabled or key is None:
+            return load(product_id)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+
+        value = load(product_id)
+        if isinstance(value, dict):
+            stored = copy.deepcopy(value)
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = (now + self.ttl, stored)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+        return value
+
+    def _drop(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate(self, *product_ids):
+        """
+        Drops the given products now and again when the current transaction
+        commits.
+        """
+        keys = [key for key in map(self._key, product_ids) if key is not None]
+        self._drop(keys)
+        if db.in_transaction():
+            db.after_commit(lambda: self._drop(keys))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    @contextlib.contextmanager
+    def disabled(self):
+        enabled, self.enabled = self.enabled, False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+product_cache = ProductCache()
@@ -0,0 +1,273 @@
+"""
+Per-operation SQL statistics for the shared database.
+
+The database in models.py runs every statement through QueryStatsMixin. While
+a QueryProfile is active, each statement is attributed to the operation that
+issued it and counted, timed and charged for the rows it returned. A
+statement shape repeating more than ``repeat_threshold`` times inside one
+call of an operation is logged as a likely N+1 query; the counts start over
+every time the operation is entered, so an operation called many times
+with one statement each isn't flagged.
+
+    with profile_queries() as profile:
+        db_operations.list_orders()
+    print(profile.summary())
+
+With ``capture_params=True`` the parameters of the first execution of each
+statement shape are kept too, so the statements can be replayed (see
+index_advisor.py).
+
+The operation is the outermost db_operations/main function on the call stack,
+or the name given with ``operation(...)``. With no profile active the only
+overhead is one list check per statement.
+
+Profiles are process-wide: an active profile sees the statements of every
+thread, e.g. those the async_operations workers run for the caller.
+"""
+import contextlib
+import contextvars
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT_THRESHOLD = 10
+OPERATION_MODULES = ('db_operations', 'main')
+UNATTRIBUTED = '<unattributed>'
+
+_operation = contextvars.ContextVar('query_stats_operation', default=None)
+# Process-wide, not per thread or context; see the module docstring
+_profiles = []
+_profiles_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def operation(name):
+    """
+    Attributes the statements issued inside the block to ``name``.
+    """
+    # The object marks this entry, so repeat counts start over
+    token = _operation.set((name, object()))
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def current_activation():
+    """
+    (operation name, activation), where the activation is an object that
+    stays the same for the statements of one call of the operation: the
+    outermost operation frame, or a marker set by ``operation()``.
+    """
+    named = _operation.get()
+    if named is not None:
+        return named
+    outermost = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_globals.get('__name__') in OPERATION_MODULES:
+            outermost = frame
+        frame = frame.f_back
+    if outermost is None:
+        return UNATTRIBUTED, None
+    return f"{outermost.f_globals['__name__']}.{outermost.f_code.co_name}", outermost
+
+
+def current_operation():
+    return current_activation()[0]
+
+
+class OperationStats:
+    def __init__(self):
+        self.queries = 0
+        self.total_time = 0.0
+        self.rows = 0
+        # Lifetime count of each statement shape
+        self.totals = Counter()
+        # Most repeats of each shape within one call
+        self.peaks = Counter()
+        # thread id -> (activation, shape counts of that call)
+        self.shapes = {}
+        self.params = {}
+
+    def count_shape(self, sql, activation):
+        thread = threading.get_ident()
+        current = self.shapes.get(thread)
+        if current is None or activation is None or current[0] is not activation:
+            # Entered again: the previous call's counts are done with. Without
+            # an activation (unattributed) every statement counts on its own.
+            current = self.shapes[thread] = (activation, Counter())
+        counts = current[1]
+        counts[sql] += 1
+        self.totals[sql] += 1
+        if counts[sql] > self.peaks[sql]:
+            self.peaks[sql] = counts[sql]
+        return counts[sql]
+
+    def as_dict(self, repeat_threshold):
+        return {
+            'queries': self.queries,
+            'total_time': self.total_time,
+            'rows': self.rows,
+            'repeated': {sql: count for sql, count in self.peaks.most_common()
+                         if count > repeat_threshold},
+        }
+
+
+class QueryProfile:
+    """
+    Collects statement statistics while active. ``sample_rate`` below 1 keeps
+    only that fraction of activations, for always-on production sampling.
+    """
+    def __init__(self, repeat_threshold=DEFAULT_REPEAT_THRESHOLD, sample_rate=1.0, capture_params=False):
+        self.repeat_threshold = repeat_threshold
+        self.sample_rate = sample_rate
+        self.capture_params = capture_params
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return self
+        with _profiles_lock:
+            _profiles.append(self)
+        return self
+
+    def stop(self):
+        with _profiles_lock:
+            if self in _profiles:
+                _profiles.remove(self)
+        with self._lock:
+            # Lets go of the operation frames
+            for stats in self.operations.values():
+                stats.shapes.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def record(self, operation_name, sql, elapsed, params=None, activation=None):
+        with self._lock:
+            stats = self.operations.get(operation_name)
+            if stats is None:
+                stats = self.operations[operation_name] = OperationStats()
+            stats.queries += 1
+            stats.total_time += elapsed
+            repeats = stats.count_shape(sql, activation)
+            if self.capture_params and sql not in stats.params:
+                stats.params[sql] = tuple(params or ())
+        if repeats == self.repeat_threshold + 1:
+            logger.warning(
+                f"Possible N+1 query in {operation_name}: statement repeated "
+                f"more than {self.repeat_threshold} times: {sql}")
+        return stats
+
+    def add_rows(self, stats, count):
+        with self._lock:
+            stats.rows += count
+
+    def count(self, operation_name=None):
+        """
+        Number of statements issued by one operation, or by all of them.
+        """
+        if operation_name is not None:
+            stats = self.operations.get(operation_name)
+            return stats.queries if stats else 0
+        return sum(stats.queries for stats in self.operations.values())
+
+    def statements(self):
+        """
+        [(operation, sql, params)] for every statement shape seen, with the
+        parameters of its first execution (needs ``capture_params``).
+        """
+        with self._lock:
+            return [(name, sql, stats.params.get(sql, ()))
+                    for name, stats in self.operations.items() for sql in stats.totals]
+
+    def report(self):
+        """
+        {operation: {'queries', 'total_time', 'rows', 'repeated'}}
+        """
+        with self._lock:
+            return {name: stats.as_dict(self.repeat_threshold)
+                    for name, stats in self.operations.items()}
+
+    def summary(self):
+        lines = [f"{'operation':40} {'queries':>8} {'time (ms)':>10} {'rows':>8}"]
+        report = self.report()
+        for name, stats in sorted(report.items(), key=lambda item: -item[1]['total_time']):
+            lines.append(f"{name:40} {stats['queries']:>8} "
+                         f"{stats['total_time'] * 1000:>10.2f} {stats['rows']:>8}")
+            for sql, count in stats['repeated'].items():
+                lines.append(f"    repeated {count}x: {sql}")
+        return "\n".join(lines)
+
+
+def profile_queries(repeat_threshold=DEFAULT_REPEAT_THRESHOLD, sample_rate=1.0, capture_params=False):
+    return QueryProfile(repeat_threshold, sample_rate, capture_params)
+
+
+class _CountingCursor:
+    """
+    Wraps a DB-API cursor and charges every fetched row to the profiles.
+    """
+    __slots__ = ('_cursor', '_charges')
+
+    def __init__(self, cursor, charges):
+        self._cursor = cursor
+        self._charges = charges
+
+    def _add_rows(self, count):
+        for profile, stats in self._charges:
+            profile.add_rows(stats, count)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._add_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._add_rows(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryStatsMixin:
+    """
+    Database mixin feeding every executed statement to the active profiles.
+    """
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not _profiles:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        operation_name, activation = current_activation()
+        start = time.perf_counter()
+        cursor = super().execute_sql(sql, params, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with _profiles_lock:
+            profiles = list(_profiles)
+        charges = [(profile, profile.record(operation_name, sql, elapsed, params, activation))
+                   for profile in profiles]
+        return _CountingCursor(cursor, charges)
+
@@ -0,0 +1,174 @@
+"""
+Best sellers: the top N products overall, under a tag, or over the last
+few days, ranked by units sold.
+
+Rankings never aggregate the purchase table. Lifetime totals come from
+models.ProductSales, read through its units index, and windows from the
+daily rows of models.DailySales; sales_rollup.py keeps both current on
+every purchase.
+
+    rankings.top_products(10)
+    rankings.top_products(10, tag_id=electronics.id, days=7)
+
+How fresh the lists are is the refresh strategy's choice:
+
+- ``sync`` (default): every call reads the rollups, so a purchase shows
+  up in the next call.
+- ``periodic``: lists are cached and served until they are
+  ``max_staleness`` seconds old, then recomputed by the caller that finds
+  them stale. ``start()`` adds a background thread that refreshes every
+  cached list more often than that, so callers rarely wait. Either way a
+  list is never older than ``max_staleness``.
+
+BETSY_RANKINGS_STRATEGY and BETSY_RANKINGS_MAX_STALENESS set the defaults
+of the module instance.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import fn
+
+from models import db, reading, DailySales, Product, ProductSales, ProductTag, TagClosure
+from sales_rollup import total_amount
+
+
+logger = logging.getLogger(__name__)
+
+SYNC = 'sync'
+PERIODIC = 'periodic'
+STRATEGIES = (SYNC, PERIODIC)
+DEFAULT_STRATEGY = os.environ.get("BETSY_RANKINGS_STRATEGY", SYNC)
+DEFAULT_MAX_STALENESS = float(os.environ.get("BETSY_RANKINGS_MAX_STALENESS", "60"))
+# Distinct (n, tag, days) lists kept by the periodic strategy
+MAX_CACHED_LISTS = 1000
+
+
+def _tagged(tag_id, include_descendants):
+    tagged = ProductTag.select(ProductTag.product)
+    if include_descendants:
+        return (tagged
+                .join(TagClosure, on=(TagClosure.descendant == ProductTag.tag))
+                .where(TagClosure.ancestor == tag_id))
+    return tagged.where(ProductTag.tag == tag_id)
+
+
+def compute_top_products(n=10, tag_id=None, days=None, include_descendants=True, today=None):
+    """
+    The ``n`` products that sold the most units, best first, as
+    [{'product_id', 'name', 'units', 'amount'}]: of all time, or over the
+    last ``days`` days including today, optionally only under ``tag_id``.
+    """
+    if days is None:
+        units, amount = ProductSales.units, ProductSales.amount
+        query = ProductSales.select(ProductSales.product, units, amount)
+        product = ProductSales.product
+    else:
+        today = today or datetime.date.today()
+        units = fn.SUM(DailySales.units)
+        amount = total_amount(DailySales.amount)
+        query = (DailySales
+                 .select(DailySales.product, units.alias('units'), amount.alias('amount'))
+                 .where(DailySales.date > today - datetime.timedelta(days=days))
+                 .group_by(DailySales.product))
+        product = DailySales.product
+    if tag_id is not None:
+        query = query.where(product.in_(_tagged(tag_id, include_descendants)))
+    ranked = query.order_by(units.desc(), product.desc()).limit(n).alias('ranked')
+    rows = (Product
+            .select(Product.id, Product.name, ranked.c.units, ranked.c.amount)
+            .join(ranked, on=(Product.id == ranked.c.product_id))
+            .order_by(ranked.c.units.desc(), Product.id.desc())
+            .tuples())
+    with reading():
+        return [{'product_id': product_id, 'name': name, 'units': units,
+                 'amount': ProductSales.amount.python_value(amount)}
+                for product_id, name, units, amount in rows]
+
+
+class Rankings:
+    def __init__(self, strategy=DEFAULT_STRATEGY, max_staleness=DEFAULT_MAX_STALENESS, clock=time.monotonic):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown ranking strategy '{strategy}'. Choose one of: {', '.join(STRATEGIES)}.")
+        self.strategy = strategy
+        self.max_staleness = max_staleness
+        self.clock = clock
+        self._lists = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+    def top_products(self, n=10, tag_id=None, days=None, include_descendants=True):
+        """
+        See compute_top_products; under the periodic strategy the list may
+        be up to ``max_staleness`` seconds old.
+        """
+        if self.strategy == SYNC:
+            return compute_top_products(n, tag_id, days, include_descendants)
+        key = (n, None if tag_id is None else str(tag_id), days, include_descendants)
+        with self._lock:
+            cached = self._lists.get(key)
+            if cached is not None:
+                self._lists.move_to_end(key)
+        if cached is not None and self.clock() - cached[0] < self.max_staleness:
+            return list(cached[1])
+        return list(self._refresh(key))
+
+    def _refresh(self, key):
+        n, tag_id, days, include_descendants = key
+        computed_at = self.clock()
+        result = compute_top_products(n, tag_id, days, include_descendants)
+        with self._lock:
+            self._lists[key] = (computed_at, result)
+            self._lists.move_to_end(key)
+            while len(self._lists) > MAX_CACHED_LISTS:
+                self._lists.popitem(last=False)
+        return result
+
+    def refresh(self):
+        """
+        Recomputes every cached list now.
+        """
+        with self._lock:
+            keys = list(self._lists)
+        for key in keys:
+            self._refresh(key)
+
+    def clear(self):
+        with self._lock:
+            self._lists.clear()
+
+    def start(self, interval=None):
+        """
+        Refreshes the cached lists every ``interval`` seconds (half of
+        ``max_staleness`` by default) on a background thread.
+        """
+        if self._thread is not None:
+            return
+        interval = self.max_staleness / 2 if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval, self._stop),
+                                        name='rankings-refresh', daemon=True)
+        self._thread.start()
+
+    def _run(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                with db.connection_context():
+                    self.refresh()
+            except Exception:
+                logger.exception("Refreshing the rankings failed.")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+rankings = Rankings()
+top_products = rankings.top_products
@@ -0,0 +1,180 @@
+"""
+Sales rollups, backed by models.DailySales and models.ProductSales.
+
+The triggers below add every purchase to its (day, product, category) row
+and to its product's lifetime totals as it is inserted, and move or
+subtract it when it is updated or deleted, in the same transaction as the
+purchase itself, whichever code path wrote it. Revenue dashboards then
+read one row per product and day instead of every purchase, and best
+seller lists (rankings.py) one row per product:
+
+    sales_rollup.daily_revenue(since=datetime.date(2024, 1, 1))
+    sales_rollup.monthly_revenue(product_id=mug.id)
+
+To rebuild both rollups from the purchase table:
+
+    python sales_rollup.py --rebuild
+"""
+import argparse
+import contextlib
+import logging
+
+from peewee import fn
+
+from models import db, DailySales, ProductSales
+
+
+logger = logging.getLogger(__name__)
+
+# Purchases with no usable date aren't counted per day.
+_ADD = """
+    INSERT INTO dailysales(date, product_id, category, purchases, units, amount)
+    SELECT date(new.date), new.product_id, coalesce(new.category, ''), 1, new.quantity, round(new.amount, 2)
+    WHERE date(new.date) IS NOT NULL
+    ON CONFLICT(date, product_id, category) DO UPDATE SET
+        purchases = purchases + 1, units = units + excluded.units, amount = round(amount + excluded.amount, 2);
+    INSERT INTO productsales(product_id, purchases, units, amount)
+    VALUES (new.product_id, 1, new.quantity, round(new.amount, 2))
+    ON CONFLICT(product_id) DO UPDATE SET
+        purchases = purchases + 1, units = units + excluded.units, amount = round(amount + excluded.amount, 2);
+"""
+
+_SUBTRACT = """
+    UPDATE dailysales
+    SET purchases = purchases - 1, units = units - old.quantity, amount = round(amount - old.amount, 2)
+    WHERE date = date(old.date) AND product_id = old.product_id AND category = coalesce(old.category, '');
+    DELETE FROM dailysales
+    WHERE date = date(old.date) AND product_id = old.product_id AND category = coalesce(old.category, '')
+      AND purchases <= 0;
+    UPDATE productsales
+    SET purchases = purchases - 1, units = units - old.quantity, amount = round(amount - old.amount, 2)
+    WHERE product_id = old.product_id;
+    DELETE FROM productsales WHERE product_id = old.product_id AND purchases <= 0;
+"""
+
+INSERT_TRIGGER = f"CREATE TRIGGER daily_sales_ai AFTER INSERT ON purchase BEGIN {_ADD} END;"
+
+TRIGGERS = {
+    'daily_sales_ai': INSERT_TRIGGER,
+    'daily_sales_au': f"""
+    CREATE TRIGGER daily_sales_au
+    AFTER UPDATE OF date, product_id, category, quantity, amount ON purchase BEGIN {_SUBTRACT} {_ADD} END;
+    """,
+    'daily_sales_ad': f"CREATE TRIGGER daily_sales_ad AFTER DELETE ON purchase BEGIN {_SUBTRACT} END;",
+}
+
+
+def create_sales_rollup():
+    """
+    Creates the rollup tables and (re)creates their triggers. Rollups that
+    didn't exist yet are filled from the existing purchases.
+    """
+    created = not DailySales.table_exists() or not ProductSales.table_exists()
+    with db.atomic():
+        db.create_tables([DailySales, ProductSales])
+        # Recreated so a database keeps no triggers from an older version
+        for name, trigger in TRIGGERS.items():
+            db.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+            db.execute_sql(trigger)
+        if created:
+            _clear()
+            _aggregate()
+
+
+def _clear():
+    DailySales.delete().execute()
+    ProductSales.delete().execute()
+
+
+def _aggregate(after_rowid=0):
+    # Adds the purchases past ``after_rowid`` to the rollups, one row per group
+    db.execute_sql(
+        'INSERT INTO dailysales(date, product_id, category, purchases, units, amount) '
+        'SELECT date(date), product_id, coalesce(category, \'\'), count(*), sum(quantity), round(sum(amount), 2) '
+        'FROM purchase WHERE rowid > ? AND date(date) IS NOT NULL GROUP BY 1, 2, 3 '
+        'ON CONFLICT(date, product_id, category) DO UPDATE SET '
+        'purchases = purchases + excluded.purchases, units = units + excluded.units, '
+        'amount = round(amount + excluded.amount, 2)', (after_rowid,))
+    db.execute_sql(
+        'INSERT INTO productsales(product_id, purchases, units, amount) '
+        'SELECT product_id, count(*), sum(quantity), round(sum(amount), 2) '
+        'FROM purchase WHERE rowid > ? GROUP BY 1 '
+        'ON CONFLICT(product_id) DO UPDATE SET '
+        'purchases = purchases + excluded.purchases, units = units + excluded.units, '
+        'amount = round(amount + excluded.amount, 2)', (after_rowid,))
+
+
+def rebuild_sales_rollup():
+    """
+    Recomputes both rollups from the purchase table.
+    """
+    with db.atomic():
+        _clear()
+        _aggregate()
+    logger.info("Sales rollups rebuilt.")
+
+
+@contextlib.contextmanager
+def bulk_insert_rollup():
+    """
+    For large appends to the purchase table, inside a write transaction: the
+    per-row insert trigger is suspended and the new purchases are added to
+    the rollups with grouped INSERT ... SELECTs when the block ends.
+    """
+    if not db.in_transaction():
+        raise RuntimeError("bulk_insert_rollup() must run inside a transaction.")
+    last_rowid = db.execute_sql('SELECT max(rowid) FROM purchase').fetchone()[0] or 0
+    db.execute_sql('DROP TRIGGER IF EXISTS daily_sales_ai')
+    yield
+    _aggregate(last_rowid)
+    db.execute_sql(INSERT_TRIGGER)
+
+
+def total_amount(field):
+    """
+    SUM of an amount column, rounded to cents: amounts are stored as floats.
+    """
+    return fn.ROUND(fn.SUM(field), 2).python_value(field.python_value)
+
+
+def _sales(period, since=None, until=None, product_id=None, category=None):
+    query = (DailySales
+             .select(period.alias('period'),
+                     fn.SUM(DailySales.purchases).alias('purchases'),
+                     fn.SUM(DailySales.units).alias('units'),
+                     total_amount(DailySales.amount).alias('amount')))
+    if since is not None:
+        query = query.where(DailySales.date >= since)
+    if until is not None:
+        query = query.where(DailySales.date < until)
+    if product_id is not None:
+        query = query.where(DailySales.product == product_id)
+    if category is not None:
+        query = query.where(DailySales.category == category)
+    return list(query.group_by(period).order_by(period).dicts())
+
+
+def daily_revenue(since=None, until=None, product_id=None, category=None):
+    """
+    [{'period': date, 'purchases', 'units', 'amount'}] per day from
+    ``since`` up to but not including ``until``, optionally for one
+    product and/or category.
+    """
+    return _sales(DailySales.date, since, until, product_id, category)
+
+
+def monthly_revenue(since=None, until=None, product_id=None, category=None):
+    """
+    Like daily_revenue, per month ('YYYY-MM').
+    """
+    return _sales(fn.strftime('%Y-%m', DailySales.date), since, until, product_id, category)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the sales rollups.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the rollups from the purchase table")
+    args = parser.parse_args()
+
+    create_sales_rollup()
+    if args.rebuild:
+        rebuild_sales_rollup()
@@ -0,0 +1,133 @@
+"""
+Full-text product search backed by the SQLite FTS5 table in models.ProductIndex.
+
+The index is an external-content table over ``product``; the triggers below
+keep it in sync on every insert, update and delete. To rebuild it from the
+existing Product rows (e.g. after a VACUUM, which may renumber rowids):
+
+    python search_index.py --rebuild
+"""
+import argparse
+import contextlib
+import logging
+import re
+
+from models import db, Product, ProductIndex
+
+
+logger = logging.getLogger(__name__)
+
+INSERT_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS product_index_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_index(rowid, id, name, description)
+        VALUES (new.rowid, new.id, new.name, new.description);
+    END;
+"""
+
+TRIGGERS = (
+    INSERT_TRIGGER,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_index_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_index(product_index, rowid, id, name, description)
+        VALUES ('delete', old.rowid, old.id, old.name, old.description);
+    END;
+    """,
+    # Only text changes touch the index; stock and price updates skip it.
+    """
+    CREATE TRIGGER IF NOT EXISTS product_index_au AFTER UPDATE OF name, description ON product
+    WHEN old.name IS NOT new.name OR old.description IS NOT new.description BEGIN
+        INSERT INTO product_index(product_index, rowid, id, name, description)
+        VALUES ('delete', old.rowid, old.id, old.name, old.description);
+        INSERT INTO product_index(rowid, id, name, description)
+        VALUES (new.rowid, new.id, new.name, new.description);
+    END;
+    """,
+)
+
+DEFAULT_PER_PAGE = 20
+
+# bm25 column weights, in column order (id, name, description): a hit in the
+# product name counts for much more than one in the description.
+BM25_WEIGHTS = (0.0, 10.0, 1.0)
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def create_search_index():
+    """
+    Creates the FTS5 table and its sync triggers if they don't exist yet.
+    A freshly created index is populated from the existing products.
+    """
+    created = not ProductIndex.table_exists()
+    with db.atomic():
+        ProductIndex.create_table(safe=True)
+        # Older databases carry an update trigger that fired on every column.
+        db.execute_sql('DROP TRIGGER IF EXISTS product_index_au')
+        for trigger in TRIGGERS:
+            db.execute_sql(trigger)
+        if created:
+            ProductIndex.rebuild()
+
+
+def rebuild_search_index():
+    """
+    Re-reads every Product row into the index.
+    """
+    with db.atomic():
+        ProductIndex.rebuild()
+    logger.info("Product search index rebuilt.")
+
+
+@contextlib.contextmanager
+def bulk_insert_indexing():
+    """
+    For large appends to the product table, inside a write transaction: the
+    per-row insert trigger is suspended and the new rows are indexed with one
+    INSERT ... SELECT when the block ends, which is an order of magnitude
+    faster. An error rolls the trigger removal back with the transaction.
+    """
+    if not db.in_transaction():
+        raise RuntimeError("bulk_insert_indexing() must run inside a transaction.")
+    last_rowid = db.execute_sql('SELECT max(rowid) FROM product').fetchone()[0] or 0
+    db.execute_sql('DROP TRIGGER IF EXISTS product_index_ai')
+    yield
+    db.execute_sql(
+        'INSERT INTO product_index(rowid, id, name, description) '
+        'SELECT rowid, id, name, description FROM product WHERE rowid > ?', (last_rowid,))
+    db.execute_sql(INSERT_TRIGGER)
+
+
+def match_expression(term):
+    """
+    Turns free text into an FTS5 query: every word must match, as a prefix.
+    Words are quoted so user input can never inject FTS5 syntax.
+    """
+    tokens = _token_re.findall(term or '')
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_products(term, page=1, per_page=DEFAULT_PER_PAGE):
+    """
+    Returns the products matching ``term`` ordered by bm25 relevance (best
+    first), one page at a time. Each product carries its ``score``.
+    """
+    expression = match_expression(term)
+    if not expression:
+        return []
+    rank = ProductIndex.bm25(*BM25_WEIGHTS)
+    return (Product
+            .select(Product, rank.alias('score'))
+            .join(ProductIndex, on=(Product.id == ProductIndex.id))
+            .where(ProductIndex.match(expression))
+            .order_by(rank)
+            .paginate(page, per_page))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the product search index.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the index from the product table")
+    args = parser.parse_args()
+
+    create_search_index()
+    if args.rebuild:
+        rebuild_search_index()
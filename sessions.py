@@ -0,0 +1,221 @@
+"""
+Session tokens, so a signed-in user proves who they are without a bcrypt
+check on every request.
+
+    token = sessions.issue(user.id)
+    sessions.validate(token)        # the user's id, or None
+    sessions.revoke(token)
+    sessions.revoke_user(user.id)   # every session of the user, e.g. after a password change
+
+Sessions live in the models.Session table, keyed by the SHA-256 of the
+token, and the ones in use are kept in an in-memory LRU in front of it.
+Validating a cached token is a hash and a dict lookup; only the first
+validation in a process, or one after ``recheck`` seconds, reads the
+table, so a session revoked by another process is noticed within that
+time. Revocations made here take effect immediately.
+
+Expired sessions are deleted when a validation runs into them, and
+``sweep()`` deletes the rest in one indexed range delete; ``start()``
+sweeps every ``interval`` seconds on a background thread.
+
+BETSY_SESSION_TTL (seconds, default 7 days), BETSY_SESSION_CACHE_SIZE,
+BETSY_SESSION_RECHECK and BETSY_SESSION_SWEEP_INTERVAL set the defaults
+of the module instance.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, reading, Session
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = float(os.environ.get("BETSY_SESSION_TTL", str(7 * 24 * 3600)))
+DEFAULT_MAX_SIZE = int(os.environ.get("BETSY_SESSION_CACHE_SIZE", "100000"))
+DEFAULT_RECHECK = float(os.environ.get("BETSY_SESSION_RECHECK", "30"))
+DEFAULT_SWEEP_INTERVAL = float(os.environ.get("BETSY_SESSION_SWEEP_INTERVAL", "300"))
+TOKEN_BYTES = 32
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _user_id(user):
+    # A user, or its id as a UUID or string, as the UUID read back from the table
+    return Session.user.python_value(Session.user.db_value(user))
+
+
+class SessionStore:
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, recheck=DEFAULT_RECHECK,
+                 clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.recheck = recheck
+        # Wall clock seconds: expiry times are stored in the table
+        self.clock = clock
+        # token hash -> (user id, expires, trusted until)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every revocation; loads that saw it change aren't stored
+        self._generation = 0
+        self._stop = None
+        self._thread = None
+
+    def _datetime(self, seconds):
+        return datetime.datetime.fromtimestamp(seconds)
+
+    def _store(self, key, user_id, expires, now, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (user_id, expires, min(expires, now + self.recheck))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def issue(self, user_id, ttl=None):
+        """
+        Starts a session for ``user_id`` lasting ``ttl`` seconds (the
+        store's default if None) and returns its token.
+        """
+        user_id = _user_id(user_id)
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        key = token_hash(token)
+        now = self.clock()
+        expires = now + (self.ttl if ttl is None else ttl)
+        Session.create(token_hash=key, user=user_id, created_at=self._datetime(now),
+                       expires_at=self._datetime(expires))
+        self._store(key, user_id, expires, now)
+        return token
+
+    def validate(self, token):
+        """
+        The id of the user ``token`` belongs to, or None if it is unknown,
+        revoked or expired.
+        """
+        if not token:
+            return None
+        key = token_hash(token)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user_id, expires, trusted_until = entry
+                if now < trusted_until:
+                    self._entries.move_to_end(key)
+                    return user_id
+                del self._entries[key]
+            generation = self._generation
+
+        with reading():
+            row = (Session
+                   .select(Session.user, Session.expires_at)
+                   .where(Session.token_hash == key)
+                   .tuples()
+                   .first())
+        if row is None:
+            return None
+        user_id, expires_at = row
+        expires = expires_at.timestamp()
+        if expires <= now:
+            # Lazy purge; the transaction sends it to the writer connection
+            # when called from a read operation
+            with db.atomic():
+                (Session
+                 .delete()
+                 .where((Session.token_hash == key) & (Session.expires_at <= self._datetime(now)))
+                 .execute())
+            return None
+        self._store(key, user_id, expires, now, generation)
+        return user_id
+
+    def _drop(self, match):
+        with self._lock:
+            self._generation += 1
+            for key in [key for key, entry in self._entries.items() if match(key, entry)]:
+                del self._entries[key]
+
+    def _forget(self, match):
+        # Now, and again when the transaction commits, so a validation racing
+        # the revocation can't cache the session again
+        self._drop(match)
+        if db.in_transaction():
+            db.after_commit(lambda: self._drop(match))
+
+    def revoke(self, token):
+        """
+        Ends the session of ``token``; returns whether there was one.
+        """
+        key = token_hash(token)
+        deleted = Session.delete().where(Session.token_hash == key).execute()
+        self._forget(lambda entry_key, entry: entry_key == key)
+        return deleted > 0
+
+    def revoke_user(self, user_id):
+        """
+        Ends every session of ``user_id``; returns how many there were.
+        """
+        user_id = _user_id(user_id)
+        deleted = Session.delete().where(Session.user == user_id).execute()
+        self._forget(lambda entry_key, entry: entry[0] == user_id)
+        return deleted
+
+    def sweep(self):
+        """
+        Deletes every expired session; returns how many there were.
+        """
+        now = self.clock()
+        deleted = Session.delete().where(Session.expires_at <= self._datetime(now)).execute()
+        self._forget(lambda entry_key, entry: entry[1] <= now)
+        if deleted:
+            logger.info(f"{deleted} expired sessions deleted.")
+        return deleted
+
+    def clear(self):
+        """
+        Empties the in-memory cache; the sessions themselves stay valid.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def start(self, interval=DEFAULT_SWEEP_INTERVAL):
+        """
+        Sweeps expired sessions every ``interval`` seconds on a background
+        thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval, self._stop),
+                                        name='session-sweep', daemon=True)
+        self._thread.start()
+
+    def _run(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                with db.connection_context():
+                    self.sweep()
+            except Exception:
+                logger.exception("Sweeping expired sessions failed.")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+sessions = SessionStore()
+issue = sessions.issue
+validate = sessions.validate
+revoke = sessions.revoke
+revoke_user = sessions.revoke_user
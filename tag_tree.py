@@ -0,0 +1,148 @@
+"""
+The tag hierarchy, backed by the closure table in models.TagClosure.
+
+The triggers below keep the closure in sync with ``tag.parent_id`` on every
+insert, reparenting and delete, touching only the moved subtree. Moving a
+tag under one of its own descendants is refused. "Products under a tag,
+including all its descendants" is then one indexed query:
+
+    tag_tree.products_under_tag(electronics.id)
+
+To rebuild the closure from the tag table:
+
+    python tag_tree.py --rebuild
+"""
+import argparse
+import logging
+
+from models import db, Product, ProductTag, Tag, TagClosure
+
+
+logger = logging.getLogger(__name__)
+
+# Rebuilds stop at this depth, so a cycle already in the data can't recurse forever.
+MAX_DEPTH = 1000
+
+TRIGGERS = (
+    # A new tag is its own ancestor and inherits its parent's ancestors.
+    """
+    CREATE TRIGGER IF NOT EXISTS tag_closure_ai AFTER INSERT ON tag BEGIN
+        INSERT INTO tagclosure(ancestor_id, descendant_id, depth) VALUES (new.id, new.id, 0);
+        INSERT INTO tagclosure(ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, new.id, depth + 1 FROM tagclosure WHERE descendant_id = new.parent_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tag_closure_bu BEFORE UPDATE OF parent_id ON tag
+    WHEN new.parent_id IS NOT NULL AND old.parent_id IS NOT new.parent_id BEGIN
+        SELECT RAISE(ABORT, 'A tag cannot be moved under itself or its descendants.')
+        WHERE EXISTS (SELECT 1 FROM tagclosure WHERE ancestor_id = new.id AND descendant_id = new.parent_id);
+    END;
+    """,
+    # Reparenting: the subtree loses the old parent's ancestors and gains the new one's.
+    """
+    CREATE TRIGGER IF NOT EXISTS tag_closure_au AFTER UPDATE OF parent_id ON tag
+    WHEN old.parent_id IS NOT new.parent_id BEGIN
+        DELETE FROM tagclosure
+        WHERE descendant_id IN (SELECT descendant_id FROM tagclosure WHERE ancestor_id = new.id)
+          AND ancestor_id IN (SELECT ancestor_id FROM tagclosure
+                              WHERE descendant_id = new.id AND ancestor_id IS NOT new.id);
+        INSERT INTO tagclosure(ancestor_id, descendant_id, depth)
+        SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+        FROM tagclosure AS above, tagclosure AS below
+        WHERE above.descendant_id = new.parent_id AND below.ancestor_id = new.id;
+    END;
+    """,
+    # Foreign keys cascade too, but the throughput profile turns them off.
+    """
+    CREATE TRIGGER IF NOT EXISTS tag_closure_ad AFTER DELETE ON tag BEGIN
+        DELETE FROM tagclosure WHERE ancestor_id = old.id OR descendant_id = old.id;
+    END;
+    """,
+)
+
+
+def create_tag_closure():
+    """
+    Creates the closure table and its triggers if they don't exist yet.
+    A freshly created closure is filled from the existing tags.
+    """
+    created = not TagClosure.table_exists()
+    with db.atomic():
+        TagClosure.create_table(safe=True)
+        for trigger in TRIGGERS:
+            db.execute_sql(trigger)
+        if created:
+            _fill()
+
+
+def _fill():
+    db.execute_sql(
+        'INSERT OR IGNORE INTO tagclosure(ancestor_id, descendant_id, depth) '
+        'WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS ('
+        '  SELECT id, id, 0 FROM tag'
+        '  UNION ALL'
+        '  SELECT paths.ancestor_id, tag.id, paths.depth + 1 FROM paths'
+        '  JOIN tag ON tag.parent_id = paths.descendant_id WHERE paths.depth < ?'
+        ') SELECT ancestor_id, descendant_id, depth FROM paths', (MAX_DEPTH,))
+
+
+def rebuild_tag_closure():
+    """
+    Recomputes the whole closure from tag.parent_id.
+    """
+    with db.atomic():
+        TagClosure.delete().execute()
+        _fill()
+    logger.info("Tag closure rebuilt.")
+
+
+def descendants(tag_id, include_self=False):
+    """
+    The tags below ``tag_id``, nearest first.
+    """
+    query = (Tag
+             .select(Tag, TagClosure.depth)
+             .join(TagClosure, on=(TagClosure.descendant == Tag.id))
+             .where(TagClosure.ancestor == tag_id))
+    if not include_self:
+        query = query.where(TagClosure.depth > 0)
+    return query.order_by(TagClosure.depth, Tag.name)
+
+
+def ancestors(tag_id, include_self=False):
+    """
+    The tags above ``tag_id``, from its parent up to the root.
+    """
+    query = (Tag
+             .select(Tag, TagClosure.depth)
+             .join(TagClosure, on=(TagClosure.ancestor == Tag.id))
+             .where(TagClosure.descendant == tag_id))
+    if not include_self:
+        query = query.where(TagClosure.depth > 0)
+    return query.order_by(TagClosure.depth)
+
+
+def products_under_tag(tag_id, include_descendants=True):
+    """
+    The products tagged with ``tag_id`` or, by default, with any tag below
+    it, each product once.
+    """
+    tagged = ProductTag.select(ProductTag.product)
+    if include_descendants:
+        tagged = (tagged
+                  .join(TagClosure, on=(TagClosure.descendant == ProductTag.tag))
+                  .where(TagClosure.ancestor == tag_id))
+    else:
+        tagged = tagged.where(ProductTag.tag == tag_id)
+    return Product.select().where(Product.id.in_(tagged)).order_by(Product.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the tag hierarchy closure table.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the closure from the tag table")
+    args = parser.parse_args()
+
+    create_tag_closure()
+    if args.rebuild:
+        rebuild_tag_closure()
@@ -1,20 +1,53 @@
 # Standard library imports
+import asyncio
+import csv
+import datetime
+import decimal
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+import uuid
 import pytest
 
 # Third-party imports
-from peewee import SqliteDatabase
+from peewee import OperationalError, SqliteDatabase, fn
+from playhouse.pool import MaxConnectionsExceeded
 
+import async_operations
+import benchmark
+import bulk_import
 import db_operations
+import export_purchases
+import tag_tree
+import view_database
+import index_advisor
+import main
+import migrate_uuid_offline
+import pagination
+import passwords
+import rankings
+import sales_rollup
+import sessions
+from autocorrect import fuzzy_matches, name_index
 from db_operations import add_product_to_user, create_product, create_user
-from populate_db import populate_test_database
+from product_cache import ProductCache, product_cache
+from populate_db import generate_synthetic_dataset, populate_test_database
+from query_stats import operation, profile_queries
+from search_index import search_products
 
 # Local module imports
-from models import db
+from models import db, make_database, reading, uuid7
+from models import StockError
 from models import Product
 from models import ProductTag
 from models import Purchase
 from models import Tag
+from models import TagClosure
+from models import DailySales
+from models import Session
 from models import User
 from models import UserProduct
 
@@ -60,6 +93,1433 @@ class TestCreateProduct(unittest.TestCase):
             db_operations.create_product("Test Product", "This is a test product.", 10.99, -5)
 
 
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Points the shared database at a fresh in-memory SQLite for each test.
+    """
+    def setUp(self):
+        db.init(':memory:')
+        db_operations.create_database()
+        name_index.reset()
+        product_cache.clear()
+        product_cache.reset_stats()
+        sessions.sessions.clear()
+
+    def tearDown(self):
+        db.close()
+
+
+class TestSearch(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        create_product("AirPods Pro", "Wireless earbuds with noise cancellation", 249.0, 5)
+        create_product("MacBook Pro", "Laptop with M1 chip", 1499.0, 2)
+        create_product("Lightning Cable", "Charges AirPods and iPhone", 19.0, 50)
+
+    def test_search_ranks_name_matches_first(self):
+        self.assertEqual(db_operations.search("airpods"), ["AirPods Pro", "Lightning Cable"])
+
+    def test_search_matches_word_prefixes(self):
+        self.assertEqual(db_operations.search("mac"), ["MacBook Pro"])
+
+    def test_search_follows_updates_and_deletes(self):
+        product = Product.get(Product.name == "MacBook Pro")
+        db_operations.update_product(product.id, description="Laptop with noise-free fans")
+        self.assertEqual(db_operations.search("fans"), ["MacBook Pro"])
+        product.delete_instance()
+        self.assertIsInstance(db_operations.search("fans"), str)
+
+    def test_search_paginates(self):
+        self.assertEqual(db_operations.search("airpods", page=2, per_page=1), ["Lightning Cable"])
+
+
+class TestAutocorrect(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        create_product("AirPods Pro", "Wireless earbuds", 249.0, 5)
+        db_operations.create_tag("Headphones")
+
+    def test_search_suggests_spelling_on_miss(self):
+        self.assertEqual(
+            db_operations.search("airpdos"),
+            "No products found matching the keyword 'airpdos'. Did you mean 'airpods'?")
+
+    def test_index_follows_renames(self):
+        tag = Tag.get(Tag.name == "Headphones")
+        db_operations.update_tag(tag.id, name="Earphones")
+        self.assertEqual(fuzzy_matches("earphnes"), [("Earphones", "tag", 1)])
+        self.assertEqual(fuzzy_matches("headphnes"), [])
+
+    def test_new_products_are_suggested(self):
+        self.assertEqual(fuzzy_matches("airpods pro"), [("AirPods Pro", "product", 0)])
+        create_product("MacBook Pro", "Laptop", 1499.0, 2)
+        self.assertEqual(fuzzy_matches("macbok pro"), [("MacBook Pro", "product", 1)])
+
+    def test_rolled_back_changes_are_not_suggested(self):
+        self.assertEqual(fuzzy_matches("headphnes"), [("Headphones", "tag", 1)])
+        tag = Tag.get(Tag.name == "Headphones")
+        with self.assertRaises(RuntimeError):
+            with db.atomic():
+                create_product("MacBook Pro", "Laptop", 1499.0, 2)
+                db_operations.update_tag(tag.id, name="Earphones")
+                raise RuntimeError
+        self.assertEqual(fuzzy_matches("macbok pro"), [])
+        self.assertEqual(fuzzy_matches("headphnes"), [("Headphones", "tag", 1)])
+
+    def test_index_loaded_mid_transaction_is_reloaded(self):
+        name_index.reset()
+        with db.atomic():
+            create_product("MacBook Pro", "Laptop", 1499.0, 2)
+            # Loads the index, uncommitted product included
+            self.assertEqual(fuzzy_matches("macbok pro"), [("MacBook Pro", "product", 1)])
+        db_operations.delete_product(Product.get(Product.name == "MacBook Pro").id)
+        self.assertEqual(fuzzy_matches("macbok pro"), [])
+
+    def test_main_changes_update_index(self):
+        tag = Tag.get(Tag.name == "Headphones")
+        main.update_tag(tag.id, "Earphones")
+        self.assertEqual(fuzzy_matches("earphnes"), [("Earphones", "tag", 1)])
+        main.delete_tag(tag.id)
+        self.assertEqual(fuzzy_matches("earphnes"), [])
+        main.remove_product(Product.get(Product.name == "AirPods Pro").id)
+        self.assertEqual(fuzzy_matches("airpods pro"), [])
+
+
+class TestListingQueryCounts(DatabaseTestCase):
+    """
+    Listings must issue the same number of queries however many rows they return.
+    """
+    def make_rows(self, count):
+        for i in range(count):
+            user = User.create(
+                username=f"user{self.created + i}", name="Test", address="1 Main St",
+                zipcode="12345", city="Boston", state="MA", country="United States",
+                billing_name="Test", billing_account="123", password="secret",
+                email=f"user{self.created + i}@example.com")
+            product = create_product(f"Product {self.created + i}", "A product.", 9.99, 10)
+            Purchase.create(user=user, product=product, quantity=1, amount=9.99)
+            UserProduct.create(user=user, product=product, quantity=1)
+        self.created += count
+        return user, product
+
+    def count_queries(self, function, *args):
+        with self.assertLogs('peewee', level='DEBUG') as logs:
+            function(*args)
+        return len(logs.records)
+
+    def setUp(self):
+        super().setUp()
+        self.created = 0
+
+    def assertConstantQueries(self, function, *args):
+        self.make_rows(2)
+        few = self.count_queries(function, *args)
+        self.make_rows(20)
+        self.assertEqual(self.count_queries(function, *args), few)
+
+    def test_list_orders(self):
+        self.assertConstantQueries(db_operations.list_orders)
+        self.assertEqual(self.count_queries(db_operations.list_orders), 1)
+
+    def test_get_user_purchases(self):
+        user, _ = self.make_rows(1)
+        for _ in range(5):
+            Purchase.create(user=user, product=Product.select().first(), quantity=1, amount=9.99)
+        self.assertEqual(len(db_operations.get_user_purchases(user.id)), 6)
+        self.assertEqual(self.count_queries(db_operations.get_user_purchases, user.id), 2)
+
+    def test_get_order_details(self):
+        self.make_rows(1)
+        order = Purchase.select().first()
+        details = db_operations.get_order_details(order.id)
+        self.assertEqual(details['user'], "user0")
+        self.assertEqual(details['product'], "Product 0")
+        self.assertEqual(self.count_queries(db_operations.get_order_details, order.id), 1)
+
+    def test_list_user_products(self):
+        user, product = self.make_rows(1)
+        for _ in range(5):
+            UserProduct.create(user=user, product=product, quantity=1)
+        self.assertEqual(self.count_queries(db_operations.list_user_products_by_user, user.id), 1)
+        self.assertEqual(self.count_queries(db_operations.list_user_products_by_product, product.id), 1)
+
+
+class TestQueryProfile(DatabaseTestCase):
+    def test_statements_are_attributed_to_operations(self):
+        create_product("AirPods Pro", "Wireless earbuds", 249.0, 5)
+        with profile_queries() as profile:
+            db_operations.list_orders()
+            db_operations.search("airpods")
+        report = profile.report()
+        self.assertEqual(report['db_operations.list_orders']['queries'], 1)
+        self.assertEqual(report['db_operations.search']['rows'], 1)
+
+    def test_repeated_statements_are_flagged(self):
+        product = create_product("AirPods Pro", "Wireless earbuds", 249.0, 5)
+        with profile_queries(repeat_threshold=3) as profile, operation("product page"):
+            with self.assertLogs('query_stats', level='WARNING'):
+                for _ in range(5):
+                    Product.get_by_id(product.id)
+        self.assertEqual(profile.count("product page"), 5)
+        self.assertEqual(len(profile.report()["product page"]['repeated']), 1)
+
+    def test_repeats_are_counted_per_call(self):
+        product = create_product("AirPods Pro", "Wireless earbuds", 249.0, 5)
+        user = make_user("alice")
+        with profile_queries(repeat_threshold=3) as profile:
+            with self.assertNoLogs('query_stats', level='WARNING'):
+                for _ in range(5):
+                    db_operations.get_user_details(user.id)
+                for _ in range(5):
+                    with operation("product page"):
+                        Product.get_by_id(product.id)
+        report = profile.report()
+        self.assertEqual(report['db_operations.get_user_details']['queries'], 5)
+        self.assertEqual(report['db_operations.get_user_details']['repeated'], {})
+        self.assertEqual(report['product page']['repeated'], {})
+
+
+def make_user(username):
+    return User.create(
+        username=username, name="Test", address="1 Main St", zipcode="12345",
+        city="Boston", state="MA", country="United States", billing_name="Test",
+        billing_account="123", password="secret", email=f"{username}@example.com")
+
+
+class TestPurchaseEngine(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("emma1")
+        self.product = create_product("AirPods Pro", "Wireless earbuds", 249.0, 3)
+
+    def stock(self):
+        return Product.get_by_id(self.product.id).quantity_in_stock
+
+    def test_purchase_reserves_stock_and_records_amount(self):
+        purchase = db_operations.record_purchase(self.user.id, self.product.id, 2)
+        self.assertEqual(purchase.amount, 498)
+        self.assertEqual(self.stock(), 1)
+
+    def test_short_stock_is_refused(self):
+        db_operations.record_purchase(self.user.id, self.product.id, 2)
+        with self.assertRaises(StockError):
+            db_operations.record_purchase(self.user.id, self.product.id, 2)
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(Purchase.select().count(), 1)
+
+    def test_missing_user_rolls_back_the_reservation(self):
+        with self.assertRaises(User.DoesNotExist):
+            db_operations.record_purchase("00000000-0000-0000-0000-000000000000", self.product.id, 1)
+        self.assertEqual(self.stock(), 3)
+
+    def test_purchase_paths_share_the_engine(self):
+        seller = make_user("max1")
+        db_operations.purchase_product(self.user.id, seller.id, self.product.id, 1)
+        self.assertEqual(db_operations.place_order(self.user.id, self.product.id, 5),
+                         f"Not enough stock for Product ID {self.product.id}. Available stock: 2")
+        db_operations.reduce_stock(self.product.id, 2)
+        with self.assertRaises(ValueError):
+            db_operations.purchase_product(self.user.id, seller.id, self.product.id, 1)
+        self.assertEqual(self.stock(), 0)
+
+
+class TestConcurrentPurchases(DatabaseTestCase):
+    # The buyers' threads open their own connections, so a file database
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db.init(os.path.join(self.tmp.name, 'purchases.db'))
+        db_operations.create_database()
+        name_index.reset()
+        product_cache.clear()
+        self.users = [make_user(f"buyer{i}") for i in range(8)]
+        self.product = create_product("AirPods Pro", "Wireless earbuds", 249.0, 5)
+
+    def tearDown(self):
+        db.close()
+        self.tmp.cleanup()
+
+    def test_concurrent_buyers_never_oversell(self):
+        start = threading.Barrier(len(self.users))
+        bought, refused, failed = [], [], []
+
+        def buy(user):
+            start.wait()
+            with db.connection_context():
+                try:
+                    bought.append(db_operations.record_purchase(user.id, self.product.id, 2).quantity)
+                except StockError:
+                    refused.append(user.username)
+                except Exception as e:
+                    failed.append(e)
+
+        threads = [threading.Thread(target=buy, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stock = Product.get_by_id(self.product.id).quantity_in_stock
+        self.assertEqual(failed, [])
+        self.assertEqual(bought, [2, 2])
+        self.assertEqual(len(refused), len(self.users) - 2)
+        self.assertEqual(sum(bought) + stock, 5)
+        self.assertGreaterEqual(stock, 0)
+        self.assertEqual(Purchase.select(fn.SUM(Purchase.quantity)).scalar(), sum(bought))
+
+
+class TestCheckout(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("emma1")
+        self.airpods = create_product("AirPods Pro", "Wireless earbuds", 249.0, 3)
+        self.macbook = create_product("MacBook Pro", "Laptop", 1499.0, 1)
+
+    def stock(self, product):
+        return Product.get_by_id(product.id).quantity_in_stock
+
+    def test_checkout_buys_every_line(self):
+        with profile_queries() as profile:
+            ids = db_operations.checkout(
+                self.user.id, [(self.airpods.id, 1), (self.macbook.id, 1), (self.airpods.id, 1)])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.stock(self.airpods), 1)
+        self.assertEqual(self.stock(self.macbook), 0)
+        self.assertEqual(Purchase.get_by_id(ids[0]).quantity, 2)
+        # user, products, update, insert
+        self.assertEqual(profile.count('db_operations.checkout'), 4)
+
+    def test_checkout_is_all_or_nothing(self):
+        with self.assertRaises(StockError):
+            db_operations.checkout(self.user.id, [(self.airpods.id, 1), (self.macbook.id, 2)])
+        self.assertEqual(self.stock(self.airpods), 3)
+        self.assertEqual(self.stock(self.macbook), 1)
+        self.assertEqual(Purchase.select().count(), 0)
+
+
+
+class TestBulkImport(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.feed = os.path.join(self.tmp.name, "feed.csv")
+        self.rejects = os.path.join(self.tmp.name, "rejects.jsonl")
+        with open(self.feed, "w", encoding="utf-8") as feed:
+            feed.write("name,description,price,quantity\n"
+                       "Clay Mug,Hand thrown mug,12.50,4\n"
+                       "Linen Scarf,Woven scarf,-1,2\n"
+                       "Oak Bowl,Turned bowl,30,1\n")
+        create_product("Clay Mug", "Old description", 10.0, 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def test_skip_keeps_existing_and_rejects_bad_rows(self):
+        stats = bulk_import.import_products(self.feed, rejects_path=self.rejects)
+        self.assertEqual((stats['imported'], stats['skipped'], stats['rejected']), (1, 1, 1))
+        self.assertEqual(Product.get(Product.name == "Clay Mug").description, "Old description")
+        with open(self.rejects, encoding="utf-8") as rejects:
+            self.assertEqual(json.loads(rejects.readline())['line'], 3)
+        self.assertEqual([p.name for p in search_products("bowl")], ["Oak Bowl"])
+
+    def test_broken_jsonl_lines_are_rejected(self):
+        feed = os.path.join(self.tmp.name, "feed.jsonl")
+        with open(feed, "w", encoding="utf-8") as f:
+            f.write('{"name": "Oak Bowl", "description": "Turned bowl", "price": 30, "quantity": 1}\n'
+                    '{"name": "Linen Scarf", "description": \n'
+                    '\n'
+                    '["not", "an", "object"]\n'
+                    '{"name": "Wool Hat", "description": "Knitted hat", "price": 15, "quantity": 3}\n')
+        stats = bulk_import.import_products(feed, rejects_path=self.rejects)
+        self.assertEqual((stats['read'], stats['imported'], stats['rejected']), (4, 2, 2))
+        with open(self.rejects, encoding="utf-8") as rejects:
+            rejected = [json.loads(line) for line in rejects]
+        self.assertEqual([reject['line'] for reject in rejected], [2, 4])
+        self.assertIn("Invalid JSON", rejected[0]['error'])
+        self.assertEqual(rejected[0]['row'], '{"name": "Linen Scarf", "description": ')
+
+    def test_update_overwrites_existing(self):
+        stats = bulk_import.import_products(self.feed, on_conflict=bulk_import.UPDATE)
+        self.assertEqual((stats['imported'], stats['updated']), (1, 1))
+        mug = Product.get(Product.name == "Clay Mug")
+        self.assertEqual((mug.description, mug.quantity_in_stock), ("Hand thrown mug", 4))
+        self.assertEqual([p.name for p in search_products("thrown")], ["Clay Mug"])
+
+
+class TestSyntheticDataset(DatabaseTestCase):
+    SIZES = dict(users=200, products=50, tags=20, purchases=3000, seed=7, shard_size=1000)
+
+    def snapshot(self):
+        return {model.__name__: list(model.select().order_by(model.id).tuples())
+                for model in (User, Tag, Product, ProductTag, Purchase)}
+
+    def test_same_seed_same_rows_for_any_worker_count(self):
+        generate_synthetic_dataset(**self.SIZES)
+        first = self.snapshot()
+        db.close()
+        db.init(':memory:')
+        generate_synthetic_dataset(workers=2, **self.SIZES)
+        self.assertEqual(self.snapshot(), first)
+        self.assertEqual(len(first['Purchase']), 3000)
+
+    def test_distributions(self):
+        generate_synthetic_dataset(**self.SIZES)
+        counts = [count for _, count in (Purchase
+                                         .select(Purchase.product, fn.COUNT(Purchase.id))
+                                         .group_by(Purchase.product)
+                                         .order_by(fn.COUNT(Purchase.id).desc())
+                                         .tuples())]
+        # Zipfian popularity: the best seller outsells the median product many times over
+        self.assertGreater(counts[0], 10 * counts[len(counts) // 2])
+        self.assertTrue(Tag.select().where(Tag.parent.is_null(False)).exists())
+        name = Product.select(Product.name).scalar()
+        self.assertEqual([p.name for p in search_products(name)], [name])
+
+
+    def test_purchase_ids_are_uuid7_in_date_order(self):
+        generate_synthetic_dataset(**self.SIZES)
+        purchases = list(Purchase.select(Purchase.id, Purchase.date).order_by(Purchase.id))
+        self.assertEqual({purchase.id.version for purchase in purchases}, {7})
+        dates = [purchase.date for purchase in purchases]
+        self.assertEqual(dates, sorted(dates))
+        epoch = datetime.datetime(1970, 1, 1)
+        first = purchases[0]
+        self.assertEqual((epoch + datetime.timedelta(milliseconds=first.id.int >> 80)).date(), first.date)
+
+class TestBenchmark(DatabaseTestCase):
+    def test_run_reports_latency_percentiles(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = benchmark.run_benchmarks(
+                200, data_dir=data_dir, cases=['search', 'checkout'], iterations=5, max_seconds=1)
+        self.assertEqual(set(results), {'search', 'checkout'})
+        metrics = results['checkout']
+        self.assertEqual(metrics['iterations'], 5)
+        self.assertLessEqual(metrics['p50_ms'], metrics['p95_ms'])
+        self.assertLessEqual(metrics['p95_ms'], metrics['p99_ms'])
+        self.assertEqual(metrics['queries_per_call'], 4)
+
+    def test_compare_flags_slower_cases_only(self):
+        baseline = {'results': {'10k': {'search': {'p50_ms': 1.0, 'p95_ms': 2.0},
+                                        'checkout': {'p50_ms': 1.0, 'p95_ms': 2.0}}}}
+        current = {'results': {'10k': {'search': {'p50_ms': 1.5, 'p95_ms': 2.1},
+                                       'checkout': {'p50_ms': 0.5, 'p95_ms': 1.0},
+                                       'list_products': {'p50_ms': 9.0, 'p95_ms': 9.0}}}}
+        regressions = benchmark.compare(current, baseline, threshold=0.2)
+        self.assertEqual([(r['case'], r['metric']) for r in regressions], [('search', 'p50_ms')])
+
+    def test_key_benchmark_covers_every_generator(self):
+        results = benchmark.run_key_benchmark(3000, samples=3)
+        self.assertEqual(set(results), {'uuid4', 'uuid7'})
+        self.assertEqual([sample['rows'] for sample in results['uuid7']['growth']], [1000, 2000, 3000])
+        self.assertGreater(results['uuid7']['primary_key_index_bytes'], 0)
+
+
+class TestDatabaseProfiles(DatabaseTestCase):
+    def test_profile_pragmas_are_applied_and_logged(self):
+        profile = db.profile
+        self.addCleanup(db.configure, ':memory:', profile)
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertLogs('models', level='INFO') as logs:
+                db.configure(os.path.join(tmp, 'durable.db'), profile='durable')
+                db.connect()
+            db.close()
+        self.assertIn("SQLite profile 'durable'", logs.output[0])
+        self.assertIn("journal_mode=wal", logs.output[0])
+        self.assertIn("synchronous=2", logs.output[0])
+        self.assertEqual(len(logs.output), 1)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            db.configure(profile='fastest')
+
+    def test_deletes_respect_foreign_keys(self):
+        product = create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+        tag = db_operations.create_tag("Pottery")
+        db_operations.add_tag_to_product(product.id, tag.id)
+        db_operations.record_purchase(make_user("emma1").id, product.id, 1)
+        self.assertEqual(db.execute_sql('PRAGMA foreign_keys').fetchone()[0], 1)
+
+        db_operations.delete_product(product.id)
+        self.assertFalse(ProductTag.select().exists())
+        self.assertFalse(Purchase.select().exists())
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.pool = make_database(os.path.join(self.tmp.name, 'pool.db'), pool_size=2, timeout=5)
+        self.addCleanup(self.pool.close_all)
+
+    def test_threads_share_a_bounded_pool(self):
+        def work():
+            for _ in range(5):
+                with self.pool.connection_context():
+                    self.pool.execute_sql('SELECT 1')
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        status = self.pool.pool_status()
+        self.assertEqual(status['checkouts'], 40)
+        self.assertLessEqual(status['opened'], 2)
+        self.assertEqual((status['in_use'], status['timeouts']), (0, 0))
+        self.assertGreaterEqual(status['wait_max'], status['wait_mean'])
+
+    def test_wait_times_out_when_pool_is_exhausted(self):
+        self.pool.init(self.pool.database, max_connections=1, timeout=0.05)
+        self.pool.connect()
+        errors = []
+
+        def work():
+            try:
+                self.pool.connect()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.pool.close()
+        self.assertIsInstance(errors[0], MaxConnectionsExceeded)
+        self.assertEqual(self.pool.pool_status()['timeouts'], 1)
+
+
+class TestAsyncOperations(DatabaseTestCase):
+    # Worker threads open their own connections, so a file database
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db.init(os.path.join(self.tmp.name, 'async.db'))
+        db_operations.create_database()
+        name_index.reset()
+        self.executor = async_operations.DatabaseExecutor(read_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        async_operations.shutdown()
+        db.close()
+        self.tmp.cleanup()
+
+    def test_get_user_by_username(self):
+        user = make_user("emma1")
+
+        async def main():
+            return await asyncio.gather(async_operations.get_user_by_username("emma1"),
+                                        async_operations.get_user_by_username("nobody"))
+
+        found, missing = asyncio.run(main())
+        self.assertEqual(found.id, user.id)
+        self.assertIsNone(missing)
+
+    def test_sessions(self):
+        passwords.hasher.configure(workers=0)
+        self.addCleanup(passwords.hasher.configure, workers=passwords.DEFAULT_WORKERS)
+        user = make_user("emma1")
+
+        async def main():
+            refused = await async_operations.create_session("emma1", "guess")
+            session = await async_operations.create_session("emma1", "secret")
+            valid = sessions.validate(session['token'])
+            return refused, valid, await async_operations.logout(session['token'])
+
+        refused, valid, logged_out = asyncio.run(main())
+        self.assertEqual(refused, "Incorrect password for user: emma1.")
+        self.assertEqual(valid, user.id)
+        self.assertEqual(logged_out, "Successfully logged out.")
+
+    def test_concurrent_reads_and_serialized_writes(self):
+        user = make_user("emma1")
+        product = create_product("Clay Mug", "Hand thrown mug", 12.5, 30)
+
+        async def main():
+            buys = [async_operations.record_purchase(user.id, product.id, 1) for _ in range(20)]
+            reads = [async_operations.search("mug") for _ in range(50)]
+            return await asyncio.gather(*buys, *reads)
+
+        results = asyncio.run(main())
+        self.assertEqual(results[-1], ["Clay Mug"])
+        self.assertEqual(Product.get_by_id(product.id).quantity_in_stock, 10)
+
+    def test_timeout_interrupts_a_running_read(self):
+        def slow_read():
+            return db.execute_sql(
+                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                "SELECT count(*) FROM n").fetchone()
+
+        async def main():
+            with self.assertRaises(TimeoutError):
+                await self.executor.run(async_operations.READ, slow_read, timeout=0.2)
+            # Every worker is free again
+            def select_one():
+                return db.execute_sql('SELECT 1').fetchone()[0]
+            return await asyncio.gather(*[self.executor.run(async_operations.READ, select_one)
+                                          for _ in range(4)])
+
+        started = time.perf_counter()
+        self.assertEqual(asyncio.run(asyncio.wait_for(main(), 5)), [1] * 4)
+        self.assertLess(time.perf_counter() - started, 5)
+
+    def test_cancelled_write_never_runs(self):
+        release = threading.Event()
+        ran = []
+
+        async def main():
+            blocker = asyncio.ensure_future(self.executor.run(async_operations.WRITE, release.wait))
+            await asyncio.sleep(0.05)
+            queued = asyncio.ensure_future(self.executor.run(async_operations.WRITE, ran.append, 1))
+            await asyncio.sleep(0.05)
+            queued.cancel()
+            release.set()
+            await blocker
+            with self.assertRaises(asyncio.CancelledError):
+                await queued
+
+        asyncio.run(main())
+        self.assertEqual(ran, [])
+
+class TestReadRouting(DatabaseTestCase):
+    def setUp(self):
+        # Routing on, whatever BETSY_DB_READ_ROUTING says
+        self.addCleanup(setattr, db, 'read_routing', db.read_routing)
+        db.read_routing = True
+        self.tmp = tempfile.TemporaryDirectory()
+        db.init(os.path.join(self.tmp.name, 'routing.db'))
+        db_operations.create_database()
+        name_index.reset()
+
+    def tearDown(self):
+        db.close()
+        db.configure(read_path='')
+        self.tmp.cleanup()
+
+    def test_reads_use_a_read_only_connection(self):
+        create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+        self.assertEqual(db_operations.search("mug"), ["Clay Mug"])
+        self.assertEqual(db_operations.list_products()[0]['name'], "Clay Mug")
+        with reading():
+            self.assertIsNot(db.cursor().connection, db.connection())
+            with self.assertRaises(OperationalError):
+                Tag.create(name="Pottery")
+
+    def test_transactions_read_their_own_writes(self):
+        with db.atomic():
+            create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+            self.assertEqual(db_operations.search("mug"), ["Clay Mug"])
+            with reading():
+                self.assertIs(db.cursor().connection, db.connection())
+
+    def test_reads_from_a_replica(self):
+        create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        replica = os.path.join(self.tmp.name, 'replica.db')
+        db.execute_sql('VACUUM INTO ?', (replica,))
+        create_product("Oak Bowl", "Turned bowl", 30, 1)
+
+        db.configure(read_path=replica)
+        self.assertEqual([product['name'] for product in db_operations.list_products()], ["Clay Mug"])
+        self.assertEqual(Product.select().count(), 2)
+
+
+class TestBinaryUUIDs(DatabaseTestCase):
+    def test_keys_are_stored_as_16_bytes(self):
+        product = create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+        db_operations.record_purchase(make_user("emma1").id, product.id, 1)
+        row = db.execute_sql('SELECT typeof(id), length(id), typeof(product_id) FROM purchase').fetchone()
+        self.assertEqual(row, ('blob', 16, 'blob'))
+        self.assertEqual(Product.get_by_id(str(product.id)).name, "Clay Mug")
+        self.assertEqual(Product.get_by_id(product.id.hex).name, "Clay Mug")
+        self.assertFalse(Product.select().where(Product.id == 'not-a-uuid').exists())
+
+    def test_migration_converts_text_keys_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db.init(os.path.join(tmp, 'legacy.db'))
+            db_operations.create_database()
+            user = make_user("emma1")
+            product = create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+            purchase = db_operations.record_purchase(user.id, product.id, 1)
+            # Keys as UUIDField stored them
+            db.execute_sql('PRAGMA foreign_keys = 0')
+            db.execute_sql('UPDATE user SET id = lower(hex(id))')
+            db.execute_sql('UPDATE product SET id = lower(hex(id))')
+            db.execute_sql('UPDATE purchase SET id = lower(hex(id)), user_id = lower(hex(user_id)), '
+                           'product_id = lower(hex(product_id))')
+            db.execute_sql('PRAGMA foreign_keys = 1')
+
+            result = migrate_uuid_offline.migrate(batch_size=1)
+            self.assertEqual(result['converted']['purchase'], 1)
+            self.assertEqual(db.execute_sql('SELECT typeof(user_id) FROM purchase').fetchone()[0], 'blob')
+            self.assertEqual(Purchase.get_by_id(purchase.id).product.name, "Clay Mug")
+            self.assertEqual(db.execute_sql('PRAGMA foreign_keys').fetchone()[0], 1)
+            self.assertIn('purchase', result['after']['objects'])
+            self.assertLess(result['after']['objects']['purchase']['used'],
+                            result['before']['objects']['purchase']['used'])
+            # Nothing left to convert
+            self.assertEqual(set(migrate_uuid_offline.migrate()['converted'].values()), {0})
+            db.close()
+
+    def test_failed_migration_converts_nothing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db.init(os.path.join(tmp, 'legacy.db'))
+            db_operations.create_database()
+            user = make_user("emma1")
+            product = create_product("Clay Mug", "Hand thrown mug", 12.5, 3)
+            db_operations.record_purchase(user.id, product.id, 1)
+            db.execute_sql('PRAGMA foreign_keys = 0')
+            db.execute_sql('UPDATE user SET id = lower(hex(id))')
+            db.execute_sql('UPDATE purchase SET user_id = lower(hex(user_id))')
+            # A purchase of a product that doesn't exist fails the final check
+            db.execute_sql('UPDATE purchase SET product_id = ?', (uuid.uuid4().bytes,))
+            db.execute_sql('PRAGMA foreign_keys = 1')
+
+            with self.assertRaises(ValueError):
+                migrate_uuid_offline.migrate(batch_size=1)
+            self.assertEqual(db.execute_sql('SELECT typeof(id) FROM user').fetchone()[0], 'text')
+            self.assertEqual(db.execute_sql('SELECT typeof(user_id) FROM purchase').fetchone()[0], 'text')
+            self.assertEqual(db.execute_sql('PRAGMA foreign_keys').fetchone()[0], 1)
+            db.close()
+
+
+class TestTimeOrderedKeys(DatabaseTestCase):
+    def test_uuid7_is_time_ordered(self):
+        before = int(time.time() * 1000)
+        ids = [uuid7() for _ in range(5000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual({key.version for key in ids}, {7})
+        self.assertLessEqual(before, ids[0].int >> 80)
+
+    def test_purchases_get_time_ordered_keys(self):
+        user = make_user("emma1")
+        product = create_product("Clay Mug", "Hand thrown mug", 12.5, 10)
+        purchases = [db_operations.record_purchase(user.id, product.id, 1) for _ in range(3)]
+        self.assertEqual([purchase.id.version for purchase in purchases], [7, 7, 7])
+        self.assertEqual(user.id.version, 4)
+        # Earlier v4 keys stay valid next to the new ones
+        legacy = Purchase.create(id=uuid.uuid4(), user=user, product=product, quantity=1, amount=12.5)
+        self.assertEqual(Purchase.get_by_id(legacy.id).quantity, 1)
+        self.assertEqual(list(Purchase.select().where(Purchase.id != legacy.id).order_by(Purchase.id)), purchases)
+
+
+class TestIndexAdvisor(DatabaseTestCase):
+    def test_current_schema_has_no_findings(self):
+        self.assertEqual(index_advisor.advise(), [])
+        # The workload was rolled back
+        self.assertFalse(User.select().exists())
+        self.assertFalse(Product.select().exists())
+
+    def test_flags_scans_and_redundant_indexes(self):
+        db.execute_sql('DROP INDEX purchase_user_id_id')
+        db.execute_sql('DROP INDEX purchase_user_id_date')
+        db.execute_sql('CREATE INDEX tag_parent_only ON tag (parent_id)')
+        db.execute_sql('CREATE INDEX tag_parent_name ON tag (parent_id, name)')
+        findings = {(finding['kind'], finding['operation'] or finding['table'])
+                    for finding in index_advisor.advise()}
+        self.assertIn((index_advisor.FULL_SCAN, 'db_operations.get_user_purchases'), findings)
+        self.assertIn((index_advisor.UNINDEXED_FOREIGN_KEY, 'purchase'), findings)
+        self.assertIn((index_advisor.REDUNDANT_INDEX, 'tag'), findings)
+
+    def test_workload_covers_sessions_and_exports(self):
+        operations = {statement[0] for statement in index_advisor.capture_workload()}
+        for name in ('db_operations.update_tag', 'db_operations.update_user', 'db_operations.create_purchase',
+                     'db_operations.check_login', 'db_operations.start_session', 'db_operations.logout',
+                     'db_operations.get_user_by_username', 'sessions.validate', 'export_purchases.chunks'):
+            self.assertIn(name, operations)
+
+    def test_user_export_uses_the_date_index(self):
+        query = export_purchases.purchases_query(uuid.uuid4(), since=datetime.date(2024, 1, 1))
+        sql, params = query.sql()
+        self.assertTrue(any('purchase_user_id_date' in detail for detail in index_advisor.explain(sql, params)))
+
+    def test_composite_indexes_serve_the_lookups(self):
+        plan = index_advisor.explain(
+            'SELECT * FROM producttag WHERE product_id = ? AND tag_id = ?', (b'x' * 16, b'y' * 16))
+        self.assertIn('producttag_product_id_tag_id', plan[0])
+
+
+class TestTagTree(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.electronics = Tag.create(name="Electronics")
+        self.audio = Tag.create(name="Audio", parent=self.electronics)
+        self.headphones = Tag.create(name="Headphones", parent=self.audio)
+        self.laptops = Tag.create(name="Laptops", parent=self.electronics)
+        for name, tag in [("AirPods Pro", self.headphones), ("MacBook Pro", self.laptops),
+                          ("Speaker", self.audio)]:
+            product = create_product(name, name, 100.0, 1)
+            db_operations.add_tag_to_product(product.id, tag.id)
+
+    def closure(self):
+        return set(TagClosure.select(TagClosure.ancestor, TagClosure.descendant, TagClosure.depth).tuples())
+
+    def assertClosureIsConsistent(self):
+        maintained = self.closure()
+        tag_tree.rebuild_tag_closure()
+        self.assertEqual(maintained, self.closure())
+
+    def names(self, query):
+        return [row.name for row in query]
+
+    def test_products_under_tag_include_descendants(self):
+        self.assertEqual(self.names(tag_tree.products_under_tag(self.electronics.id)),
+                         ["AirPods Pro", "MacBook Pro", "Speaker"])
+        self.assertEqual(self.names(tag_tree.products_under_tag(self.audio.id, include_descendants=False)),
+                         ["Speaker"])
+        self.assertEqual(self.names(tag_tree.descendants(self.electronics.id)),
+                         ["Audio", "Laptops", "Headphones"])
+        self.assertEqual(self.names(tag_tree.ancestors(self.headphones.id)), ["Audio", "Electronics"])
+        with profile_queries() as profile:
+            list(tag_tree.products_under_tag(self.electronics.id))
+        self.assertEqual(profile.count(), 1)
+
+    def test_reparenting_moves_the_subtree(self):
+        db_operations.update_tag(self.audio.id, parent=self.laptops.id)
+        self.assertEqual(self.names(tag_tree.ancestors(self.headphones.id)), ["Audio", "Laptops", "Electronics"])
+        self.assertEqual(self.names(tag_tree.products_under_tag(self.laptops.id)),
+                         ["AirPods Pro", "MacBook Pro", "Speaker"])
+        db_operations.update_tag(self.audio.id, parent=None)
+        self.assertEqual(self.names(tag_tree.products_under_tag(self.electronics.id)), ["MacBook Pro"])
+        self.assertClosureIsConsistent()
+
+    def test_cycles_are_refused(self):
+        result = db_operations.update_tag(self.electronics.id, parent=self.headphones.id)
+        self.assertIn("cannot be moved under itself", result)
+        self.assertIsNone(Tag.get_by_id(self.electronics.id).parent)
+        self.assertClosureIsConsistent()
+
+    def test_deleting_a_tag_detaches_its_children(self):
+        db_operations.delete_tag(self.audio.id)
+        self.assertEqual(self.names(tag_tree.ancestors(self.headphones.id)), [])
+        self.assertEqual(self.names(tag_tree.products_under_tag(self.electronics.id)), ["MacBook Pro"])
+        self.assertClosureIsConsistent()
+
+    def test_initialize_database_creates_the_closure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db.init(os.path.join(tmp, 'init.db'))
+            self.assertFalse(db_operations.are_tables_initialized())
+            db_operations.initialize_database()
+            self.assertTrue(db_operations.are_tables_initialized())
+            electronics = Tag.create(name="Electronics")
+            audio = Tag.create(name="Audio", parent=electronics)
+            self.assertEqual(self.names(tag_tree.ancestors(audio.id)), ["Electronics"])
+            TagClosure.drop_table()
+            self.assertFalse(db_operations.are_tables_initialized())
+            db.close()
+
+
+class TestProductCache(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = create_product("Clay Mug", "Hand thrown mug", 12.5, 10)
+        self.tag = db_operations.create_tag("Pottery")
+
+    def details(self):
+        return db_operations.get_product_details(self.product.id)
+
+    def test_repeated_lookups_are_served_from_the_cache(self):
+        with profile_queries() as profile:
+            first = self.details()
+            second = self.details()
+        self.assertEqual(first, second)
+        self.assertEqual(first['stock'], 10)
+        self.assertEqual(profile.count(), 2)
+        stats = product_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+        # Callers get their own copy
+        first['tags'].append("Changed")
+        self.assertEqual(self.details()['tags'], [])
+
+    def test_writes_invalidate_the_product(self):
+        user = make_user("emma1")
+        self.details()
+        db_operations.add_stock(self.product.id, 5)
+        self.assertEqual(self.details()['stock'], 15)
+        db_operations.record_purchase(user.id, self.product.id, 2)
+        self.assertEqual(self.details()['stock'], 13)
+        db_operations.checkout(user.id, [(self.product.id, 3)])
+        self.assertEqual(self.details()['stock'], 10)
+        db_operations.update_product(self.product.id, price_per_unit=20)
+        self.assertEqual(self.details()['price'], 20)
+        db_operations.add_tag_to_product(self.product.id, self.tag.id)
+        self.assertEqual(self.details()['tags'], ["Pottery"])
+        db_operations.update_tag(self.tag.id, name="Ceramics")
+        self.assertEqual(self.details()['tags'], ["Ceramics"])
+        db_operations.delete_tag(self.tag.id)
+        self.assertEqual(self.details()['tags'], [])
+        db_operations.delete_product(self.product.id)
+        self.assertIn("does not exist", self.details())
+        self.assertEqual(product_cache.stats()['hits'], 0)
+
+    def test_main_changes_invalidate_the_product(self):
+        self.details()
+        main.add_tag_to_product(self.product.id, "Pottery")
+        self.assertEqual(self.details()['tags'], ["Pottery"])
+        main.update_tag(self.tag.id, "Ceramics")
+        self.assertEqual(self.details()['tags'], ["Ceramics"])
+        main.remove_tag_from_product(self.product.id, "Ceramics")
+        self.assertEqual(self.details()['tags'], [])
+        main.add_tag_to_product(self.product.id, "Stoneware")
+        self.assertEqual(self.details()['tags'], ["Stoneware"])
+        main.delete_tag(Tag.get(Tag.name == "Stoneware").id)
+        self.assertEqual(self.details()['tags'], [])
+        main.remove_product(self.product.id)
+        self.assertIn("does not exist", self.details())
+
+    def test_commit_drops_values_cached_during_the_transaction(self):
+        with db.atomic():
+            db_operations.add_stock(self.product.id, 5)
+            # A reader that still saw the committed row
+            product_cache.get(self.product.id, lambda product_id: {'stock': 10})
+        self.assertEqual(self.details()['stock'], 15)
+
+    def test_loads_overlapping_an_invalidation_are_not_stored(self):
+        def load(product_id):
+            product_cache.invalidate(product_id)
+            return {'stock': 10}
+
+        product_cache.get(self.product.id, load)
+        self.assertEqual(product_cache.stats()['size'], 0)
+
+    def test_bounded_by_size_and_age(self):
+        now = [0.0]
+        cache = ProductCache(max_size=2, ttl=10, clock=lambda: now[0])
+        ids = [uuid.uuid4() for _ in range(3)]
+        for product_id in ids:
+            cache.get(product_id, lambda product_id: {'id': product_id})
+        cache.get(ids[1], self.fail)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        now[0] = 11
+        cache.get(ids[2], lambda product_id: {'id': product_id})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations']), (1, 4, 1))
+
+    def test_can_be_disabled(self):
+        with product_cache.disabled():
+            self.details()
+            self.details()
+        self.assertEqual(product_cache.stats()['size'], 0)
+        self.assertEqual(product_cache.stats()['misses'], 0)
+
+
+class TestPagination(DatabaseTestCase):
+    def pages(self, listing, *args, per_page=3):
+        pages = [listing(*args, per_page=per_page)]
+        while pages[-1].next_cursor:
+            pages.append(listing(*args, cursor=pages[-1].next_cursor, per_page=per_page))
+        return pages
+
+    def test_pages_cover_every_row_once(self):
+        names = [f"Product {i}" for i in range(7)]
+        for name in reversed(names):
+            create_product(name, "Sample", 1.0, 1)
+        pages = self.pages(db_operations.list_products)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([row['name'] for page in pages for row in page], names)
+        for i in range(4):
+            make_user(f"user{i}")
+            db_operations.create_tag(f"tag{i}")
+        self.assertEqual([len(page) for page in self.pages(db_operations.list_users)], [3, 1])
+        self.assertEqual([len(page) for page in self.pages(db_operations.list_tags)], [3, 1])
+
+    def test_orders_page_by_time_ordered_id(self):
+        user, other = make_user("emma1"), make_user("noah1")
+        product = create_product("Clay Mug", "Hand thrown mug", 12.5, 100)
+        purchases = [db_operations.record_purchase(user.id, product.id, 1) for _ in range(5)]
+        db_operations.record_purchase(other.id, product.id, 1)
+        pages = self.pages(db_operations.list_orders, user.id, per_page=2)
+        self.assertEqual([row['order_id'] for page in pages for row in page],
+                         [purchase.id for purchase in purchases])
+        self.assertEqual(sum(len(page) for page in self.pages(db_operations.list_orders)), 6)
+
+    def test_later_pages_seek_instead_of_skipping(self):
+        for i in range(5):
+            create_product(f"Product {i}", "Sample", 1.0, 1)
+        cursor = db_operations.list_products(per_page=2).next_cursor
+        with profile_queries(capture_params=True) as profile:
+            db_operations.list_products(cursor=cursor, per_page=2)
+        (_, sql, params), = profile.statements()
+        self.assertNotIn('OFFSET', sql)
+        self.assertTrue(index_advisor.explain(sql, params)[0].startswith('SEARCH'))
+        # Rows added before the cursor don't shift the following pages
+        create_product("Product 0a", "Sample", 1.0, 1)
+        self.assertEqual([row['name'] for row in db_operations.list_products(cursor=cursor, per_page=2)],
+                         ["Product 2", "Product 3"])
+
+    def test_invalid_arguments(self):
+        create_product("Clay Mug", "Hand thrown mug", 12.5, 10)
+        make_user("emma1")
+        self.assertEqual(db_operations.list_products(cursor="not a cursor"), "Invalid page cursor.")
+        cursor = db_operations.list_users(per_page=1).next_cursor
+        self.assertIsNone(cursor)
+        user_cursor = pagination.encode_cursor('users', "emma1")
+        self.assertEqual(db_operations.list_products(cursor=user_cursor), "Invalid page cursor.")
+        self.assertEqual(db_operations.list_users(cursor=user_cursor), [])
+        self.assertIn("per_page must be", db_operations.list_orders(per_page=0))
+
+
+class TestViewDatabase(DatabaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db.init(os.path.join(self.tmp.name, 'dump.db'))
+        db_operations.create_database()
+        name_index.reset()
+        self.user = make_user("emma1")
+        self.product = create_product("Clay Mug", "Hand thrown mug", 12.5, 1000)
+
+    def tearDown(self):
+        db.close()
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.tmp.name, 'out', name), encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def test_streams_tables_as_csv_and_jsonl(self):
+        for _ in range(3):
+            db_operations.record_purchase(self.user.id, self.product.id, 2)
+        output = os.path.join(self.tmp.name, 'out')
+        counts = view_database.dump(fmt='csv', output=output)
+        self.assertEqual((counts['product'], counts['purchase']), (1, 3))
+        header, *rows = self.read('purchase.csv')
+        self.assertTrue(header.startswith('id,user_id,product_id,quantity,amount'))
+        self.assertEqual(len(rows), 3)
+        self.assertIn(str(self.user.id), rows[0])
+
+        view_database.dump([Product, Purchase], 'jsonl', output, limit=2)
+        product, = [json.loads(line) for line in self.read('product.jsonl')]
+        self.assertEqual((product['id'], product['name']), (str(self.product.id), "Clay Mug"))
+        self.assertEqual(len(self.read('purchase.jsonl')), 2)
+        with self.assertRaises(ValueError):
+            view_database.dump(fmt='csv')
+
+    def test_sampling(self):
+        with db.atomic():
+            for _ in range(400):
+                Purchase.create(user=self.user, product=self.product, quantity=1, amount=12.5)
+        output = os.path.join(self.tmp.name, 'out')
+        counts = view_database.dump([Purchase], 'csv', output, sample=0.25)
+        self.assertLess(40, counts['purchase'])
+        self.assertLess(counts['purchase'], 160)
+
+    def test_snapshot_does_not_block_or_see_writers(self):
+        with view_database.snapshot():
+            self.assertEqual(Product.select().count(), 1)
+            # Another thread writes and commits while the snapshot is open
+            writer = threading.Thread(target=lambda: (create_product("Oak Bowl", "Turned bowl", 30, 1),
+                                                      db.close()))
+            writer.start()
+            writer.join()
+            self.assertEqual(Product.select().count(), 1)
+        with reading():
+            self.assertEqual(Product.select().count(), 2)
+
+
+class TestExportPurchases(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.user, self.other = make_user("emma1"), make_user("noah1")
+        self.product = create_product("Clay Mug", "Hand thrown mug", 12.5, 100)
+        self.purchases = []
+        for day in range(1, 6):
+            for user in (self.user, self.other):
+                self.purchases.append(Purchase.create(user=user, product=self.product, quantity=day,
+                                                      amount=12.5 * day, date=datetime.date(2024, 1, day)))
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def read_csv(self, name):
+        with open(self.path(name), newline='', encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+
+    def test_exports_joined_rows_in_chunks(self):
+        with profile_queries() as profile:
+            result = export_purchases.export_purchases(self.path('all.csv'), chunk_size=4)
+        self.assertEqual(result['rows'], 10)
+        # Three chunks, each one joined query
+        self.assertEqual(profile.count(), 3)
+        rows = self.read_csv('all.csv')
+        self.assertEqual([row['purchase_id'] for row in rows], [str(p.id) for p in self.purchases])
+        self.assertEqual((rows[0]['username'], rows[0]['product_name'], rows[0]['amount'], rows[0]['date']),
+                         ("emma1", "Clay Mug", "12.5", "2024-01-01"))
+
+    def test_filters_and_resume(self):
+        result = export_purchases.export_purchases(
+            self.path('emma.csv'), user_id=self.user.id, since=datetime.date(2024, 1, 2),
+            until=datetime.date(2024, 1, 5))
+        self.assertEqual([row['quantity'] for row in self.read_csv('emma.csv')], ["2", "3", "4"])
+        # Only what was bought since the last export
+        Purchase.create(user=self.user, product=self.product, quantity=9, amount=1, date=datetime.date(2024, 1, 3))
+        resumed = export_purchases.export_purchases(
+            self.path('more.csv'), user_id=self.user.id, since=datetime.date(2024, 1, 2),
+            until=datetime.date(2024, 1, 5), cursor=result['cursor'])
+        self.assertEqual([row['quantity'] for row in self.read_csv('more.csv')], ["9"])
+        with self.assertRaises(ValueError):
+            export_purchases.export_purchases(self.path('bad.csv'), cursor=pagination.encode_cursor('orders', "x"))
+        with self.assertRaises(ValueError):
+            export_purchases.export_purchases(self.path('purchases.xlsx'))
+        self.assertEqual(resumed['rows'], 1)
+
+    def test_resume_picks_up_purchases_below_legacy_ids(self):
+        # A random (UUIDv4) id from before the switch to UUIDv7 sorts above new ids
+        Purchase.create(id=uuid.UUID('ffffffff-ffff-4fff-bfff-ffffffffffff'), user=self.user,
+                        product=self.product, quantity=7, amount=1, date=datetime.date(2024, 1, 6))
+        result = export_purchases.export_purchases(self.path('all.csv'))
+        self.assertEqual(result['rows'], 11)
+        Purchase.create(user=self.other, product=self.product, quantity=8, amount=1, date=datetime.date(2024, 1, 7))
+        resumed = export_purchases.export_purchases(self.path('new.csv'), cursor=result['cursor'])
+        self.assertEqual([row['quantity'] for row in self.read_csv('new.csv')], ["8"])
+        self.assertEqual(resumed['rows'], 1)
+
+    @unittest.skipIf(export_purchases.pyarrow is None, "pyarrow is not installed")
+    def test_columnar_output(self):
+        import pyarrow.parquet
+        export_purchases.export_purchases(self.path('all.parquet'), chunk_size=3)
+        table = pyarrow.parquet.read_table(self.path('all.parquet'))
+        self.assertEqual(table.num_rows, 10)
+        self.assertEqual(table.column('amount')[1].as_py(), decimal.Decimal('12.50'))
+        self.assertEqual(table.column('date')[0].as_py(), datetime.date(2024, 1, 1))
+        export_purchases.export_purchases(self.path('all.arrow'))
+        with pyarrow.ipc.open_file(self.path('all.arrow')) as reader:
+            self.assertEqual(reader.read_all().column_names, list(export_purchases.COLUMNS))
+
+
+class TestSalesRollup(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer, self.seller = make_user("emma1"), make_user("noah1")
+        self.mug = create_product("Clay Mug", "Hand thrown mug", 12.5, 100)
+        self.bowl = create_product("Oak Bowl", "Turned bowl", 30, 100)
+
+    def rollup(self):
+        return set(DailySales.select(DailySales.date, DailySales.product, DailySales.category,
+                                     DailySales.purchases, DailySales.units, DailySales.amount).tuples())
+
+    def test_initialize_database_creates_the_rollups(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db.init(os.path.join(tmp, 'init.db'))
+            db_operations.initialize_database()
+            buyer = make_user("emma1")
+            mug = create_product("Clay Mug", "Hand thrown mug", 12.5, 100)
+            db_operations.record_purchase(buyer.id, mug.id, 2)
+            self.assertEqual([row['units'] for row in sales_rollup.daily_revenue()], [2])
+            self.assertEqual(rankings.compute_top_products(1)[0]['units'], 2)
+            db.close()
+
+    def assertRollupIsConsistent(self):
+        maintained = self.rollup()
+        sales_rollup.rebuild_sales_rollup()
+        self.assertEqual(maintained, self.rollup())
+
+    def test_every_purchase_path_updates_the_rollup(self):
+        db_operations.create_purchase(self.buyer.id, self.mug.id, 1)
+        db_operations.record_purchase(self.buyer.id, self.mug.id, 2)
+        db_operations.purchase_product(self.buyer.id, self.seller.id, self.mug.id, 1)
+        db_operations.place_order(self.buyer.id, self.bowl.id, 1)
+        db_operations.checkout(self.buyer.id, [(self.mug.id, 1), (self.bowl.id, 2)])
+        today = datetime.date.today()
+        mug = DailySales.get(date=today, product=self.mug.id, category='')
+        self.assertEqual((mug.purchases, mug.units, mug.amount), (4, 5, decimal.Decimal('62.50')))
+        self.assertEqual(DailySales.get(date=today, product=self.bowl.id).units, 3)
+        self.assertRollupIsConsistent()
+
+    def test_updates_and_deletes_move_the_totals(self):
+        day = datetime.date(2024, 3, 1)
+        purchase = Purchase.create(user=self.buyer, product=self.mug, quantity=2, amount=25,
+                                   date=day, category="gifts")
+        Purchase.create(user=self.buyer, product=self.mug, quantity=1, amount=12.5, date=day)
+        Purchase.update(quantity=3, amount=37.5).where(Purchase.id == purchase.id).execute()
+        self.assertEqual(DailySales.get(date=day, product=self.mug.id, category="gifts").units, 3)
+        Purchase.update(date=datetime.date(2024, 3, 2)).where(Purchase.id == purchase.id).execute()
+        self.assertEqual(DailySales.select().where(DailySales.category == "gifts").get().date,
+                         datetime.date(2024, 3, 2))
+        self.assertRollupIsConsistent()
+        Purchase.delete().where(Purchase.id == purchase.id).execute()
+        self.assertFalse(DailySales.select().where(DailySales.category == "gifts").exists())
+        # A rolled back purchase leaves no trace
+        with db.atomic() as transaction:
+            Purchase.create(user=self.buyer, product=self.mug, quantity=5, amount=62.5, date=day)
+            transaction.rollback()
+        self.assertEqual(DailySales.get(date=day, product=self.mug.id).units, 1)
+        self.assertRollupIsConsistent()
+
+    def test_revenue_reads_the_rollup(self):
+        for month, day in [(1, 5), (1, 20), (2, 3)]:
+            for product in (self.mug, self.bowl):
+                Purchase.create(user=self.buyer, product=product, quantity=1,
+                                amount=product.price_per_unit, date=datetime.date(2024, month, day))
+        with profile_queries() as profile:
+            daily = sales_rollup.daily_revenue(since=datetime.date(2024, 1, 6), product_id=self.mug.id)
+            monthly = sales_rollup.monthly_revenue()
+        self.assertEqual([(row['period'], row['amount']) for row in daily],
+                         [(datetime.date(2024, 1, 20), decimal.Decimal('12.50')),
+                          (datetime.date(2024, 2, 3), decimal.Decimal('12.50'))])
+        self.assertEqual([(row['period'], row['purchases'], row['amount']) for row in monthly],
+                         [('2024-01', 4, decimal.Decimal('85.00')), ('2024-02', 2, decimal.Decimal('42.50'))])
+        self.assertEqual(profile.count(), 2)
+
+    def test_bulk_loads_aggregate_once(self):
+        generate_synthetic_dataset(users=20, products=10, tags=3, purchases=500)
+        self.assertEqual(DailySales.select(fn.SUM(DailySales.purchases)).scalar(), 500)
+        self.assertRollupIsConsistent()
+        self.assertIn('daily_sales_ai', [row[0] for row in db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'")])
+
+
+class TestRankings(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = make_user("emma1")
+        self.electronics = Tag.create(name="Electronics")
+        self.audio = Tag.create(name="Audio", parent=self.electronics)
+        self.pottery = Tag.create(name="Pottery")
+        self.products = {}
+        for name, tag in [("Speaker", self.audio), ("Laptop", self.electronics), ("Clay Mug", self.pottery)]:
+            self.products[name] = create_product(name, name, 10.0, 1000)
+            db_operations.add_tag_to_product(self.products[name].id, tag.id)
+
+    def buy(self, name, quantity, days_ago=0):
+        Purchase.create(user=self.buyer, product=self.products[name], quantity=quantity, amount=10.0 * quantity,
+                        date=datetime.date.today() - datetime.timedelta(days=days_ago))
+
+    def names(self, rows):
+        return [row['name'] for row in rows]
+
+    def test_top_products_overall_per_tag_and_window(self):
+        self.buy("Clay Mug", 5)
+        self.buy("Speaker", 2)
+        self.buy("Laptop", 3, days_ago=10)
+        self.buy("Speaker", 2, days_ago=10)
+        with profile_queries(capture_params=True) as profile:
+            top = rankings.top_products(2)
+        self.assertEqual(self.names(top), ["Clay Mug", "Speaker"])
+        self.assertEqual((top[0]['units'], top[0]['amount']), (5, decimal.Decimal('50.00')))
+        # Served from the counters, not the purchase table
+        (_, sql, _), = profile.statements()
+        self.assertNotIn('"purchase"', sql)
+        self.assertEqual(self.names(rankings.top_products(5, tag_id=self.electronics.id)), ["Speaker", "Laptop"])
+        self.assertEqual(self.names(rankings.top_products(5, tag_id=self.electronics.id,
+                                                          include_descendants=False)), ["Laptop"])
+        self.assertEqual(self.names(rankings.top_products(5, days=7)), ["Clay Mug", "Speaker"])
+        self.assertEqual(rankings.top_products(5, tag_id=self.electronics.id, days=7)[0]['units'], 2)
+
+    def test_counters_follow_every_purchase(self):
+        db_operations.record_purchase(self.buyer.id, self.products["Laptop"].id, 4)
+        self.assertEqual(self.names(rankings.top_products(1)), ["Laptop"])
+        db_operations.checkout(self.buyer.id, [(self.products["Speaker"].id, 5)])
+        self.assertEqual(self.names(rankings.top_products(1)), ["Speaker"])
+        Purchase.delete().where(Purchase.product == self.products["Speaker"].id).execute()
+        self.assertEqual(self.names(rankings.top_products(5)), ["Laptop"])
+
+    def test_periodic_lists_have_bounded_staleness(self):
+        now = [0.0]
+        periodic = rankings.Rankings(rankings.PERIODIC, max_staleness=30, clock=lambda: now[0])
+        self.buy("Clay Mug", 1)
+        self.assertEqual(self.names(periodic.top_products(1)), ["Clay Mug"])
+        self.buy("Speaker", 3)
+        now[0] = 29
+        self.assertEqual(self.names(periodic.top_products(1)), ["Clay Mug"])
+        now[0] = 30
+        self.assertEqual(self.names(periodic.top_products(1)), ["Speaker"])
+        self.buy("Laptop", 9)
+        periodic.refresh()
+        with profile_queries() as profile:
+            self.assertEqual(self.names(periodic.top_products(1)), ["Laptop"])
+        self.assertEqual(profile.count(), 0)
+        with self.assertRaises(ValueError):
+            rankings.Rankings("hourly")
+
+
+class TestPasswords(DatabaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # A file database, so read operations run on the read-only connections
+        db.init(os.path.join(self.tmp.name, 'passwords.db'))
+        db_operations.create_database()
+        name_index.reset()
+        self.settings = (passwords.hasher.rounds, passwords.hasher.workers, passwords.hasher.queue_size)
+        passwords.hasher.configure(rounds=4, workers=0)
+
+    def tearDown(self):
+        rounds, workers, queue_size = self.settings
+        passwords.hasher.configure(rounds, workers, queue_size)
+        passwords.hasher.queue_timeout = None
+        db.close()
+        self.tmp.cleanup()
+
+    def stored(self, username):
+        return User.get(User.username == username).password
+
+    def test_hashes_and_verifies_in_worker_processes(self):
+        passwords.hasher.configure(workers=1)
+        hashed = passwords.hash_password("s3cret")
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(passwords.verify_password("s3cret", hashed))
+        self.assertFalse(passwords.verify_password("guess", hashed))
+
+        async def main():
+            hashed = await passwords.hash_password_async("s3cret")
+            return await asyncio.gather(passwords.verify_password_async("s3cret", hashed),
+                                        passwords.verify_password_async("guess", hashed))
+
+        self.assertEqual(asyncio.run(main()), [True, False])
+
+    def test_full_queue_times_out(self):
+        passwords.hasher.configure(workers=1, queue_size=1)
+        passwords.hasher.queue_timeout = 0.05
+        passwords.hasher._slots.acquire()
+        try:
+            with self.assertRaises(TimeoutError):
+                passwords.hash_password("s3cret")
+        finally:
+            passwords.hasher._slots.release()
+
+    def test_rejects_unsupported_rounds(self):
+        with self.assertRaises(ValueError):
+            passwords.hasher.configure(rounds=3)
+        self.assertEqual(passwords.hasher.rounds, 4)
+
+    def test_login_rehashes_when_the_cost_changes(self):
+        make_user("emma1")
+        User.update(password=passwords.hash_password("s3cret")).execute()
+        old = self.stored("emma1")
+        self.assertEqual(db_operations.authenticate_user("emma1", "s3cret"), "User emma1 authenticated successfully.")
+        self.assertEqual(self.stored("emma1"), old)
+
+        passwords.hasher.configure(rounds=5)
+        self.assertEqual(db_operations.authenticate_user("emma1", "guess"), "Incorrect password for user emma1.")
+        self.assertEqual(self.stored("emma1"), old)
+        self.assertEqual(db_operations.login("emma1", "s3cret"), "Login successful for user: emma1.")
+        self.assertTrue(self.stored("emma1").startswith('$2b$05$'))
+        self.assertEqual(db_operations.authenticate_user("emma1", "s3cret"), "User emma1 authenticated successfully.")
+
+    def test_async_login_stores_rehashes_on_the_writer(self):
+        make_user("emma1")
+        threads = []
+        store = db_operations.store_rehashed_password
+
+        def recording_store(user, hashed):
+            threads.append(threading.current_thread().name)
+            store(user, hashed)
+
+        db_operations.store_rehashed_password = recording_store
+        self.addCleanup(setattr, db_operations, 'store_rehashed_password', store)
+        self.addCleanup(async_operations.shutdown)
+        result = asyncio.run(async_operations.authenticate_user("emma1", "secret"))
+        self.assertEqual(result, "User emma1 authenticated successfully.")
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith("db-write"))
+        self.assertFalse(passwords.needs_rehash(self.stored("emma1")))
+
+    def test_plaintext_passwords_are_hashed_on_login(self):
+        make_user("emma1")
+        self.assertEqual(db_operations.login("emma1", "guess"), "Incorrect password for user: emma1.")
+        self.assertEqual(self.stored("emma1"), "secret")
+        self.assertEqual(db_operations.login("emma1", "secret"), "Login successful for user: emma1.")
+        self.assertTrue(passwords.verify_password("secret", self.stored("emma1")))
+        self.assertFalse(passwords.needs_rehash(self.stored("emma1")))
+
+    def test_update_user_password_hashes(self):
+        user = make_user("emma1")
+        db_operations.update_user_password(user.id, "n3w")
+        self.assertTrue(self.stored("emma1").startswith('$2b$04$'))
+        self.assertEqual(db_operations.login("emma1", "n3w"), "Login successful for user: emma1.")
+
+
+class TestSessions(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1_700_000_000.0
+        self.store = sessions.SessionStore(ttl=3600, recheck=30, clock=lambda: self.now)
+        self.emma = make_user("emma1")
+        self.max = make_user("max1")
+
+    def test_validates_from_memory_and_reads_the_table_on_a_miss(self):
+        token = self.store.issue(self.emma.id)
+        self.assertNotIn(token, [row.token_hash for row in Session.select()])
+        with profile_queries() as profile:
+            self.assertEqual(self.store.validate(token), self.emma.id)
+        self.assertEqual(profile.count(), 0)
+
+        # Another process: a cold cache
+        other = sessions.SessionStore(clock=lambda: self.now)
+        self.assertEqual(other.validate(token), self.emma.id)
+        self.assertIsNone(other.validate("not-a-token"))
+        self.assertIsNone(other.validate(None))
+
+    def test_revoke_and_revoke_user(self):
+        first, second = self.store.issue(self.emma.id), self.store.issue(str(self.emma.id))
+        kept = self.store.issue(self.max)
+        self.assertTrue(self.store.revoke(first))
+        self.assertFalse(self.store.revoke(first))
+        self.assertIsNone(self.store.validate(first))
+        self.assertEqual(self.store.validate(second), self.emma.id)
+
+        self.assertEqual(self.store.revoke_user(self.emma.id), 1)
+        self.assertIsNone(self.store.validate(second))
+        self.assertEqual(self.store.validate(kept), self.max.id)
+
+    def test_revocations_elsewhere_are_seen_after_recheck(self):
+        token = self.store.issue(self.emma.id)
+        Session.delete().execute()
+        self.assertEqual(self.store.validate(token), self.emma.id)
+        self.now += 31
+        self.assertIsNone(self.store.validate(token))
+
+    def test_expired_sessions_are_purged_lazily_and_swept(self):
+        lazy = self.store.issue(self.emma.id, ttl=60)
+        swept = self.store.issue(self.max.id, ttl=60)
+        live = self.store.issue(self.max.id)
+        self.now += 61
+        self.assertIsNone(self.store.validate(lazy))
+        self.assertEqual(Session.select().count(), 2)
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertIsNone(self.store.validate(swept))
+        self.assertEqual(self.store.validate(live), self.max.id)
+        self.assertEqual(Session.select().count(), 1)
+
+    def test_create_session_and_logout(self):
+        passwords.hasher.configure(workers=0)
+        self.addCleanup(passwords.hasher.configure, workers=passwords.DEFAULT_WORKERS)
+        self.assertEqual(db_operations.create_session("emma1", "guess"), "Incorrect password for user: emma1.")
+        session = db_operations.create_session("emma1", "secret")
+        self.assertEqual(session['user_id'], self.emma.id)
+        self.assertEqual(sessions.validate(session['token']), self.emma.id)
+        self.assertEqual(db_operations.logout(session['token']), "Successfully logged out.")
+        self.assertIsNone(sessions.validate(session['token']))
+        self.assertEqual(db_operations.logout(session['token']), "No user is currently logged in.")
+
+    def test_initialize_database_creates_the_session_table(self):
+        passwords.hasher.configure(workers=0)
+        self.addCleanup(passwords.hasher.configure, workers=passwords.DEFAULT_WORKERS)
+        with tempfile.TemporaryDirectory() as tmp:
+            db.init(os.path.join(tmp, 'init.db'))
+            db_operations.initialize_database()
+            make_user("ann")
+            session = db_operations.create_session("ann", "secret")
+            self.assertEqual(db_operations.logout(session['token']), "Successfully logged out.")
+            Session.drop_table()
+            self.assertFalse(db_operations.are_tables_initialized())
+            db.close()
+
+    def test_password_change_and_deletion_sign_the_user_out(self):
+        passwords.hasher.configure(rounds=4, workers=0)
+        self.addCleanup(passwords.hasher.configure, passwords.DEFAULT_ROUNDS, passwords.DEFAULT_WORKERS)
+        token = sessions.issue(self.emma.id)
+        db_operations.update_user_password(self.emma.id, "n3w")
+        self.assertIsNone(sessions.validate(token))
+        token = sessions.issue(self.max.id)
+        db_operations.delete_user(self.max.id)
+        self.assertIsNone(sessions.validate(token))
+
+
 # tests related to add_product_to_user in test_db_operations.py
 
 def test_remove_tag_from_product(self):
@@ -1,5 +1,38 @@
+"""
+Prints or dumps the contents of every table.
 
-from models import db, Product, User, Tag, ProductTag, Purchase, UserProduct
+Without arguments each row is printed as before. With ``--format csv`` or
+``--format jsonl`` the tables are streamed as plain tuples, so memory stays
+constant however large a table is:
+
+    python view_database.py --format csv --output dump/ --snapshot
+    python view_database.py --format jsonl --tables purchase --sample 0.01 --limit 100000
+
+``--snapshot`` reads every table in one read transaction on the read-only
+connection: the dump is consistent as of one moment and, under WAL, never
+blocks the writers.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from peewee import fn
+
+from models import db, reading, Product, User, Tag, ProductTag, Purchase, UserProduct
+
+
+logger = logging.getLogger(__name__)
+
+TABLES = [Product, User, Tag, ProductTag, Purchase, UserProduct]
+FORMATS = ('repr', 'csv', 'jsonl')
+DEFAULT_PROGRESS_EVERY = 100000
+# random() is uniform over the signed 64-bit integers
+RANDOM_RANGE = float(2 ** 64)
 
 
 def view_table(model):
@@ -7,20 +40,148 @@ def view_table(model):
     rows = model.select()
     return rows
 
+
+def table_rows(model, limit=None, sample=None):
+    """
+    (columns, rows) of one table, the rows as tuples streamed from the
+    cursor. ``sample`` keeps about that fraction of the rows, ``limit``
+    stops after that many.
+    """
+    fields = model._meta.sorted_fields
+    query = model.select(*fields)
+    if sample is not None:
+        query = query.where(fn.random() / RANDOM_RANGE + 0.5 < sample)
+    if limit is not None:
+        query = query.limit(limit)
+    return [field.column_name for field in fields], query.tuples().iterator()
+
+
+class _JsonlWriter:
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns
+
+    def writerow(self, row):
+        # UUIDs, decimals and dates as their str()
+        self.out.write(json.dumps(dict(zip(self.columns, row)), default=str) + "\n")
+
+
+def dump_table(model, out, fmt='csv', limit=None, sample=None, progress_every=DEFAULT_PROGRESS_EVERY):
+    """
+    Writes one table to the file object ``out`` and returns the number of
+    rows written. Progress is logged every ``progress_every`` rows.
+    """
+    columns, rows = table_rows(model, limit, sample)
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+    elif fmt == 'jsonl':
+        writer = _JsonlWriter(out, columns)
+    else:
+        raise ValueError(f"Unknown dump format '{fmt}'. Choose csv or jsonl.")
+
+    table = model._meta.table_name
+    start = time.perf_counter()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if progress_every and count % progress_every == 0:
+            elapsed = time.perf_counter() - start
+            logger.info(f"{table}: {count} rows ({count / elapsed:.0f} rows/s)")
+    logger.info(f"{table}: {count} rows written in {time.perf_counter() - start:.1f}s.")
+    return count
+
+
+@contextlib.contextmanager
+def snapshot():
+    """
+    Runs the block in one read transaction, on the read-only connection when
+    reads are routed (see models.BetsyDatabase), so every table is read as
+    of the same moment without holding up the writers.
+    """
+    if not db.routes_reads():
+        with db.atomic():
+            yield
+        return
+    conn = db.read_connection()
+    conn.execute('BEGIN')
+    try:
+        with reading():
+            yield
+    finally:
+        conn.execute('COMMIT')
+
+
+def dump(tables=None, fmt='csv', output=None, limit=None, sample=None,
+         progress_every=DEFAULT_PROGRESS_EVERY, use_snapshot=False):
+    """
+    Dumps ``tables`` (all of TABLES by default) to ``output``/<table>.<fmt>,
+    or to stdout when ``output`` is None. Returns {table: rows written}.
+    """
+    tables = tables or TABLES
+    if output is None and len(tables) > 1:
+        raise ValueError("Dumping more than one table needs an output directory.")
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+    counts = {}
+    with snapshot() if use_snapshot else reading():
+        for model in tables:
+            table = model._meta.table_name
+            if output is None:
+                counts[table] = dump_table(model, sys.stdout, fmt, limit, sample, progress_every)
+                continue
+            with open(os.path.join(output, f"{table}.{fmt}"), 'w', newline='', encoding='utf-8') as out:
+                counts[table] = dump_table(model, out, fmt, limit, sample, progress_every)
+    return counts
+
+
 def main():
-    tables = [Product, User, Tag, ProductTag, Purchase, UserProduct]
+    tables = TABLES
     for table in tables:
         print(f"Contents of {table.__name__}:")
-        rows = view_table(table)
+        # Streamed, so instances aren't all kept in memory
+        rows = view_table(table).iterator()
         for row in rows:
             print(row)
         print("\n")
 
+
 if __name__ == "__main__":
-    db.connect()  # Connect to the database
+    by_name = {model._meta.table_name: model for model in TABLES}
+    parser = argparse.ArgumentParser(description="Print or dump the contents of the tables.")
+    parser.add_argument("--format", choices=FORMATS, default='repr', help="output format (default: repr)")
+    parser.add_argument("--output", help="directory for one <table>.<format> file per table")
+    parser.add_argument("--tables", nargs="+", choices=sorted(by_name), help="tables to dump (default: all)")
+    parser.add_argument("--limit", type=int, help="dump at most this many rows per table")
+    parser.add_argument("--sample", type=float, help="dump about this fraction of each table (0-1)")
+    parser.add_argument("--progress-every", type=int, default=DEFAULT_PROGRESS_EVERY,
+                        help="log progress every N rows (0: never)")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="read everything from one read-only snapshot")
+    parser.add_argument("--db", help="database file (default: BETSY_DB_PATH)")
+    args = parser.parse_args()
+
+    # Progress goes to stderr
+    logging.basicConfig(level=logging.INFO)
+    if args.db:
+        db.configure(args.db)
+    if args.format == 'repr':
+        db.connect()  # Connect to the database
 
-    # Create tables if they don't exist
-    db.create_tables([Product, User, Tag, ProductTag, Purchase, UserProduct])
+        # Create tables if they don't exist
+        db.create_tables([Product, User, Tag, ProductTag, Purchase, UserProduct])
 
-    main()
-    db.close()  # Close the connection
+        main()
+        db.close()  # Close the connection
+    else:
+        if args.sample is not None and not 0 < args.sample <= 1:
+            parser.error("--sample must be between 0 and 1.")
+        tables = [by_name[name] for name in args.tables] if args.tables else None
+        try:
+            dump(tables, args.format, args.output, args.limit, args.sample,
+                 args.progress_every, args.snapshot)
+        except ValueError as e:
+            parser.error(str(e))
+        finally:
+            db.close()